@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Deterministic local stand-ins for ssh, sshfs, docker, pigz, fusermount and ssh-add.
+
+The harness symlinks this script under each tool name into a directory that is put first on $PATH.
+The tool is chosen by the name it is invoked as. Behaviour is configured through environment variables:
+
+DOCKERDO_BENCH_ROOT       Directory holding the fake remote host ("remote") and container ("container") filesystems
+DOCKERDO_BENCH_LATENCY    Seconds added to every network round trip (ssh exec, ssh control commands)
+DOCKERDO_BENCH_BANDWIDTH  Bytes per second for streams crossing the network (0 for unlimited)
+DOCKERDO_BENCH_IMAGE_MB   Size of the image produced by docker save, in megabytes
+DOCKERDO_BENCH_BOOT       Seconds for docker run or docker start to boot a stopped container
+"""
+
+import json
+import os
+import re
+import signal
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+CHUNK_SIZE = 1 << 16
+ROOT = Path(os.environ.get("DOCKERDO_BENCH_ROOT", "/tmp/dockerdo-bench"))
+LATENCY = float(os.environ.get("DOCKERDO_BENCH_LATENCY", "0"))
+BANDWIDTH = float(os.environ.get("DOCKERDO_BENCH_BANDWIDTH", "0"))
+IMAGE_MB = int(os.environ.get("DOCKERDO_BENCH_IMAGE_MB", "16"))
+BOOT = float(os.environ.get("DOCKERDO_BENCH_BOOT", "0"))
+STATE_FILE = ROOT / "containers.json"
+# Container events, appended by the fake docker and followed by docker events
+EVENTS_FILE = ROOT / "events.jsonl"
+MUX_MSG_HELLO = 0x00000001
+MUX_C_ALIVE_CHECK = 0x10000004
+MUX_S_ALIVE = 0x80000005
+RE_CONTAINER_COMMAND = re.compile(r"^source (\S+) && cd (\S+) && (.*)$", re.DOTALL)
+RE_REMOTE_COMMAND = re.compile(r"^cd (\S+) && (.*)$", re.DOTALL)
+RE_BATCH_COMMAND = re.compile(r"^(__dockerdo_run \d+ )(\S+)", re.MULTILINE)
+RE_TRANSFER_PATH = re.compile(r"(^|&& )(mkdir -p |cd )(/\S*)")
+
+
+def round_trip() -> None:
+    if LATENCY > 0:
+        time.sleep(LATENCY)
+
+
+def boot() -> None:
+    if BOOT > 0:
+        time.sleep(BOOT)
+
+
+def copy_stream(source, destination, limit: int = -1) -> int:
+    """Copy between binary streams, throttled to the configured bandwidth"""
+    start = time.monotonic()
+    total = 0
+    while limit < 0 or total < limit:
+        size = CHUNK_SIZE if limit < 0 else min(CHUNK_SIZE, limit - total)
+        chunk = source.read(size) if source is not None else bytes(size)
+        if not chunk:
+            break
+        destination.write(chunk)
+        total += len(chunk)
+        if BANDWIDTH > 0:
+            ahead = total / BANDWIDTH - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    destination.flush()
+    return total
+
+
+def load_state() -> dict:
+    if not STATE_FILE.exists():
+        return {}
+    with open(STATE_FILE, "r") as fin:
+        return json.load(fin)
+
+
+def save_state(state: dict) -> None:
+    with open(STATE_FILE, "w") as fout:
+        json.dump(state, fout)
+
+
+def inside(root: Path, path: str) -> Path:
+    """Map an absolute path on a fake host into the directory standing in for its filesystem"""
+    return root / path.lstrip("/")
+
+
+def emit_event(container_name: str, action: str) -> None:
+    event = {
+        "Type": "container", "Action": action, "id": container_name, "Actor": {"Attributes": {"name": container_name}}
+    }
+    with open(EVENTS_FILE, "a") as fout:
+        fout.write(json.dumps(event) + "\n")
+
+
+def follow_events(container_name: str) -> None:
+    """
+    Print the events of the container from now on, until terminated.
+    Run through the fake ssh, it also stops with it, as the real one stops when its connection closes.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    parent = os.getppid()
+    EVENTS_FILE.touch()
+    with open(EVENTS_FILE, "r") as fin:
+        fin.seek(0, os.SEEK_END)
+        while os.getppid() == parent:
+            line = fin.readline()
+            if not line:
+                time.sleep(0.01)
+                continue
+            if json.loads(line)["Actor"]["Attributes"]["name"] == container_name:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+
+
+def stay_alive() -> None:
+    """Run until terminated, like a long-running ssh master, sshfs -f or docker events"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    while True:
+        time.sleep(3600)
+
+
+def mux_message(*values: int) -> bytes:
+    payload = struct.pack(f">{len(values)}I", *values)
+    return struct.pack(">I", len(payload)) + payload
+
+
+def serve_control_socket(socket_path: Path) -> None:
+    """Answer `ssh -O check` on the control socket, in the connection multiplexing protocol of OpenSSH"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    socket_path.unlink(missing_ok=True)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(socket_path))
+        server.listen()
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    connection.sendall(mux_message(MUX_MSG_HELLO, 4))
+                    connection.recv(12)
+                    request = connection.recv(12)
+                    if len(request) == 12 and struct.unpack(">III", request)[1] == MUX_C_ALIVE_CHECK:
+                        connection.sendall(mux_message(MUX_S_ALIVE, struct.unpack(">III", request)[2], os.getpid()))
+                except OSError:
+                    pass
+
+
+def run_remote(command: str, cwd: Optional[Path] = None) -> int:
+    """Run the command given to ssh, terminated with it, as the real one is when its connection closes"""
+    process = subprocess.Popen(["sh", "-c", command], cwd=cwd)
+
+    def terminate(signum, frame) -> None:
+        process.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    return process.wait()
+
+
+def ssh(args: list) -> int:
+    if "-O" in args:
+        round_trip()
+        return 0
+    if "-M" in args:
+        # Master connection: answer on the control socket until terminated
+        socket_path = Path(args[args.index("-S") + 1])
+        round_trip()
+        serve_control_socket(socket_path)
+    round_trip()
+    command = args[-1]
+    match = RE_CONTAINER_COMMAND.match(command)
+    if match is not None:
+        env_file, work_dir, command = match.groups()
+        root = ROOT / "container"
+        script = f". {inside(root, env_file)} && cd {inside(root, work_dir)} && {command}"
+        return run_remote(script)
+    if "-p" in args and RE_TRANSFER_PATH.match(command) is not None:
+        # dockerdo export-files and cp, connecting to the container: tar and find in a directory of the container
+        root = ROOT / "container"
+        script = RE_TRANSFER_PATH.sub(lambda m: f"{m.group(1)}{m.group(2)}{inside(root, m.group(3))}", command)
+        return run_remote(script)
+    if RE_BATCH_COMMAND.search(command) is not None:
+        # dodo --batch: each command changes to its working directory in the container
+        root = ROOT / "container"
+        script = RE_BATCH_COMMAND.sub(lambda m: f"{m.group(1)}{inside(root, m.group(2))}", command)
+        return run_remote(script)
+    match = RE_REMOTE_COMMAND.match(command)
+    if match is not None:
+        build_dir, command = match.groups()
+        cwd = inside(ROOT / "remote", build_dir) if build_dir.startswith("/") else ROOT / "remote" / build_dir
+        cwd.mkdir(parents=True, exist_ok=True)
+        return run_remote(command, cwd)
+    return run_remote(command, ROOT / "remote")
+
+
+def docker(args: list) -> int:
+    state = load_state()
+    subcommand = args[0]
+    if subcommand == "ps":
+        name = next((arg.split("=", 1)[1] for arg in args if arg.startswith("name=")), None)
+        name = name.strip("^$") if name is not None else None
+        for container_name, container_state in state.items():
+            if name is None or container_name == name:
+                print(json.dumps({
+                    "Names": container_name,
+                    "State": container_state,
+                    "ID": container_name,
+                    "Image": "image",
+                    "Status": container_state,
+                }))
+        return 0
+    if subcommand == "run":
+        name = args[args.index("--name") + 1]
+        boot()
+        state[name] = "running"
+        save_state(state)
+        print(name)
+        return 0
+    if subcommand == "rename":
+        old_name, new_name = args[1:3]
+        if old_name not in state:
+            print(f"Error: No such container: {old_name}", file=sys.stderr)
+            return 1
+        state[new_name] = state.pop(old_name)
+        save_state(state)
+        return 0
+    if subcommand in ("start", "stop", "rm"):
+        name = args[-1]
+        if subcommand == "rm":
+            state.pop(name, None)
+        else:
+            if subcommand == "start" and state.get(name) != "running":
+                boot()
+            state[name] = "running" if subcommand == "start" else "exited"
+        save_state(state)
+        print(name)
+        return 0
+    if subcommand == "save":
+        copy_stream(None, sys.stdout.buffer, limit=IMAGE_MB << 20)
+        return 0
+    if subcommand == "load":
+        if "-i" in args:
+            with open(args[args.index("-i") + 1], "rb") as fin:
+                total = copy_stream(fin, open(os.devnull, "wb"))
+        else:
+            total = copy_stream(sys.stdin.buffer, open(os.devnull, "wb"))
+        print(f"Loaded image ({total} bytes)")
+        return 0
+    if subcommand == "images":
+        # Every image exists
+        if "--format" in args:
+            repository, _, tag = args[-1].partition(":")
+            print(json.dumps({"Repository": repository, "Tag": tag or "latest", "ID": "0123456789ab", "Size": "1GB"}))
+        else:
+            print("REPOSITORY   TAG   IMAGE ID   CREATED   SIZE")
+        return 0
+    if subcommand == "events":
+        name = next(arg.split("=", 1)[1] for arg in args if arg.startswith("container="))
+        follow_events(name)
+    if subcommand == "commit":
+        # Like docker commit, the container is paused while committing
+        emit_event(args[1], "pause")
+        emit_event(args[1], "unpause")
+        return 0
+    if subcommand in ("build", "push", "rmi"):
+        return 0
+    print(f"fake docker: unsupported subcommand {subcommand}", file=sys.stderr)
+    return 1
+
+
+def pigz(args: list) -> int:
+    if "-d" in args:
+        with open(args[-1], "rb") as fin:
+            copy_stream(fin, sys.stdout.buffer)
+        return 0
+    copy_stream(sys.stdin.buffer, sys.stdout.buffer)
+    return 0
+
+
+def sshfs(args: list) -> int:
+    round_trip()
+    if "-f" in args:
+        # Foreground mode: runs until unmounted
+        stay_alive()
+    return 0
+
+
+def main() -> int:
+    tool = Path(sys.argv[0]).name
+    args = sys.argv[1:]
+    if tool == "ssh":
+        return ssh(args)
+    if tool == "docker":
+        return docker(args)
+    if tool == "pigz":
+        return pigz(args)
+    if tool == "sshfs":
+        return sshfs(args)
+    if tool == "fusermount":
+        return 0
+    if tool == "ssh-add":
+        print("256 SHA256:benchmark benchmark (ED25519)")
+        return 0
+    print(f"fake_tools: unknown tool {tool} {shlex.join(args)}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Benchmark the hot paths of the dockerdo CLI offline.
+
+The real CLI from this source tree is run against the stand-ins in fake_tools.py,
+with a temporary directory tree standing in for the remote host and the container.
+Reports per-command latency, throughput and peak memory, so that performance changes can be compared.
+
+Usage: python benchmarks/run_benchmarks.py [--latency 0.05] [--bandwidth 10e6] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from subprocess import Popen
+from typing import Dict, List, Any, Callable, Optional, Tuple
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARK_DIR.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from dockerdo.config import Session  # noqa: E402
+from dockerdo.container_state import invalidate_cached_state  # noqa: E402
+from dockerdo.shell import send_supervisor_request  # noqa: E402
+
+FAKE_TOOLS = ("ssh", "docker", "pigz", "sshfs", "fusermount", "ssh-add")
+REMOTE_HOST = "benchhost"
+CLI = "import sys; from dockerdo import cli; sys.exit(cli())"
+
+
+def wait_nohang(process: Popen) -> Optional[Tuple[int, int, Any]]:
+    """os.wait4 without blocking: None if the process is still running"""
+    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    return (pid, status, rusage) if pid != 0 else None
+
+
+class Workspace:
+    """Temporary directory tree with the fake tools, the fake hosts, and an active session"""
+
+    def __init__(self, root: Path, latency: float, bandwidth: float, image_mb: int, boot: float) -> None:
+        self.root = root
+        self.bin_dir = root / "bin"
+        self.remote_root = root / "remote"
+        self.container_root = root / "container"
+        self.work_dir = root / "work"
+        self.session_dir = root / "session"
+        self.project_dir = self.container_root / "opt" / "project"
+        for directory in (self.bin_dir, self.remote_root / "build", self.work_dir / "container", root / "home"):
+            directory.mkdir(parents=True, exist_ok=True)
+        for tool in FAKE_TOOLS:
+            (self.bin_dir / tool).symlink_to(BENCHMARK_DIR / "fake_tools.py")
+        # The sshfs mount points stand in for the fake hosts. The container mount point is a real directory,
+        # so that the working directory of dodo, which has its symlinks resolved, is inside the mount point.
+        self.container_root.symlink_to(self.work_dir / "container")
+        (self.work_dir / REMOTE_HOST).symlink_to(self.remote_root / "build")
+        for directory in (self.container_root / "tmp", self.project_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self.env = dict(os.environ)
+        self.env.update({
+            "PATH": f"{self.bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+            "PYTHONPATH": str(REPO_ROOT),
+            "HOME": str(root / "home"),
+            "SSH_AUTH_SOCK": str(root / "agent.sock"),
+            "DOCKERDO_SESSION_DIR": str(self.session_dir),
+            "DOCKERDO_BENCH_ROOT": str(root),
+            "DOCKERDO_BENCH_LATENCY": str(latency),
+            "DOCKERDO_BENCH_BANDWIDTH": str(bandwidth),
+            "DOCKERDO_BENCH_IMAGE_MB": str(image_mb),
+            "DOCKERDO_BENCH_BOOT": str(boot),
+        })
+        self.env.pop("DOCKERDO_TRACE", None)
+        self.session = Session(
+            name="bench",
+            container_name="bench_container",
+            remote_host=REMOTE_HOST,
+            distro="ubuntu",
+            base_image="ubuntu:latest",
+            image_tag="dockerdo-ubuntu:latest-bench",
+            session_dir=self.session_dir,
+            ssh_port_on_remote_host=2222,
+            remote_host_build_dir=Path("build"),
+            local_work_dir=self.work_dir,
+            remote_delay=0.0,
+        )
+        self.session.save()
+
+    def set_container_state(self, running: bool) -> None:
+        """Set the state of the fake container, bypassing dockerdo run. Other containers, e.g. pooled ones, are kept."""
+        state_path = self.root / "containers.json"
+        state = json.loads(state_path.read_text()) if state_path.exists() else {}
+        state.pop(self.session.container_name, None)
+        if running:
+            state[self.session.container_name] = "running"
+        with open(state_path, "w") as fout:
+            json.dump(state, fout)
+        session = Session.load(self.session_dir)
+        session.container_state = "running" if running else "nothing"
+        session.save()
+        invalidate_cached_state(self.session_dir)
+
+    def verify_exec(self) -> None:
+        """
+        Fail unless dodo reaches the fake container. If the current directory does not resolve to a path inside
+        the container mount point, dodo refuses to run, and the exec benchmarks would not measure the exec path.
+        """
+        marker = self.project_dir / ".bench-exec"
+        self.run_cli(["exec", "touch", marker.name], cwd=self.work_dir / "container" / "opt" / "project")
+        if not marker.exists():
+            raise RuntimeError(f"dodo did not reach the container, see {self.root / 'stderr.log'}")
+        marker.unlink()
+
+    def run_cli(self, args: List[str], cwd: Optional[Path] = None, until: Optional[Path] = None) -> Dict[str, Any]:
+        """
+        Run the dockerdo CLI once, returning wall time, exit status and peak memory.
+        For commands that keep running, the wall time is measured until the path given in until exists,
+        and the session supervisor is then shut down through its control socket.
+        """
+        with open(os.devnull, "rb") as stdin, open(os.devnull, "wb") as stdout:
+            with open(self.root / "stderr.log", "ab") as stderr:
+                start = time.perf_counter()
+                process = Popen(
+                    [sys.executable, "-c", CLI, *args],
+                    cwd=cwd if cwd is not None else self.work_dir,
+                    env=self.env,
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                )
+                # Popen.poll() would reap the process without its resource usage
+                reaped = None
+                if until is not None:
+                    while not until.exists() and reaped is None:
+                        reaped = wait_nohang(process)
+                        time.sleep(0.01)
+                    wall_time = time.perf_counter() - start
+                    session = Session.load(self.session_dir)
+                    while reaped is None and send_supervisor_request(session, "shutdown") is None:
+                        reaped = wait_nohang(process)
+                        time.sleep(0.01)
+                if reaped is None:
+                    reaped = os.wait4(process.pid, 0)
+                _, status, rusage = reaped
+                if until is None:
+                    wall_time = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise RuntimeError(f"dockerdo {' '.join(args)} failed, see {self.root / 'stderr.log'}")
+        # ru_maxrss is in kilobytes on Linux
+        return {"wall_time": wall_time, "max_rss_mb": rusage.ru_maxrss / 1024}
+
+
+def summarize(name: str, runs: List[Dict[str, Any]], transferred_bytes: int = 0) -> Dict[str, Any]:
+    wall_times = sorted(run["wall_time"] for run in runs)
+    median = statistics.median(wall_times)
+    return {
+        "name": name,
+        "n": len(runs),
+        "median_s": median,
+        "p90_s": wall_times[min(len(wall_times) - 1, int(0.9 * len(wall_times)))],
+        "throughput_mb_s": (transferred_bytes / median / 1e6) if transferred_bytes else None,
+        "max_rss_mb": max(run["max_rss_mb"] for run in runs),
+    }
+
+
+def bench_exec(ws: Workspace, repeat: int) -> Dict[str, Any]:
+    ws.verify_exec()
+    runs = [ws.run_cli(["exec", "true"], cwd=ws.work_dir / "container" / "opt" / "project") for _ in range(repeat)]
+    return summarize("exec true", runs)
+
+
+def bench_exec_output(ws: Workspace, repeat: int, size_mb: int) -> Dict[str, Any]:
+    ws.verify_exec()
+    data_file = ws.project_dir / "data.bin"
+    with open(data_file, "wb") as fout:
+        fout.write(bytes(size_mb << 20))
+    cwd = ws.work_dir / "container" / "opt" / "project"
+    runs = [ws.run_cli(["exec", "cat", "data.bin"], cwd=cwd) for _ in range(repeat)]
+    data_file.unlink()
+    return summarize(f"exec cat {size_mb} MB", runs, transferred_bytes=size_mb << 20)
+
+
+def bench_exec_batch(ws: Workspace, repeat: int, batch_size: int) -> Dict[str, Any]:
+    """A batch of commands over one connection, to compare with batch_size times exec"""
+    ws.verify_exec()
+    batch_file = ws.root / "batch.txt"
+    batch_file.write_text("cd /opt/project\n" + "true\n" * batch_size)
+    cwd = ws.work_dir / "container" / "opt" / "project"
+    runs = [ws.run_cli(["exec", "--batch", str(batch_file)], cwd=cwd) for _ in range(repeat)]
+    return summarize(f"exec --batch {batch_size} x true", runs)
+
+
+def bench_export_files(ws: Workspace, repeat: int, file_count: int) -> Dict[str, Any]:
+    """Recorded modified files streamed out of the container as one tar"""
+    session = Session.load(ws.session_dir)
+    config_dir = ws.container_root / "etc" / "bench"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(file_count):
+        (config_dir / f"file{i}.conf").write_bytes(bytes(4096))
+        session.record_modified_file(Path("/etc/bench") / f"file{i}.conf")
+    session.history_store.close()
+    runs = []
+    for _ in range(repeat):
+        runs.append(ws.run_cli(["export-files", "-o", str(ws.root / "context")]))
+        shutil.rmtree(ws.root / "context")
+    shutil.rmtree(config_dir)
+    return summarize(f"export-files {file_count} files", runs, transferred_bytes=file_count * 4096)
+
+
+def bench_cp(ws: Workspace, repeat: int, size_mb: int, jobs: int) -> Dict[str, Any]:
+    """A directory of files copied into the container as tar streams"""
+    source = ws.root / "dataset"
+    source.mkdir(exist_ok=True)
+    file_count = 64
+    for i in range(file_count):
+        (source / f"part{i}.bin").write_bytes(bytes((size_mb << 20) // file_count))
+    runs = []
+    for _ in range(repeat):
+        runs.append(ws.run_cli(["cp", "-j", str(jobs), str(source), "container:/opt/incoming"]))
+        shutil.rmtree(ws.container_root / "opt" / "incoming")
+    shutil.rmtree(source)
+    return summarize(f"cp {size_mb} MB -j {jobs}", runs, transferred_bytes=size_mb << 20)
+
+
+def bench_status(ws: Workspace, repeat: int) -> Dict[str, Any]:
+    runs = [ws.run_cli(["status"]) for _ in range(repeat)]
+    return summarize("status", runs)
+
+
+def bench_run(ws: Workspace, repeat: int) -> Dict[str, Any]:
+    """Time until the ssh master connection to the container is up. The session supervisor is then shut down."""
+    runs = []
+    for _ in range(repeat):
+        ws.set_container_state(running=False)
+        # Left behind by the fake ssh master of the previous run
+        (ws.session_dir / "ssh-socket-container").unlink(missing_ok=True)
+        runs.append(ws.run_cli(["run"], until=ws.session_dir / "ssh-socket-container"))
+    return summarize("run", runs)
+
+
+def bench_run_pooled(ws: Workspace, repeat: int) -> Dict[str, Any]:
+    """Like run, but claiming a container started in advance by dockerdo pool fill"""
+    config_path = ws.root / "home" / ".config" / "dockerdo" / "dockerdo.yaml"
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    config_path.write_text("pool_size: 1\n")
+    runs = []
+    for _ in range(repeat):
+        ws.set_container_state(running=False)
+        ws.run_cli(["pool", "fill"])
+        (ws.session_dir / "ssh-socket-container").unlink(missing_ok=True)
+        runs.append(ws.run_cli(["run"], until=ws.session_dir / "ssh-socket-container"))
+    config_path.unlink()
+    return summarize("run (pooled)", runs)
+
+
+def bench_push(ws: Workspace, repeat: int, image_mb: int) -> Dict[str, Any]:
+    runs = [ws.run_cli(["push"]) for _ in range(repeat)]
+    return summarize(f"push {image_mb} MB", runs, transferred_bytes=image_mb << 20)
+
+
+def bench_record_scan(ws: Workspace, repeat: int, tree_dirs: int) -> Dict[str, Any]:
+    """Initial directory scan of --record, measured in-process"""
+    from dockerdo.inotify import InotifyListener
+
+    for i in range(tree_dirs):
+        (ws.container_root / "usr" / "share" / f"pkg{i % 50}" / f"dir{i}").mkdir(parents=True, exist_ok=True)
+    session = Session.load(ws.session_dir)
+    runs = []
+    for _ in range(repeat):
+        listener = InotifyListener(session)
+        tracemalloc.start()
+        start = time.perf_counter()
+        listener.register_listeners()
+        wall_time = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert listener.inotify is not None
+        listener.inotify.close()
+        runs.append({"wall_time": wall_time, "max_rss_mb": peak / (1 << 20)})
+    result = summarize(f"record scan {tree_dirs} dirs", runs)
+    result["watches"] = len(listener.watch_descriptors)
+    return result
+
+
+def bench_prefetch(ws: Workspace, repeat: int, tree_dirs: int) -> Dict[str, Any]:
+    """Metadata prefetch of a project tree through the container mount, measured in-process"""
+    from dockerdo.prefetch import prefetch_tree
+
+    project = ws.container_root / "opt" / "project"
+    for i in range(tree_dirs):
+        directory = project / f"pkg{i % 50}" / f"dir{i}"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "module.py").touch()
+    session = Session.load(ws.session_dir)
+    runs = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        stats = prefetch_tree(session.sshfs_container_mount_point, [Path("/opt/project")], max_entries=1 << 20)
+        wall_time = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        runs.append({"wall_time": wall_time, "max_rss_mb": peak / (1 << 20)})
+    result = summarize(f"prefetch {tree_dirs} dirs", runs)
+    result["entries"] = stats.entries
+    return result
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    header = f"{'benchmark':<28} {'n':>3} {'median s':>9} {'p90 s':>9} {'MB/s':>9} {'max MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        throughput = result["throughput_mb_s"]
+        print(
+            f"{result['name']:<28} {result['n']:>3} {result['median_s']:>9.3f} {result['p90_s']:>9.3f}"
+            f" {throughput if throughput is not None else float('nan'):>9.1f} {result['max_rss_mb']:>8.1f}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per network round trip")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Network bytes per second, 0 for unlimited")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions of the fast benchmarks")
+    parser.add_argument("--repeat-slow", type=int, default=1, help="Repetitions of run and push")
+    parser.add_argument("--boot", type=float, default=0.5, help="Seconds to boot a container in docker run")
+    parser.add_argument("--image-mb", type=int, default=16, help="Image size for push")
+    parser.add_argument("--output-mb", type=int, default=16, help="Output size for exec throughput")
+    parser.add_argument("--batch-size", type=int, default=20, help="Commands in the batch for exec --batch")
+    parser.add_argument("--export-files", type=int, default=2000, help="Modified files for export-files")
+    parser.add_argument("--cp-mb", type=int, default=64, help="Size of the directory copied by cp")
+    parser.add_argument("--tree-dirs", type=int, default=2000, help="Directories in the tree scanned by --record")
+    parser.add_argument("--only", type=str, action="append", help="Run only benchmarks with these names")
+    parser.add_argument("--json", type=Path, default=None, help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory")
+    opts = parser.parse_args()
+
+    benchmarks: Dict[str, Callable[[Workspace], Dict[str, Any]]] = {
+        "exec": lambda ws: bench_exec(ws, opts.repeat),
+        "exec-output": lambda ws: bench_exec_output(ws, opts.repeat, opts.output_mb),
+        "exec-batch": lambda ws: bench_exec_batch(ws, opts.repeat, opts.batch_size),
+        "export-files": lambda ws: bench_export_files(ws, opts.repeat, opts.export_files),
+        "cp": lambda ws: bench_cp(ws, opts.repeat, opts.cp_mb, jobs=1),
+        "cp-parallel": lambda ws: bench_cp(ws, opts.repeat, opts.cp_mb, jobs=4),
+        "status": lambda ws: bench_status(ws, opts.repeat),
+        "run": lambda ws: bench_run(ws, opts.repeat_slow),
+        "run-pooled": lambda ws: bench_run_pooled(ws, opts.repeat_slow),
+        "push": lambda ws: bench_push(ws, opts.repeat_slow, opts.image_mb),
+        "record": lambda ws: bench_record_scan(ws, opts.repeat, opts.tree_dirs),
+        "prefetch": lambda ws: bench_prefetch(ws, opts.repeat, opts.tree_dirs),
+    }
+    selected = opts.only if opts.only else list(benchmarks)
+    root = Path(tempfile.mkdtemp(prefix="dockerdo_bench_"))
+    results = []
+    try:
+        ws = Workspace(root, latency=opts.latency, bandwidth=opts.bandwidth, image_mb=opts.image_mb, boot=opts.boot)
+        ws.set_container_state(running=True)
+        for name in selected:
+            results.append(benchmarks[name](ws))
+    finally:
+        if opts.keep:
+            print(f"Kept {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    print_table(results)
+    if opts.json is not None:
+        with open(opts.json, "w") as fout:
+            json.dump({"options": {k: str(v) for k, v in vars(opts).items()}, "results": results}, fout, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""Run a batch of commands in the container as one script, over a single connection"""
+
+import os
+import re
+import shlex
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, List, NamedTuple, Optional
+
+from dockerdo.history import ExecStats
+
+# The script reports the end of each command on stderr, after the output of the command
+BATCH_MARKER = b"\x1edockerdo-batch"
+# The times are not numbers if date in the container does not support %N
+RE_BATCH_MARKER = re.compile(rb"\x1edockerdo-batch (\d+) (\d+) (\S*) (\S*)\n")
+MAX_BATCH_MARKER_LEN = 96
+
+# Runs one command in a subshell, so that commands do not affect each other, like separate dodo invocations.
+# Stdin is not used: with --batch -, it is the batch itself.
+BATCH_FUNCTION = """\
+__dockerdo_failed=0
+__dockerdo_run() {
+    __dockerdo_index=$1
+    __dockerdo_dir=$2
+    shift 2
+    __dockerdo_start=$(date +%s%N)
+    (cd "$__dockerdo_dir" && "$@") < /dev/null
+    __dockerdo_status=$?
+    printf '\\036dockerdo-batch %s %s %s %s\\n' \
+        "$__dockerdo_index" "$__dockerdo_status" "$__dockerdo_start" "$(date +%s%N)" >&2
+    if [ "$__dockerdo_status" -ne 0 ] && [ "$__dockerdo_failed" -eq 0 ]; then
+        __dockerdo_failed=$__dockerdo_status
+    fi
+    return $__dockerdo_status
+}
+"""
+
+
+class BatchError(Exception):
+    pass
+
+
+class BatchCommand(NamedTuple):
+    """A command of the batch, quoted for the shell, and the working directory in the container it runs in"""
+
+    command: str
+    work_dir: Path
+    line_number: int
+
+
+class BatchResult(NamedTuple):
+    command: BatchCommand
+    exit_code: int
+    stats: ExecStats
+
+
+def parse_batch(text: str, work_dir: Path) -> List[BatchCommand]:
+    """
+    Parse a batch: one command per line, quoted like the arguments of dodo.
+    Empty lines and comment lines are skipped, and a trailing backslash continues the line.
+    A ``cd DIR`` line changes the working directory of the following commands, relative to the previous one.
+    """
+    commands = []
+    lines = text.splitlines()
+    line_index = 0
+    while line_index < len(lines):
+        line_number = line_index + 1
+        line = lines[line_index]
+        while line.endswith("\\") and line_index + 1 < len(lines):
+            line_index += 1
+            line = line[:-1] + lines[line_index]
+        line_index += 1
+        if line.lstrip().startswith("#"):
+            continue
+        try:
+            tokens = shlex.split(line)
+        except ValueError as e:
+            raise BatchError(f"Line {line_number}: {e}")
+        if len(tokens) == 0:
+            continue
+        if tokens[0] == "cd":
+            if len(tokens) != 2:
+                raise BatchError(f"Line {line_number}: cd takes exactly one directory")
+            work_dir = Path(os.path.normpath(work_dir / tokens[1]))
+            continue
+        commands.append(BatchCommand(command=shlex.join(tokens), work_dir=work_dir, line_number=line_number))
+    return commands
+
+
+def format_batch_script(commands: List[BatchCommand], env: Dict[str, str], keep_going: bool) -> str:
+    """
+    Format the shell script that runs the batch in the container.
+    The session environment is exported by the script itself, instead of writing the env file.
+    Unless keep_going is True, the script exits after the first failing command.
+    Either way, the exit status of the script is that of the first failing command.
+    """
+    lines = [f"export {key}={value}" for key, value in env.items()]
+    lines.append(BATCH_FUNCTION)
+    on_error = "" if keep_going else " || exit $?"
+    for index, command in enumerate(commands):
+        work_dir = shlex.quote(str(command.work_dir))
+        lines.append(f"__dockerdo_run {index} {work_dir} {command.command}{on_error}")
+    lines.append("exit $__dockerdo_failed")
+    return "\n".join(lines) + "\n"
+
+
+class BatchMarkerFilter:
+    """
+    Write the stderr of the batch through to the destination, removing the markers and reporting them.
+    A possible marker is held back until it is complete.
+    """
+
+    def __init__(self, destination: BinaryIO, on_marker: Callable[[int, int, Optional[float]], None]) -> None:
+        self.destination = destination
+        self.on_marker = on_marker
+        self.byte_count = 0
+        self._pending = b""
+
+    def _write_through(self, data: bytes) -> None:
+        if len(data) > 0:
+            self.byte_count += len(data)
+            self.destination.write(data)
+
+    def _could_be_marker(self, data: bytes) -> bool:
+        if b"\n" in data or len(data) >= MAX_BATCH_MARKER_LEN:
+            return False
+        prefix = data[:len(BATCH_MARKER)]
+        return BATCH_MARKER.startswith(prefix)
+
+    def write(self, data: bytes) -> None:
+        pending = self._pending + data
+        while True:
+            marker_index = pending.find(BATCH_MARKER[:1])
+            if marker_index == -1:
+                self._write_through(pending)
+                pending = b""
+                break
+            self._write_through(pending[:marker_index])
+            pending = pending[marker_index:]
+            match = RE_BATCH_MARKER.match(pending)
+            if match is not None:
+                index, status = int(match.group(1)), int(match.group(2))
+                start_ns, end_ns = match.group(3), match.group(4)
+                remote_time = (int(end_ns) - int(start_ns)) / 1e9 if start_ns.isdigit() and end_ns.isdigit() else None
+                self.on_marker(index, status, remote_time)
+                pending = pending[match.end():]
+            elif self._could_be_marker(pending):
+                break
+            else:
+                self._write_through(pending[:1])
+                pending = pending[1:]
+        self._pending = pending
+
+    def flush(self) -> None:
+        self.destination.flush()
+
+    def close(self) -> None:
+        """Write out anything held back at the end of the output"""
+        self._write_through(self._pending)
+        self._pending = b""
+        self.destination.flush()
+
+
+class BatchOutput:
+    """Write the stdout of the batch through to the destination, counting the bytes"""
+
+    def __init__(self, destination: BinaryIO) -> None:
+        self.destination = destination
+        self.byte_count = 0
+
+    def write(self, data: bytes) -> None:
+        self.byte_count += len(data)
+        self.destination.write(data)
+
+    def flush(self) -> None:
+        self.destination.flush()
+
+
+class BatchRun:
+    """
+    Collects the results of the commands of a batch, as their markers arrive.
+    The output received since the previous marker is attributed to the command.
+    The time to start and connect is attributed to the first command, like for a single dodo.
+    on_result is called as each command finishes, e.g. to show progress.
+    """
+
+    def __init__(
+        self,
+        commands: List[BatchCommand],
+        stdout: BinaryIO,
+        stderr: BinaryIO,
+        local_time: float = 0.0,
+        on_result: Optional[Callable[[BatchResult], None]] = None,
+    ) -> None:
+        self.commands = commands
+        self.on_result = on_result
+        self.stdout = BatchOutput(stdout)
+        self.stderr = BatchMarkerFilter(stderr, self.on_marker)
+        self.results: List[BatchResult] = []
+        self._local_time = local_time
+        self._last_time = time.time()
+        self._last_stdout_bytes = 0
+        self._last_stderr_bytes = 0
+
+    def on_marker(self, index: int, status: int, remote_time: Optional[float]) -> None:
+        if index >= len(self.commands):
+            return
+        now = time.time()
+        elapsed = now - self._last_time
+        stats = ExecStats(
+            wall_time=self._local_time + elapsed,
+            local_time=self._local_time,
+            remote_time=remote_time,
+            ssh_time=max(0.0, elapsed - remote_time) if remote_time is not None else None,
+            stdout_bytes=self.stdout.byte_count - self._last_stdout_bytes,
+            stderr_bytes=self.stderr.byte_count - self._last_stderr_bytes,
+        )
+        result = BatchResult(command=self.commands[index], exit_code=status, stats=stats)
+        self.results.append(result)
+        if self.on_result is not None:
+            self.on_result(result)
+        self._local_time = 0.0
+        self._last_time = now
+        self._last_stdout_bytes = self.stdout.byte_count
+        self._last_stderr_bytes = self.stderr.byte_count
@@ -0,0 +1,141 @@
+"""Find what to clean up across all sessions: stale sessions, and the images and tarballs they left behind"""
+
+import re
+from datetime import datetime
+from pathlib import Path
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Set, Tuple
+
+from dockerdo.remote_helper import HostStatus
+from dockerdo.session_index import IndexedSession
+from dockerdo.utils import snapshot_base_image
+
+IMAGE_PREFIX = "dockerdo-"
+TARBALL_SUFFIX = ".tar.gz"
+# A tarball modified more recently may belong to a push that is still running
+TARBALL_MIN_AGE = 3600.0
+RE_DOCKER_SIZE = re.compile(r"^([0-9.]+)\s*([kKMGT]?B)$")
+# The docker cli uses decimal units
+DOCKER_SIZE_UNITS = {"B": 1, "kB": 1000, "KB": 1000, "MB": 1000**2, "GB": 1000**3, "TB": 1000**4}
+
+
+def parse_docker_size(size: str) -> int:
+    """Parse a size printed by the docker cli, e.g. "77.9MB". Returns 0 if the size can not be parsed."""
+    match = RE_DOCKER_SIZE.match(size.strip())
+    if match is None:
+        return 0
+    value, unit = match.groups()
+    return int(float(value) * DOCKER_SIZE_UNITS[unit])
+
+
+def parse_docker_timestamp(created_at: str) -> Optional[float]:
+    """Parse a timestamp printed by the docker cli, e.g. "2025-03-26 22:31:01 +0200 EET" """
+    try:
+        return datetime.strptime(" ".join(created_at.split()[:3]), "%Y-%m-%d %H:%M:%S %z").timestamp()
+    except ValueError:
+        return None
+
+
+def image_reference(entry: Dict) -> str:
+    return f"{entry.get('Repository')}:{entry.get('Tag')}"
+
+
+def is_dockerdo_image(reference: str) -> bool:
+    # The registry, if any, is part of the repository
+    return reference.rsplit("/", 1)[-1].startswith(IMAGE_PREFIX)
+
+
+class CleanupPlan(BaseModel):
+    """
+    What to remove from a directory on a host: the build directory of the sessions on a remote host,
+    or the local host. Only the first plan of each host removes orphaned images.
+    """
+
+    host: str
+    build_dir: Optional[Path] = None
+    sessions: List[IndexedSession] = Field(default_factory=list)
+    containers: List[str] = Field(default_factory=list)
+    images: List[str] = Field(default_factory=list)
+    tarballs: List[str] = Field(default_factory=list)
+    reclaimable_bytes: int = 0
+
+    def is_empty(self) -> bool:
+        return not (self.sessions or self.containers or self.images or self.tarballs)
+
+
+PlanKey = Tuple[str, Optional[Path]]
+
+
+def is_stale(entry: IndexedSession, container: Optional[Dict], now: float, max_idle: float) -> bool:
+    """A session is stale if its container is not running, and it has not been used for max_idle seconds"""
+    if container is not None and container.get("State") == "running":
+        return False
+    return now - entry.last_active() >= max_idle
+
+
+def plan_cleanup(
+    sessions: Dict[PlanKey, List[IndexedSession]],
+    host_statuses: Dict[PlanKey, Optional[HostStatus]],
+    now: float,
+    max_idle: float,
+    remove_all: bool = False,
+) -> Tuple[List[CleanupPlan], List[str]]:
+    """
+    Plan the cleanup of the sessions, grouped by host and build directory, using the answers of the helper script.
+    With remove_all, every session is removed, including running ones.
+    Hosts that could not be checked are left alone. Returns the plans, and the hosts that were skipped.
+    """
+    plans: List[CleanupPlan] = []
+    skipped: List[str] = []
+    removed_names: Set[str] = set()
+    removed_images: Set[str] = set()
+    kept_images: Set[str] = set()
+    for (host, build_dir), entries in sessions.items():
+        host_status = host_statuses.get((host, build_dir))
+        if host_status is None or host_status.containers is None:
+            if host not in skipped:
+                skipped.append(host)
+            kept_images.update(snapshot_base_image(entry.image_tag) for entry in entries if entry.image_tag is not None)
+            continue
+        plan = CleanupPlan(host=host, build_dir=build_dir)
+        for entry in entries:
+            container = host_status.find_container(entry.container_name)
+            if remove_all or is_stale(entry, container, now, max_idle):
+                plan.sessions.append(entry)
+                removed_names.add(entry.name)
+                if entry.image_tag is not None:
+                    removed_images.add(snapshot_base_image(entry.image_tag))
+                if container is not None:
+                    plan.containers.append(entry.container_name)
+            elif entry.image_tag is not None:
+                kept_images.add(snapshot_base_image(entry.image_tag))
+        plans.append(plan)
+
+    all_names = {entry.name for entries in sessions.values() for entry in entries}
+    planned_hosts: Set[str] = set()
+    for plan in plans:
+        host_status = host_statuses[(plan.host, plan.build_dir)]
+        assert host_status is not None
+        if plan.host not in planned_hosts:
+            planned_hosts.add(plan.host)
+            for image in host_status.images or []:
+                reference = image_reference(image)
+                # Snapshots belong to the session of the image they were committed on top of
+                base_reference = snapshot_base_image(reference)
+                if not is_dockerdo_image(reference) or base_reference in kept_images:
+                    continue
+                created_at = parse_docker_timestamp(str(image.get("CreatedAt", "")))
+                # An orphaned image may belong to a session on another machine that uses the same host,
+                # so it is only removed once it is old enough
+                if base_reference in removed_images or (created_at is not None and now - created_at >= max_idle):
+                    plan.images.append(reference)
+                    plan.reclaimable_bytes += parse_docker_size(str(image.get("Size", "")))
+        for tarball in host_status.tarballs or []:
+            # Leftovers of pushes by known sessions. Other tarballs in the build directory are not ours.
+            if not tarball.name.endswith(TARBALL_SUFFIX) or tarball.name[:-len(TARBALL_SUFFIX)] not in all_names:
+                continue
+            if now - tarball.mtime < TARBALL_MIN_AGE:
+                continue
+            plan.tarballs.append(tarball.name)
+            plan.reclaimable_bytes += tarball.size
+    return [plan for plan in plans if not plan.is_empty()], skipped
@@ -1,15 +1,24 @@
 """User configuration and session data"""
 
 import yaml
-import json
 from pathlib import Path
 from pydantic import BaseModel as PydanticBaseModel
-from pydantic import Field, ConfigDict
+from pydantic import Field, ConfigDict, PrivateAttr
 from tempfile import mkdtemp
-from typing import Optional, Literal, Dict, List
+from typing import Optional, Literal, Dict, List, Iterator, Any
 
-from dockerdo.utils import ephemeral_container_name
-from dockerdo import prettyprint
+from dockerdo.history import HistoryStore, ExecStats
+from dockerdo.utils import ephemeral_container_name, make_snapshot_tag
+from dockerdo import prettyprint, trace
+
+# Detect a dead network within 15 seconds, instead of waiting for the TCP timeout
+SSH_KEEPALIVE_OPTIONS = "-o ServerAliveInterval=5 -o ServerAliveCountMax=3"
+SSHFS_RECONNECT_OPTIONS = f"-o reconnect {SSH_KEEPALIVE_OPTIONS}"
+DEFAULT_RECORD_INCLUDE_PATHS = [Path("/")]
+DEFAULT_RECORD_EXCLUDE_GLOBS = ["/proc", "/dev", "/sys"]
+# The defaults of sshfs: seconds until a cached entry expires, and the number of cached entries
+SSHFS_CACHE_TIMEOUT = 20
+SSHFS_CACHE_MAX_SIZE = 10000
 
 
 class BaseModel(PydanticBaseModel):
@@ -33,7 +42,19 @@ class UserConfig(BaseModel):
     default_docker_run_args: str = ""
     default_remote_delay: float = 0.3
     always_record_inotify: bool = False
+    always_exec_server: bool = False
     always_interactive: bool = False
+    container_state_ttl: float = 10.0
+    docker_transport: Literal["cli", "api"] = "cli"
+    ssh_port_range_start: int = 2222
+    ssh_port_range_size: int = 1000
+    stale_after_days: float = 7.0
+    pool_size: int = 0
+    record_include_paths: List[Path] = Field(default_factory=lambda: list(DEFAULT_RECORD_INCLUDE_PATHS))
+    record_exclude_globs: List[str] = Field(default_factory=lambda: list(DEFAULT_RECORD_EXCLUDE_GLOBS))
+    prefetch_paths: List[Path] = Field(default_factory=list)
+    sshfs_cache_timeout: int = SSHFS_CACHE_TIMEOUT
+    sshfs_cache_max_size: int = SSHFS_CACHE_MAX_SIZE
     ssh_key_path: Path = Path("~/.ssh/id_rsa.pub").expanduser()
 
     @classmethod
@@ -42,6 +63,17 @@ class UserConfig(BaseModel):
         return cls(**yaml.safe_load(yaml_str))
 
 
+class Snapshot(BaseModel):
+    """A committed state of the session container"""
+
+    name: str
+    image_tag: str
+    # The image the container was created from: the image of the session, or an earlier snapshot
+    parent: str
+    created_at: float
+    message: Optional[str] = None
+
+
 class Session(BaseModel):
     """A dockerdo session"""
 
@@ -55,15 +87,26 @@ class Session(BaseModel):
     container_username: str = "root"
     docker_registry: Optional[str] = None
     record_inotify: bool = False
+    exec_server: bool = False
+    record_include_paths: List[Path] = Field(default_factory=lambda: list(DEFAULT_RECORD_INCLUDE_PATHS))
+    record_exclude_globs: List[str] = Field(default_factory=lambda: list(DEFAULT_RECORD_EXCLUDE_GLOBS))
+    prefetch_paths: List[Path] = Field(default_factory=list)
+    sshfs_cache_timeout: int = SSHFS_CACHE_TIMEOUT
+    sshfs_cache_max_size: int = SSHFS_CACHE_MAX_SIZE
     session_dir: Path
     ssh_port_on_remote_host: Optional[int] = None
     remote_host_build_dir: Path
     local_work_dir: Path
     docker_run_args: Optional[str] = None
     remote_delay: float = 0.0
+    snapshots: List[Snapshot] = Field(default_factory=list)
+    # The snapshot the container was created from, or None for the image of the session
+    snapshot: Optional[str] = None
 
     container_state: Literal["nothing", "running", "stopped"] = "nothing"
 
+    _history_store: Optional[HistoryStore] = PrivateAttr(default=None)
+
     @classmethod
     def from_opts(
         cls,
@@ -142,6 +185,11 @@ class Session(BaseModel):
             container_username=container_username,
             docker_registry=registry,
             record_inotify=record_inotify,
+            record_include_paths=list(user_config.record_include_paths),
+            record_exclude_globs=list(user_config.record_exclude_globs),
+            prefetch_paths=list(user_config.prefetch_paths),
+            sshfs_cache_timeout=user_config.sshfs_cache_timeout,
+            sshfs_cache_max_size=user_config.sshfs_cache_max_size,
             session_dir=session_dir,
             remote_host_build_dir=remote_host_build_dir,
             local_work_dir=local_work_dir,
@@ -156,31 +204,46 @@ class Session(BaseModel):
         else:
             return Path(f"/home/{self.container_username}")
 
-    def record_command(self, command: str, path: Path) -> None:
+    def find_snapshot(self, name: str) -> Optional[Snapshot]:
+        for snapshot in self.snapshots:
+            if snapshot.name == name:
+                return snapshot
+        return None
+
+    def snapshot_tag(self, name: str) -> str:
+        assert self.image_tag is not None
+        return make_snapshot_tag(self.image_tag, name)
+
+    @property
+    def container_image(self) -> Optional[str]:
+        """The image to create the container from: the restored snapshot, if any, otherwise the image of the session"""
+        if self.snapshot is not None:
+            snapshot = self.find_snapshot(self.snapshot)
+            if snapshot is not None:
+                return snapshot.image_tag
+        return self.image_tag
+
+    @property
+    def history_store(self) -> HistoryStore:
+        """The indexed store for the command history and modified files"""
+        if self._history_store is None:
+            self._history_store = HistoryStore(self.session_dir)
+        return self._history_store
+
+    def record_command(
+        self, command: str, path: Path, exit_code: int = 0, stats: Optional[ExecStats] = None
+    ) -> None:
         """
-        Record a command in the session history.
-        The command history is appended to a file in the session directory.
+        Record a command in the session history, together with its exit code and timing.
+        The command history is stored in a database in the session directory.
         """
-        history_file = self.session_dir / "command_history.jsonl"
-        with open(history_file, "a") as f:
-            json.dump({"cwd": str(path), "command": command}, f)
-            f.write("\n")
+        self.history_store.record_command(command, path, exit_code=exit_code, stats=stats)
 
     def record_modified_file(self, file: Path) -> bool:
         """Record a file write in the session history"""
         if file == self.env_file_path:
             return False
-        modified_files_path = self.session_dir / "modified_files"
-        if modified_files_path.exists():
-            with open(modified_files_path, "r") as f:
-                modified_files = {Path(line.strip()) for line in f}
-        else:
-            modified_files = set()
-        if file in modified_files:
-            return False
-        with open(modified_files_path, "a") as fout:
-            fout.write(f"{file}\n")
-        return True
+        return self.history_store.record_modified_file(file)
 
     def _update_env(self, key: str, value: str) -> None:
         if len(value.strip()) == 0:
@@ -233,6 +296,16 @@ class Session(BaseModel):
         """Get the path on the local host where the container filesystem is mounted"""
         return self.local_work_dir / "container"
 
+    @property
+    def sshfs_cache_options(self) -> str:
+        """Options for the caches of the sshfs mount of the container, where they differ from the defaults of sshfs"""
+        options = []
+        if self.sshfs_cache_timeout != SSHFS_CACHE_TIMEOUT:
+            options.append(f"-o cache_timeout={self.sshfs_cache_timeout}")
+        if self.sshfs_cache_max_size != SSHFS_CACHE_MAX_SIZE:
+            options.append(f"-o cache_max_size={self.sshfs_cache_max_size}")
+        return " ".join(options)
+
     def format_activate_script(self) -> str:
         """Generate the activate script"""
         result = []
@@ -250,9 +323,14 @@ class Session(BaseModel):
         )
 
         if self.remote_host is not None:
-            # Create a socket for ssh master connection to the remote host (unless it already exists)
-            result.append(f"if [ ! -e {self.session_dir}/ssh-socket-remote ]; then\n")
-            result.append(f"  ssh -M -N -S {self.session_dir}/ssh-socket-remote {self.remote_host} &\n")
+            # Create a socket for ssh master connection to the remote host (unless a live one already exists)
+            result.append(
+                f"if ! ssh -S {self.session_dir}/ssh-socket-remote -O check {self.remote_host} 2> /dev/null; then\n"
+            )
+            result.append(f"  rm -f {self.session_dir}/ssh-socket-remote\n")
+            result.append(
+                f"  ssh -M -N -S {self.session_dir}/ssh-socket-remote {SSH_KEEPALIVE_OPTIONS} {self.remote_host} &\n"
+            )
             result.append("fi\n")
 
             # Unless the remote host build directory is already mounted
@@ -265,7 +343,8 @@ class Session(BaseModel):
             # Mount remote host build directory
             result.append(f"  mkdir -p {self.sshfs_remote_mount_point}\n")
             result.append(
-                f"  sshfs {self.remote_host}:{self.remote_host_build_dir} {self.sshfs_remote_mount_point}\n"
+                f"  sshfs {SSHFS_RECONNECT_OPTIONS}"
+                f" {self.remote_host}:{self.remote_host_build_dir} {self.sshfs_remote_mount_point}\n"
             )
             result.append("fi\n")
 
@@ -281,37 +360,40 @@ class Session(BaseModel):
         activate_script.chmod(0o755)
         return activate_script
 
-    def get_command_history(self) -> List[Dict[str, str]]:
-        """Get the command history"""
-        history_file = self.session_dir / "command_history.jsonl"
-        if not history_file.exists():
-            return []
-        with open(history_file, "r") as f:
-            history = []
-            for line in f:
-                try:
-                    history.append(json.loads(line))
-                except json.JSONDecodeError:
-                    pass
-            return history
-
-    def get_modified_files(self) -> List[Path]:
-        """Get the list of modified files"""
-        modified_files_path = self.session_dir / "modified_files"
-        if not modified_files_path.exists():
-            return []
-        with open(modified_files_path, "r") as f:
-            modified_files = {Path(line.strip()) for line in f}
-        return list(sorted(modified_files))
+    def get_command_history(
+        self,
+        path_prefix: Optional[Path] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        pattern: Optional[str] = None,
+        successful_only: bool = True,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> Iterator[Dict[str, Any]]:
+        """Get the command history, optionally filtered. By default, failed commands are left out."""
+        return self.history_store.iter_commands(
+            path_prefix=path_prefix,
+            since=since,
+            until=until,
+            pattern=pattern,
+            successful_only=successful_only,
+            limit=limit,
+            offset=offset,
+        )
+
+    def get_modified_files(self, path_prefix: Optional[Path] = None) -> Iterator[Path]:
+        """Get the modified files, in sorted order"""
+        return self.history_store.iter_modified_files(path_prefix=path_prefix)
 
     def write_container_env_file(self, verbose: bool = False) -> None:
         """Write the container env file to a file inside the container"""
         path_on_host = self.sshfs_container_mount_point / self.env_file_path.relative_to(Path('/'))
         if verbose:
             prettyprint.info(f"Writing container env file to {path_on_host}")
-        with open(path_on_host, "w") as f:
-            for key, value in self.env.items():
-                f.write(f"export {key}={value}\n")
+        with trace.span("sshfs write", "sshfs", path=path_on_host):
+            with open(path_on_host, "w") as f:
+                for key, value in self.env.items():
+                    f.write(f"export {key}={value}\n")
 
     @property
     def env_file_path(self) -> Path:
@@ -0,0 +1,108 @@
+"""Cache of the container state, kept up to date by docker events"""
+
+import os
+import time
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Optional, Dict, Any
+
+CACHE_FILE = "container_state.json"
+
+# Docker state after each container event. None means that the container no longer exists.
+# kill is not here: it is sent for any signal, e.g. by docker kill -s HUP, and the container may keep running.
+# A container that does stop sends die.
+EVENT_STATES: Dict[str, Optional[str]] = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+    "destroy": None,
+}
+
+
+class CachedContainerState(BaseModel):
+    """
+    The last known state of the container.
+
+    state is the docker state (e.g. "running" or "exited"), or None if there is no container.
+    If watcher_pid is set, that process is subscribed to docker events and keeps the cache up to date.
+    """
+
+    container_name: str
+    container_id: Optional[str] = None
+    state: Optional[str] = None
+    checked_at: float
+    watcher_pid: Optional[int] = None
+
+
+def process_alive(pid: int) -> bool:
+    """Check if a process with the given pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def load_cached_state(
+    session_dir: Path, container_name: str, max_age: float, now: Optional[float] = None
+) -> Optional[CachedContainerState]:
+    """
+    Load the cached state, if it is still valid.
+    The cache is valid if it is younger than max_age, or if an event watcher is keeping it up to date.
+    """
+    cache_path = session_dir / CACHE_FILE
+    try:
+        with open(cache_path, "r") as fin:
+            cached = CachedContainerState.model_validate_json(fin.read())
+    except (OSError, ValueError):
+        return None
+    if cached.container_name != container_name:
+        return None
+    if cached.watcher_pid is not None and process_alive(cached.watcher_pid):
+        return cached
+    now = now if now is not None else time.time()
+    if now - cached.checked_at <= max_age:
+        return cached
+    return None
+
+
+def save_cached_state(session_dir: Path, cached: CachedContainerState) -> None:
+    """Write the cache atomically, so that concurrent readers never see a partial file"""
+    cache_path = session_dir / CACHE_FILE
+    tmp_path = cache_path.with_name(f"{CACHE_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fout:
+        fout.write(cached.model_dump_json())
+    os.replace(tmp_path, cache_path)
+
+
+def invalidate_cached_state(session_dir: Path) -> None:
+    """Forget the cached state, forcing the next check to ask docker"""
+    cache_path = session_dir / CACHE_FILE
+    if cache_path.exists():
+        cache_path.unlink()
+
+
+def apply_event(cached: CachedContainerState, event: Dict[str, Any], watcher_pid: Optional[int]) -> bool:
+    """
+    Update the cached state according to a docker event.
+    Returns False if the event doesn't affect the state.
+    """
+    if event.get("Type", "container") != "container":
+        return False
+    action = str(event.get("Action", event.get("status", "")))
+    if action not in EVENT_STATES:
+        return False
+    attributes = event.get("Actor", {}).get("Attributes", {})
+    if attributes.get("name", cached.container_name) != cached.container_name:
+        return False
+    cached.state = EVENT_STATES[action]
+    cached.container_id = None if cached.state is None else event.get("id", cached.container_id)
+    cached.checked_at = time.time()
+    cached.watcher_pid = watcher_pid
+    return True
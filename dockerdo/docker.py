@@ -1,6 +1,10 @@
 """Docker related functions"""
 
+import json
+import re
+import shlex
 from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 GENERIC_DOCKERFILE = r"""
 # syntax=docker/dockerfile:1
@@ -51,3 +55,218 @@ def format_dockerfile(
         homedir=homedir,
         **kwargs,
     )
+
+
+# Commands that only inspect the container, left out of a Dockerfile synthesized from the history
+READ_ONLY_COMMANDS = {
+    "cat", "clear", "command", "df", "diff", "du", "echo", "env", "file", "find", "free", "grep", "head", "history",
+    "id", "less", "ls", "man", "more", "nano", "printenv", "ps", "pwd", "stat", "tail", "test", "top", "htop",
+    "tree", "true", "type", "uname", "vi", "vim", "wc", "whereis", "which", "whoami", "apt-cache",
+}
+# Subcommands of package managers that only inspect, or that the merged install layers already run
+READ_ONLY_SUBCOMMANDS = {
+    "apt": {"list", "search", "show", "policy", "update"},
+    "apt-get": {"update", "check", "changelog"},
+    "apk": {"info", "search", "list", "policy", "update"},
+    "dnf": {"list", "info", "search", "repolist", "makecache", "check-update"},
+    "yum": {"list", "info", "search", "repolist", "makecache", "check-update"},
+    "dpkg": {"-l", "-L", "-s", "--list", "--listfiles", "--status"},
+    "pip": {"list", "show", "freeze", "search", "check", "--version"},
+    "pip3": {"list", "show", "freeze", "search", "check", "--version"},
+    "systemctl": {"status", "is-active", "is-enabled", "list-units"},
+}
+# Flags that can be merged into one install layer. The flags that the layer adds itself are dropped.
+INSTALL_FLAGS = {
+    "apt": ({"--no-install-recommends", "--no-install-suggests"}, {"-y", "--yes", "-q", "-qq"}),
+    "apk": ({"--no-progress"}, {"--no-cache", "-U", "--update", "-q", "--quiet"}),
+    "dnf": ({"--nodocs", "--setopt=install_weak_deps=False"}, {"-y", "--assumeyes", "-q", "--quiet"}),
+    "yum": ({"--nodocs"}, {"-y", "--assumeyes", "-q", "--quiet"}),
+    "pip": ({"-U", "--upgrade", "--user", "--pre"}, {"-q", "--quiet", "--no-cache-dir"}),
+}
+# The system package installs are moved to the start, but not past commands that configure the package sources
+RE_PACKAGE_SOURCES = re.compile(
+    r"add-apt-repository|apt-key|sources\.list|/etc/apt/|/etc/apk/|yum\.repos\.d|config-manager"
+)
+COPY_CONTEXT_DIR = "files"
+
+
+class PackageInstall(NamedTuple):
+    """An install of packages, that can be merged with other installs with the same program and flags"""
+
+    manager: str
+    program: Tuple[str, ...]
+    flags: Tuple[str, ...]
+    packages: Tuple[str, ...]
+
+    @property
+    def is_system(self) -> bool:
+        return self.manager != "pip"
+
+
+def strip_sudo(tokens: List[str]) -> List[str]:
+    return tokens[1:] if len(tokens) > 1 and tokens[0] == "sudo" else tokens
+
+
+def is_read_only_command(tokens: List[str]) -> bool:
+    """Commands that do not change the container, like ls or apt search"""
+    tokens = strip_sudo(tokens)
+    if len(tokens) == 0 or tokens[0] in READ_ONLY_COMMANDS:
+        return True
+    subcommands = READ_ONLY_SUBCOMMANDS.get(tokens[0])
+    return subcommands is not None and len(tokens) > 1 and tokens[1] in subcommands
+
+
+def parse_package_install(tokens: List[str]) -> Optional[PackageInstall]:
+    """
+    Recognize an install of packages by apt, apk, dnf, yum or pip. Returns None for anything else,
+    including installs with options that take a value, e.g. pip install -r requirements.txt.
+    """
+    tokens = strip_sudo(tokens)
+    if len(tokens) >= 3 and tokens[0] in ("python", "python3") and tokens[1:3] == ["-m", "pip"]:
+        manager, program, rest = "pip", tuple(tokens[:3]), tokens[3:]
+    elif len(tokens) >= 1 and tokens[0] in ("apt", "apt-get"):
+        manager, program, rest = "apt", ("apt-get",), tokens[1:]
+    elif len(tokens) >= 1 and tokens[0] in ("pip", "pip3"):
+        manager, program, rest = "pip", (tokens[0],), tokens[1:]
+    elif len(tokens) >= 1 and tokens[0] in ("apk", "dnf", "yum"):
+        manager, program, rest = tokens[0], (tokens[0],), tokens[1:]
+    else:
+        return None
+    install_verb = "add" if manager == "apk" else "install"
+    if install_verb not in rest:
+        return None
+    verb_index = rest.index(install_verb)
+    mergeable, dropped = INSTALL_FLAGS[manager]
+    flags = []
+    packages = []
+    for token in rest[:verb_index] + rest[verb_index + 1:]:
+        if token in dropped:
+            continue
+        if token in mergeable:
+            flags.append(token)
+        elif token.startswith("-"):
+            return None
+        elif token not in packages:
+            packages.append(token)
+    if len(packages) == 0:
+        return None
+    return PackageInstall(manager, program, tuple(sorted(set(flags))), tuple(packages))
+
+
+def format_package_install(install: PackageInstall) -> str:
+    """One install layer, cleaning up the package cache in the same layer"""
+    program = " ".join(install.program)
+    flags = "".join(f" {flag}" for flag in install.flags)
+    packages = " ".join(install.packages)
+    if install.manager == "apt":
+        return (
+            f"apt-get update && DEBIAN_FRONTEND=noninteractive apt-get install -y{flags} {packages}"
+            " && rm -rf /var/lib/apt/lists/*"
+        )
+    if install.manager == "apk":
+        return f"apk add --no-cache{flags} {packages}"
+    if install.manager in ("dnf", "yum"):
+        return f"{program} install -y{flags} {packages} && {program} clean all"
+    return f"{program} install --no-cache-dir{flags} {packages}"
+
+
+def format_copy_block(paths: Sequence[Path], context_dir: str = COPY_CONTEXT_DIR) -> str:
+    """
+    COPY the files into the image in one layer, from a directory of the build context
+    that mirrors the container filesystem.
+    """
+    if len(paths) == 0:
+        return ""
+    lines = [f"# Modified files, from {context_dir}/ in the build context (see dockerdo export-files):"]
+    lines.extend(f"#   {path}" for path in sorted(paths))
+    lines.append(f"COPY {context_dir}/ /")
+    return "\n".join(lines)
+
+
+def format_env_value(value: str) -> str:
+    return value if re.fullmatch(r"[\w./:@%+,-]*", value) else json.dumps(value)
+
+
+def format_history_dockerfile(
+    base_image: str,
+    commands: Sequence[Tuple[str, Path]],
+    env: Dict[str, str],
+    modified_files: Sequence[Path],
+) -> str:
+    """
+    Synthesize a Dockerfile from the successful commands of the history, each with its working directory.
+
+    Read-only commands are dropped. Consecutive package installs are merged into one layer,
+    and the system package installs are moved first, as they change least often and take longest,
+    followed by the environment. The other commands are coalesced into one layer per working directory,
+    in their original order. The modified files are copied last, as they have their final content.
+    """
+    steps: List[Tuple[Path, Union[str, PackageInstall]]] = []
+    for command, cwd in commands:
+        # Quoted like dodo quotes its arguments
+        tokens = shlex.split(command)
+        if is_read_only_command(tokens):
+            continue
+        install = parse_package_install(tokens)
+        steps.append((cwd, install if install is not None else shlex.join(strip_sudo(tokens))))
+
+    system_installs: List[PackageInstall] = []
+    rest: List[Tuple[Path, Union[str, PackageInstall]]] = []
+    sources_configured = False
+    for cwd, step in steps:
+        if isinstance(step, PackageInstall) and step.is_system and not sources_configured:
+            system_installs.append(step)
+            continue
+        if isinstance(step, str) and RE_PACKAGE_SOURCES.search(step):
+            sources_configured = True
+        rest.append((cwd, step))
+
+    def merge(installs: List[PackageInstall]) -> List[PackageInstall]:
+        merged: List[PackageInstall] = []
+        for install in installs:
+            previous = merged[-1] if merged else None
+            if previous is not None and previous[:3] == install[:3]:
+                packages = previous.packages + tuple(p for p in install.packages if p not in previous.packages)
+                merged[-1] = previous._replace(packages=packages)
+            else:
+                merged.append(install)
+        return merged
+
+    lines = [f"FROM {base_image}", ""]
+    for install in merge(sorted(system_installs, key=lambda install: install.manager)):
+        lines.append(f"RUN {format_package_install(install)}")
+    if len(env) > 0:
+        assignments = [f"{key}={format_env_value(value)}" for key, value in sorted(env.items())]
+        lines.append("ENV " + " \\\n    ".join(assignments))
+    if len(lines) > 2:
+        lines.append("")
+    workdir: Optional[Path] = None
+    layer: List[str] = []
+    pending_installs: List[PackageInstall] = []
+
+    def flush() -> None:
+        for install in merge(pending_installs):
+            lines.append(f"RUN {format_package_install(install)}")
+        pending_installs.clear()
+        if layer:
+            lines.append("RUN " + " \\\n    && ".join(layer))
+            layer.clear()
+
+    for cwd, step in rest:
+        if cwd != workdir:
+            flush()
+            lines.append(f"WORKDIR {cwd}")
+            workdir = cwd
+        if isinstance(step, PackageInstall):
+            if layer:
+                flush()
+            pending_installs.append(step)
+        else:
+            if pending_installs:
+                flush()
+            layer.append(step)
+    flush()
+    copy_block = format_copy_block(modified_files)
+    if copy_block:
+        lines.extend(["", copy_block])
+    return "\n".join(lines).strip() + "\n"
@@ -0,0 +1,90 @@
+#!/bin/sh
+# dockerdo remote helper: answers a batch of queries about the host in a single json object.
+# Installed by dockerdo into the remote host build directory, and run from there.
+#
+# Usage: sh dockerdo-helper.sh [image=TAG | images] [container=NAME | containers] [ports] [disk] [files] [tarballs]
+# A null value means that the query failed.
+
+json_string() {
+    printf '"%s"' "$(printf '%s' "$1" | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' | tr -d '\n\r\t')"
+}
+
+# Join the json values on stdin, one per line, into an array
+json_array() {
+    printf '['
+    sep=''
+    while IFS= read -r line; do
+        [ -n "$line" ] || continue
+        printf '%s%s' "$sep" "$line"
+        sep=','
+    done
+    printf ']'
+}
+
+listening_ports() {
+    { ss -Htln 2>/dev/null || netstat -tln 2>/dev/null; } \
+        | awk '$4 ~ /:[0-9]+$/ { sub(/.*:/, "", $4); print $4 }' \
+        | sort -un
+}
+
+printf '{"version": 3'
+for query in "$@"; do
+    case "$query" in
+        image=*)
+            printf ', "images": '
+            if output=$(docker images --format '{{json .}}' "${query#image=}" 2>/dev/null); then
+                printf '%s\n' "$output" | json_array
+            else
+                printf 'null'
+            fi
+            ;;
+        images)
+            printf ', "images": '
+            if output=$(docker images --format '{{json .}}' 2>/dev/null); then
+                printf '%s\n' "$output" | json_array
+            else
+                printf 'null'
+            fi
+            ;;
+        containers)
+            printf ', "containers": '
+            if output=$(docker ps -a --format '{{json .}}' 2>/dev/null); then
+                printf '%s\n' "$output" | json_array
+            else
+                printf 'null'
+            fi
+            ;;
+        container=*)
+            printf ', "containers": '
+            if output=$(docker ps -a --filter "name=^${query#container=}\$" --format '{{json .}}' 2>/dev/null); then
+                printf '%s\n' "$output" | json_array
+            else
+                printf 'null'
+            fi
+            ;;
+        ports)
+            printf ', "ports": '
+            listening_ports | json_array
+            ;;
+        disk)
+            printf ', "disk": '
+            df -Pk . 2>/dev/null \
+                | awk 'NR == 2 { printf "{\"total_kb\": %s, \"used_kb\": %s, \"available_kb\": %s}", $2, $3, $4; found = 1 }
+                       END { if (!found) printf "null" }'
+            ;;
+        files)
+            printf ', "files": '
+            ls -1A . | while IFS= read -r name; do json_string "$name"; echo; done | json_array
+            ;;
+        tarballs)
+            printf ', "tarballs": '
+            for name in *.tar.gz; do
+                [ -f "$name" ] || continue
+                stat -c '%s %Y' "$name" 2>/dev/null | while read -r size mtime; do
+                    printf '{"name": %s, "size": %s, "mtime": %s}\n' "$(json_string "$name")" "$size" "$mtime"
+                done
+            done | json_array
+            ;;
+    esac
+done
+printf '}\n'
@@ -1,41 +1,151 @@
 """dockerdo/dodo: Use your local dev tools for remote docker development"""
 
+import asyncio
 import click
+import fcntl
 import importlib.resources
 import os
+import re
 import rich
+import shlex
+import shutil
+import sqlite3
 import sys
+import threading
 import time
+import yaml
 from contextlib import nullcontext, AbstractContextManager
+from datetime import datetime
+from functools import partial
 from pathlib import Path
-from subprocess import Popen
-from typing import Optional, List, Literal
-
-from dockerdo import prettyprint
-from dockerdo.config import UserConfig, Session
-from dockerdo.docker import DISTROS, format_dockerfile
+from subprocess import Popen, DEVNULL
+from typing import Optional, List, Literal, Dict, Any, TextIO, Tuple
+
+from dockerdo import prettyprint, trace
+from dockerdo.batch import BatchCommand, BatchError, BatchResult, parse_batch
+from dockerdo.cleanup import CleanupPlan, PlanKey, plan_cleanup
+from dockerdo.config import UserConfig, Session, Snapshot
+from dockerdo.docker import COPY_CONTEXT_DIR, DISTROS, format_copy_block, format_dockerfile, format_history_dockerfile
+from dockerdo.engine import DockerEngine, container_entry_names
+from dockerdo.fanout import FanoutError, PrefixedOutput, format_prefixes, select_sessions
+from dockerdo.file_transfer import (
+    TransferError,
+    TransferProgress,
+    TransferShard,
+    group_sources,
+    parse_location,
+    split_shard,
+)
+from dockerdo.history import ExecStats
+from dockerdo.pipeline import MAX_WORKERS, Step, run_pipeline, first_failure
+from dockerdo.pool import (
+    FILL_LOCK,
+    POOL_LABEL,
+    PooledContainer,
+    add_container,
+    claim_container,
+    load_pool,
+    pooled_container_name,
+    port_owner_dir,
+    remove_containers,
+)
+from dockerdo.port_registry import (
+    PortAllocationError,
+    allocate_port,
+    choose_port,
+    load_registry,
+    reassign_port,
+    release_ports,
+)
+from dockerdo.remote_helper import HostStatus, helper_queries
+from dockerdo.search import LocalPathOutput, SearchProgram, format_search_command, rewrites_paths
+from dockerdo.session_index import IndexedSession, SessionIndex
+from dockerdo.supervisor import ProcessComponent
 from dockerdo.shell import (
     set_execution_mode,
     get_user_config_dir,
+    get_user_data_dir,
+    get_user_state_dir,
     run_docker_save_pipe,
+    run_docker_save_to_engine,
+    run_engine_call,
+    open_docker_engine,
+    query_host_status,
+    query_listening_ports,
+    query_local_status,
     run_local_command,
     run_remote_command,
     run_container_command,
+    run_container_batch,
+    run_container_command_unattended,
+    OutputDestination,
+    run_container_tar_export,
+    run_tar_stream,
+    list_transfer_files,
+    resolve_location,
+    get_container_work_dir,
     verify_container_state,
-    run_ssh_master_process,
+    record_container_state,
+    make_session_supervisor,
+    send_supervisor_request,
+    stop_supervisor,
+    ensure_container_connection,
     detect_background,
     detect_ssh_agent,
+    MOUNT_PROBE_TIMEOUT,
 )
-from dockerdo.utils import make_image_tag
+from dockerdo.utils import make_image_tag, process_start_time, percentile, probe_path, split_image_reference
+
+STATS_PERCENTILES = (50, 90, 99, 100)
+# Seconds between updates of the progress of dockerdo cp
+PROGRESS_INTERVAL = 0.5
+# Snapshot names become part of an image tag
+RE_SNAPSHOT_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]{0,63}$")
 
 
 def load_user_config() -> UserConfig:
     """Load the user config"""
     user_config_path = get_user_config_dir() / "dockerdo.yaml"
-    if not user_config_path.exists():
-        return UserConfig()
-    with open(user_config_path, "r") as fin:
-        return UserConfig.from_yaml(fin.read())
+    with trace.span("load user config", "config", path=user_config_path):
+        if not user_config_path.exists():
+            return UserConfig()
+        with open(user_config_path, "r") as fin:
+            return UserConfig.from_yaml(fin.read())
+
+
+def index_session(session: Session, remove: bool = False) -> None:
+    """Keep the global session index up to date. Not fatal: dockerdo ls checks the state live."""
+    index = SessionIndex(get_user_state_dir())
+    try:
+        with trace.span("update session index", "config"):
+            if remove:
+                index.remove(session.session_dir)
+            else:
+                index.update(session)
+    except sqlite3.Error as e:
+        prettyprint.warning(f"Could not update the session index: {e}")
+    finally:
+        index.close()
+
+
+def load_session_index(dry_run: bool = False) -> List[IndexedSession]:
+    """
+    All the sessions in the index, after indexing the persistent sessions that are not in it yet,
+    and forgetting those whose directory is gone. A dry run reads the index without changing it.
+    """
+    index = SessionIndex(get_user_state_dir())
+    with trace.span("load session index", "config"):
+        if dry_run:
+            missing = {entry.session_dir for entry in index.missing()}
+            entries = [entry for entry in index.sessions() if entry.session_dir not in missing] + [
+                IndexedSession.from_session(session) for session in index.unindexed(get_user_data_dir())
+            ]
+        else:
+            index.discover(get_user_data_dir())
+            index.prune_missing()
+            entries = index.sessions()
+    index.close()
+    return entries
 
 
 def load_session() -> Optional[Session]:
@@ -46,14 +156,25 @@ def load_session() -> Optional[Session]:
             "$DOCKERDO_SESSION_DIR is not set. Did you source the activate script?"
         )
         return None
-    session = Session.load(Path(session_dir))
+    with trace.span("load session", "config", path=session_dir):
+        session = Session.load(Path(session_dir))
     return session
 
 
 # ## for subcommands
 @click.group(context_settings={"show_default": True})
-def cli() -> None:
-    pass
+@click.option(
+    "--trace",
+    "trace_path",
+    type=Path,
+    envvar="DOCKERDO_TRACE",
+    default=None,
+    help="Write timed spans in Chrome trace-event format to this file (or a new file in this directory)",
+)
+@click.pass_context
+def cli(ctx: click.Context, trace_path: Optional[Path]) -> None:
+    if trace_path is not None:
+        trace.enable(trace_path, name=ctx.invoked_subcommand or "dockerdo")
 
 
 @click.option("--no-bashrc", is_flag=True, help="Do not modify ~/.bashrc")
@@ -185,6 +306,7 @@ def init(
         return 1
     if not dry_run:
         session.save()
+        index_session(session)
         if not in_background:
             prettyprint.info("Remember to source the activate script:")
         print(session.write_activate_script())
@@ -287,11 +409,12 @@ def build(remote: bool, overlay_tag: Optional[str], verbose: bool, dry_run: bool
                     task.set_status("FAIL")
                     prettyprint.error(f"Remote host build directory not mounted at {session.sshfs_remote_mount_point}")
                     return 1
-                with open(dockerfile, "r") as fin:
-                    with open(destination, "w") as fout:
-                        fout.write(fin.read())
+                with trace.span("sshfs write", "sshfs", path=destination):
+                    with open(dockerfile, "r") as fin:
+                        with open(destination, "w") as fout:
+                            fout.write(fin.read())
                 # sleep to allow sshfs to catch up
-                time.sleep(max(1.0, session.remote_delay))
+                trace.sleep(max(1.0, session.remote_delay), reason="sshfs catch up")
             task.set_status("OK")
         with prettyprint.LongAction(
             host="remote",
@@ -325,6 +448,8 @@ def build(remote: bool, overlay_tag: Optional[str], verbose: bool, dry_run: bool
             else:
                 return retval
     session.save()
+    if not dry_run:
+        index_session(session)
     return 0
 
 
@@ -340,6 +465,7 @@ def push(verbose: bool, dry_run: bool) -> int:
     if session.image_tag is None:
         prettyprint.error("Must 'dockerdo build' first")
         return 1
+    transport = load_user_config().docker_transport
 
     if session.docker_registry is not None:
         with prettyprint.LongAction(
@@ -354,6 +480,17 @@ def push(verbose: bool, dry_run: bool) -> int:
             if retval != 0:
                 return retval
             task.set_status("OK")
+    elif session.remote_host is not None and (engine := open_docker_engine(session, transport)) is not None:
+        with prettyprint.LongAction(
+            host="remote",
+            running_verb="Loading",
+            done_verb="Loaded" if not dry_run else "Would load",
+            running_message=f"image {session.image_tag}",
+        ) as task:
+            retval = run_docker_save_to_engine(session.image_tag, local_work_dir=session.local_work_dir, engine=engine)
+            if retval != 0:
+                return retval
+            task.set_status("OK")
     elif session.remote_host is not None:
         sshfs_remote_mount_point = session.sshfs_remote_mount_point
         assert sshfs_remote_mount_point is not None
@@ -363,17 +500,21 @@ def push(verbose: bool, dry_run: bool) -> int:
             done_verb="Saved" if not dry_run else "Would save",
             running_message=f"image {session.image_tag}",
         ) as task:
+            tarball_name = f"{session.name}.tar.gz"
             retval = run_docker_save_pipe(
                 session.image_tag,
                 local_work_dir=session.local_work_dir,
                 sshfs_remote_mount_point=sshfs_remote_mount_point,
+                output_name=tarball_name,
             )
             if retval != 0:
                 return retval
-            remote_path = session.remote_host_build_dir / f"{session.name}.tar.gz"
-            retval = run_remote_command(f"pigz -d {remote_path} | docker load", session)
+            remote_path = session.remote_host_build_dir / tarball_name
+            # docker load decompresses by itself. The tarball is deleted, instead of filling the remote disk.
+            retval = run_remote_command(f"docker load -i {remote_path}", session)
             if retval != 0:
                 return retval
+            run_remote_command(f"rm -f {remote_path}", session)
             task.set_status("OK")
     else:
         prettyprint.warning(
@@ -383,6 +524,176 @@ def push(verbose: bool, dry_run: bool) -> int:
     return 0
 
 
+def allocate_ssh_port(
+    session: Session, user_config: UserConfig, host_status: Optional[HostStatus], dry_run: bool
+) -> Optional[int]:
+    """
+    Assign the port on the host that is forwarded to ssh in the container.
+    Unless a port was requested, the lowest free port in the configured range is used.
+    The assignment is recorded in the registry shared by all local sessions,
+    so that sessions started in parallel on the same host get different ports.
+    """
+    host = session.remote_host if session.remote_host is not None else "localhost"
+    requested = session.ssh_port_on_remote_host
+    in_use = query_listening_ports(session, host_status)
+    if in_use is None:
+        in_use = []
+        if not dry_run:
+            prettyprint.warning(f"Could not list the ports in use on {host}")
+    if requested is not None and requested in in_use:
+        prettyprint.error(f"Port {requested} is already in use on {host}")
+        return None
+    first_port = user_config.ssh_port_range_start
+    port_range = range(first_port, first_port + user_config.ssh_port_range_size)
+    try:
+        if dry_run:
+            port = choose_port(
+                load_registry(get_user_state_dir()), host, session.session_dir, in_use, port_range, requested
+            )
+        else:
+            port = allocate_port(
+                get_user_state_dir(), host, session.name, session.session_dir, in_use, port_range, requested
+            )
+    except PortAllocationError as e:
+        prettyprint.error(str(e))
+        return None
+    if requested is None:
+        where: Literal["local", "remote"] = "local" if session.remote_host is None else "remote"
+        prettyprint.action(where, "Allocated" if not dry_run else "Would allocate", f"port {port} for ssh")
+    session.ssh_port_on_remote_host = port
+    return port
+
+
+def format_docker_run_command(
+    docker_args_str: str, ssh_port_on_remote_host: int, container_name: str, image_tag: str, label: str = ""
+) -> str:
+    label_flag = f" --label {label}" if label else ""
+    return (
+        f"docker run -d {docker_args_str}"
+        f" -p {ssh_port_on_remote_host}:22{label_flag}"
+        f" --name {container_name} {image_tag}"
+    )
+
+
+def run_on_host(command: str, session: Session, silent: bool = False) -> int:
+    """Run a command on the host of the containers: the remote host, or the local host"""
+    if session.remote_host is None:
+        return run_local_command(command, cwd=session.local_work_dir, silent=silent)
+    return run_remote_command(command, session)
+
+
+def claim_pooled_container(session: Session, docker_args_str: str) -> Optional[PooledContainer]:
+    """
+    Take a pre-started container out of the pool, and rename it to the container of the session.
+    Its port is handed over to the session. Returns None if the pool has no matching container.
+    """
+    assert session.image_tag is not None
+    state_dir = get_user_state_dir()
+    host = session.remote_host if session.remote_host is not None else "localhost"
+    while (claimed := claim_container(state_dir, host, session.image_tag, docker_args_str)) is not None:
+        owner_dir = port_owner_dir(state_dir, claimed.container_name)
+        # A single round trip. Starting a running container does nothing, but revives one that died.
+        retval = run_on_host(
+            f"sh -c 'docker rename {claimed.container_name} {session.container_name}"
+            f" && docker start {session.container_name} > /dev/null'",
+            session,
+        )
+        if retval == 0:
+            reassign_port(state_dir, host, claimed.port, session.name, session.session_dir)
+            shutil.rmtree(owner_dir, ignore_errors=True)
+            session.ssh_port_on_remote_host = claimed.port
+            prettyprint.action("container", "Claimed", f"pooled container {claimed.container_name}")
+            return claimed
+        # E.g. removed by hand: try the next one
+        prettyprint.warning(f"Pooled container {claimed.container_name} is gone")
+        release_ports(state_dir, owner_dir)
+        shutil.rmtree(owner_dir, ignore_errors=True)
+    return None
+
+
+def start_pool_refill(session: Session) -> None:
+    """Top up the pool in a detached process, so that the next dockerdo run can claim a container"""
+    env = dict(os.environ, DOCKERDO_SESSION_DIR=str(session.session_dir))
+    # The trace file belongs to this process
+    env.pop("DOCKERDO_TRACE", None)
+    Popen(
+        [sys.executable, "-m", "dockerdo.dockerdo", "pool", "fill"],
+        cwd=session.local_work_dir,
+        env=env,
+        stdin=DEVNULL,
+        stdout=DEVNULL,
+        stderr=DEVNULL,
+        start_new_session=True,
+        # Leave the CPU to bringing up the session that claimed the container
+        preexec_fn=lambda: os.nice(10),
+    )
+
+
+def fill_pool(session: Session, user_config: UserConfig, size: int, jobs: int, dry_run: bool) -> int:
+    """
+    Start containers in parallel, until the pool holds size containers for the image of the session on its host.
+    The containers are started with the default docker run arguments of the session.
+    """
+    assert session.image_tag is not None
+    image_tag = session.image_tag
+    state_dir = get_user_state_dir()
+    state_dir.mkdir(parents=True, exist_ok=True)
+    host = session.remote_host if session.remote_host is not None else "localhost"
+    docker_args_str = " ".join(session.docker_run_args.split()) if session.docker_run_args is not None else ""
+    with open(state_dir / FILL_LOCK, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            prettyprint.info("The pool is already being filled")
+            return 0
+        missing = size - len(load_pool(state_dir).available(host, image_tag, docker_args_str))
+        if missing <= 0:
+            return 0
+        in_use = query_listening_ports(session) or []
+        first_port = user_config.ssh_port_range_start
+        port_range = range(first_port, first_port + user_config.ssh_port_range_size)
+
+        def start(container_name: str) -> int:
+            owner_dir = port_owner_dir(state_dir, container_name)
+            if dry_run:
+                port = choose_port(load_registry(state_dir), host, owner_dir, in_use, port_range)
+            else:
+                owner_dir.mkdir(parents=True, exist_ok=True)
+                try:
+                    port = allocate_port(state_dir, host, container_name, owner_dir, in_use, port_range)
+                except PortAllocationError as e:
+                    prettyprint.error(str(e))
+                    shutil.rmtree(owner_dir, ignore_errors=True)
+                    return 1
+            command = format_docker_run_command(
+                docker_args_str, port, container_name, image_tag, label=f"{POOL_LABEL}=1"
+            )
+            retval = run_on_host(command, session, silent=True)
+            if retval != 0:
+                release_ports(state_dir, owner_dir)
+                shutil.rmtree(owner_dir, ignore_errors=True)
+                return retval
+            if not dry_run:
+                add_container(
+                    state_dir,
+                    PooledContainer(
+                        host=host,
+                        image_tag=image_tag,
+                        docker_run_args=docker_args_str,
+                        container_name=container_name,
+                        port=port,
+                        created_at=time.time(),
+                    ),
+                )
+            prettyprint.action(
+                "container", "Started" if not dry_run else "Would start", f"pooled container {container_name}"
+            )
+            return 0
+
+        names = [pooled_container_name() for _ in range(missing)]
+        return first_failure(run_pipeline([Step(name, partial(start, name)) for name in names], max_workers=jobs))
+
+
 def run_or_start(
     docker_command: Literal["run", "start"],
     docker_args: List[str],
@@ -391,6 +702,7 @@ def run_or_start(
     verbose: bool,
     dry_run: bool,
     session: Session,
+    exec_server: bool = False,
 ) -> int:
     """
     Either run (create and start) or start the container
@@ -407,20 +719,52 @@ def run_or_start(
     if not detect_ssh_agent():
         prettyprint.error("Dockerdo requires an ssh agent. Please start one and add your keys.")
         return 1
-    verify_container_state(session)
+    user_config = load_user_config()
+    engine = open_docker_engine(session, user_config.docker_transport)
+    # The image of the session, or the restored snapshot
+    container_image = session.container_image
+    assert container_image is not None
+    # Check the container, the image and the ports in a single round trip
+    host_status = query_host_status(
+        session, image=container_image, container=session.container_name, ports=True
+    ) if engine is None else None
+    verify_container_state(
+        session, max_age=user_config.container_state_ttl, engine=engine, host_status=host_status
+    )
     if session.container_state == "running":
         prettyprint.error(f"Container {session.container_name} is already running!")
         return 1
+    if docker_command == "run" and host_status is not None:
+        if host_status.images is not None and not host_status.has_image():
+            if session.snapshot is not None:
+                prettyprint.error(f"Image {container_image} of snapshot {session.snapshot} not found")
+                return 1
+            if session.docker_registry is None:
+                prettyprint.error(f"Image {session.image_tag} not found on remote host: must 'dockerdo push' first")
+                return 1
     docker_args_str = " ".join(docker_args)
+    # Pooled containers run the image of the session, not a snapshot
+    use_pool = (
+        docker_command == "run" and user_config.pool_size > 0 and session.ssh_port_on_remote_host is None
+        and session.snapshot is None and not dry_run
+    )
+    claimed = claim_pooled_container(session, docker_args_str) if use_pool else None
+    if claimed is not None:
+        ssh_port_on_remote_host = claimed.port
+    elif docker_command == "run":
+        allocated_port = allocate_ssh_port(session, user_config, host_status, dry_run)
+        if allocated_port is None:
+            return 1
+        ssh_port_on_remote_host = allocated_port
+    else:
+        assert session.ssh_port_on_remote_host is not None
+        ssh_port_on_remote_host = session.ssh_port_on_remote_host
     if remote_delay is not None:
         session.remote_delay = remote_delay
-    ssh_port_on_remote_host = session.ssh_port_on_remote_host if session.ssh_port_on_remote_host is not None else 2222
 
     if docker_command == "run":
-        command = (
-            f"docker run -d {docker_args_str}"
-            f" -p {ssh_port_on_remote_host}:22 "
-            f" --name {session.container_name} {session.image_tag}"
+        command = format_docker_run_command(
+            docker_args_str, ssh_port_on_remote_host, session.container_name, container_image
         )
     else:  # start
         command = f"docker start {docker_args_str} {session.container_name}"
@@ -436,95 +780,55 @@ def run_or_start(
             running_message=f"container {session.container_name}",
         )
     with ctx_mgr as task:
-        if session.remote_host is None:
+        if claimed is not None:
+            retval = 0
+        elif engine is not None and docker_command == "start" and len(docker_args) == 0:
+            retval = run_engine_call(
+                f"POST /containers/{session.container_name}/start",
+                lambda: engine.start_container(session.container_name),
+            )
+        elif session.remote_host is None:
             retval = run_local_command(command, cwd=session.local_work_dir, silent=in_background)
         else:
             retval = run_remote_command(command, session)
         if retval != 0:
+            if docker_command == "run" and not dry_run:
+                release_ports(get_user_state_dir(), session.session_dir)
             return retval
+        record_container_state(session, "running")
         if task:
             task.set_status("OK")
+    if use_pool:
+        start_pool_refill(session)
 
     remote_host = (
         session.remote_host if session.remote_host is not None else "localhost"
     )
-    ssh_master_process: Optional[Popen] = None
-    if not in_background:
-        ctx_mgr = prettyprint.LongAction(
-            host="local",
-            running_verb="Creating" if not dry_run else "Would create",
-            done_verb="Created" if not dry_run else "Would create",
-            running_message="SSH socket",
-        )
-    with ctx_mgr as task:
-        # sleep to wait for the container to start
-        if not dry_run:
-            time.sleep(2)
-        ssh_master_process = run_ssh_master_process(
-            session=session,
-            remote_host=remote_host,
-            ssh_port_on_remote_host=ssh_port_on_remote_host
-        )
-        # sleep to wait for the ssh master process to start
-        time.sleep(2)
-        if task and os.path.exists(session.session_dir / "ssh-socket-container"):
-            task.set_status("OK")
-        if dry_run:
-            task.set_status("OK")
+    session.record_inotify = session.record_inotify or record
+    session.exec_server = session.exec_server or exec_server or user_config.always_exec_server
+    supervisor = make_session_supervisor(
+        session,
+        remote_host=remote_host,
+        ssh_port_on_remote_host=ssh_port_on_remote_host,
+        record=session.record_inotify,
+    )
+    if dry_run:
+        for component in supervisor.components:
+            if isinstance(component, ProcessComponent):
+                print(f"+ {' '.join(component.command)}", file=sys.stderr)
+            prettyprint.action(component.host, "Would start", component.message)
+        return 0
+    session.container_state = "running"
+    session.save()
+    index_session(session)
 
     if not in_background:
-        ctx_mgr = prettyprint.LongAction(
-            host="local",
-            running_verb="Mounting" if not dry_run else "Would mount",
-            done_verb="Mounted" if not dry_run else "Would mount",
-            running_message="container filesystem",
-        )
-    with ctx_mgr as task:
-        if not dry_run:
-            os.makedirs(session.sshfs_container_mount_point, exist_ok=True)
-        retval = run_local_command(
-            f"sshfs -p {ssh_port_on_remote_host}"
-            f" {session.container_username}@{remote_host}:/"
-            f" {session.sshfs_container_mount_point}",
-            cwd=session.local_work_dir,
-            silent=in_background,
+        prettyprint.info(
+            "Supervising the ssh connection, the mount and the recording."
+            " Runs indefinitely: remember to background this process."
         )
-        if retval != 0:
-            return retval
-        if task and session.sshfs_container_mount_point.is_mount():
-            task.set_status("OK")
-        if dry_run:
-            task.set_status("OK")
-
-    session.record_inotify = session.record_inotify or record
-    if not dry_run:
-        session.container_state = "running"
-        session.save()
-
-    if session.record_inotify:
-        if not dry_run:
-            import dockerdo.inotify
-
-            inotify_listener = dockerdo.inotify.InotifyListener(session)
-            inotify_listener.register_listeners()
-            if not in_background:
-                prettyprint.info("Recording filesystem events. Runs indefinitely: remember to background this process.")
-            try:
-                inotify_listener.listen(verbose=verbose)
-            except OSError as e:
-                prettyprint.error(f"No longer listening to filesystem events due to error: {e}")
-        else:
-            prettyprint.info("Would record filesystem events")
-
-    if ssh_master_process is None:
-        return 1
-    else:
-        if not in_background:
-            prettyprint.info(
-                "Waiting for ssh master connection to close. Runs indefinitely: remember to background this process."
-            )
-        ssh_master_process.wait()
-    return 0
+    # Owns the long-running processes of the session until the container stops or `dockerdo stop`
+    return asyncio.run(supervisor.run(show_progress=not in_background))
 
 
 @cli.command(context_settings=dict(ignore_unknown_options=True))
@@ -538,6 +842,7 @@ def run_or_start(
     "--ssh-port-on-remote-host", type=int, help="container SSH port on remote host"
 )
 @click.option("--record", is_flag=True, help="Record filesystem events")
+@click.option("--exec-server", is_flag=True, help="Run commands through an exec server in the container")
 @click.option(
     "--remote-delay",
     type=float,
@@ -556,6 +861,7 @@ def run(
     no_default_args: bool,
     ssh_port_on_remote_host: Optional[int],
     record: bool,
+    exec_server: bool,
     remote_delay: Optional[float],
     verbose: bool,
     dry_run: bool,
@@ -572,9 +878,7 @@ def run(
         return 1
     if session.docker_run_args is not None and not no_default_args:
         docker_run_args = session.docker_run_args.split() + docker_run_args
-    if ssh_port_on_remote_host is None:
-        # TODO: detect a free port
-        ssh_port_on_remote_host = 2222
+    # None means: allocate a free port
     session.ssh_port_on_remote_host = ssh_port_on_remote_host
     return run_or_start(
         docker_command="run",
@@ -584,12 +888,14 @@ def run(
         verbose=verbose,
         dry_run=dry_run,
         session=session,
+        exec_server=exec_server,
     )
 
 
 @cli.command(context_settings=dict(ignore_unknown_options=True))
 @click.argument("docker_start_args", nargs=-1, type=click.UNPROCESSED)
 @click.option("--record", is_flag=True, help="Record filesystem events")
+@click.option("--exec-server", is_flag=True, help="Run commands through an exec server in the container")
 @click.option(
     "--remote-delay",
     type=float,
@@ -601,6 +907,7 @@ def run(
 def start(
     docker_start_args: List[str],
     record: bool,
+    exec_server: bool,
     remote_delay: Optional[float],
     verbose: bool,
     dry_run: bool,
@@ -627,6 +934,7 @@ def start(
         verbose=verbose,
         dry_run=dry_run,
         session=session,
+        exec_server=exec_server,
     )
 
 
@@ -654,31 +962,281 @@ def export(key_value: str, verbose: bool, dry_run: bool) -> int:
     return 0
 
 
+def exec_batch(text: str, session: Session, keep_going: bool, dry_run: bool) -> int:
+    """Run a batch of commands over a single connection, recording each command in the history"""
+    container_work_dir = get_container_work_dir(session)
+    if not container_work_dir:
+        prettyprint.error(
+            f"Current working directory is not inside the container mount point {session.sshfs_container_mount_point}"
+        )
+        return 1
+    try:
+        commands = parse_batch(text, container_work_dir)
+    except BatchError as e:
+        prettyprint.error(f"Invalid batch: {e}")
+        return 1
+    ensure_container_connection(session)
+    if session.remote_delay > 0.0:
+        trace.sleep(session.remote_delay, reason="remote delay")
+    retval, results = run_container_batch(
+        commands, session, keep_going=keep_going, local_time=time.time() - process_start_time()
+    )
+    if dry_run:
+        return retval
+    for result in results:
+        session.record_command(
+            result.command.command, result.command.work_dir, exit_code=result.exit_code, stats=result.stats
+        )
+        if result.exit_code != 0:
+            prettyprint.error(
+                f"Line {result.command.line_number} exited with status {result.exit_code}: {result.command.command}"
+            )
+    if len(results) < len(commands):
+        prettyprint.warning(f"Ran {len(results)} of {len(commands)} commands")
+    if retval != 0:
+        return retval
+    session.save()
+    return 0
+
+
+def exec_fanout(command: str, names: List[str], all_running: bool, jobs: int, dry_run: bool) -> int:
+    """
+    Run a command in several sessions concurrently, each output line prefixed by the name of the session.
+    Returns the exit status of the first failing session, in the given order.
+    """
+    entries = load_session_index()
+    try:
+        selected = select_sessions(entries, names, all_running)
+    except FanoutError as e:
+        prettyprint.error(str(e))
+        return 1
+    if len(selected) == 0:
+        prettyprint.error("No running sessions" if all_running else "No sessions given")
+        return 1
+    sessions = [Session.load(entry.session_dir) for entry in selected]
+    # The same working directory in all the containers, deduced from the mount point containing the current directory
+    active_session_dir = os.environ.get("DOCKERDO_SESSION_DIR", None)
+    candidates = sessions + ([Session.load(Path(active_session_dir))] if active_session_dir is not None else [])
+    container_work_dir = next(
+        (work_dir for work_dir in (get_container_work_dir(session) for session in candidates) if work_dir), None
+    )
+    if container_work_dir is None:
+        prettyprint.error("Current working directory is not inside the container mount point of any of the sessions")
+        return 1
+    prefixes = format_prefixes([session.name for session in sessions])
+    output_lock = threading.Lock()
+    results: Dict[Path, Tuple[int, ExecStats]] = {}
+
+    def run(session: Session) -> int:
+        ensure_container_connection(session)
+        if session.remote_delay > 0.0:
+            trace.sleep(session.remote_delay, reason="remote delay")
+        stdout = PrefixedOutput(sys.stdout.buffer, prefixes[session.name], output_lock)
+        stderr = PrefixedOutput(sys.stderr.buffer, prefixes[session.name], output_lock)
+        with trace.span("exec", "fanout", session=session.name):
+            retval, stats = run_container_command_unattended(
+                command, session, container_work_dir, stdout=stdout, stderr=stderr
+            )
+        stdout.close()
+        stderr.close()
+        stats.wall_time = time.time() - process_start_time()
+        results[session.session_dir] = (retval, stats)
+        return retval
+
+    run_pipeline(
+        [Step(str(session.session_dir), partial(run, session)) for session in sessions],
+        max_workers=jobs,
+    )
+    if dry_run:
+        return 0
+    rows: List[Tuple[str, Optional[int], Optional[float]]] = []
+    retval = 0
+    for session in sessions:
+        if session.session_dir not in results:
+            rows.append((session.name, None, None))
+            continue
+        exit_code, stats = results[session.session_dir]
+        stats.local_time = (stats.wall_time or 0.0) - (stats.ssh_time or 0.0) - (stats.remote_time or 0.0)
+        session.record_command(command, container_work_dir, exit_code=exit_code, stats=stats)
+        rows.append((session.name, exit_code, stats.wall_time))
+        retval = retval or exit_code
+    prettyprint.fanout_summary(rows)
+    return retval
+
+
 @cli.command(context_settings=dict(ignore_unknown_options=True))
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
 @click.option("-i", "--interactive", is_flag=True, help="Connect stdin for interactive commands")
+@click.option(
+    "--sessions", type=str, default=None,
+    help="Run the command concurrently in these sessions, given as comma separated names",
+)
+@click.option(
+    "--all-running", is_flag=True, help="Run the command concurrently in all sessions with a running container"
+)
+@click.option(
+    "--session-jobs", type=int, default=MAX_WORKERS,
+    help="With --sessions or --all-running, number of sessions to run the command in at once",
+)
+@click.option(
+    "--batch", "batch_file", type=click.File("r"), default=None,
+    help="Run the commands in a file, one per line, over a single connection. - reads them from stdin",
+)
+@click.option(
+    "--on-error", type=click.Choice(["stop", "continue"]), default="stop",
+    help="With --batch, whether to stop at the first failing command",
+)
 @click.option("-v", "--verbose", is_flag=True, help="Print commands")
 @click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
-def exec(args: List[str], interactive: bool, verbose: bool, dry_run: bool) -> int:
+def exec(
+    args: List[str],
+    interactive: bool,
+    sessions: Optional[str],
+    all_running: bool,
+    session_jobs: int,
+    batch_file: Optional[TextIO],
+    on_error: str,
+    verbose: bool,
+    dry_run: bool,
+) -> int:
     """Execute a command in the container"""
     set_execution_mode(verbose, dry_run)
+    if sessions is not None or all_running:
+        if interactive or batch_file is not None:
+            prettyprint.error("A command run in several sessions can not be interactive or a batch")
+            return 1
+        names = [name.strip() for name in (sessions or "").split(",") if name.strip()]
+        return exec_fanout(" ".join(args), names, all_running, session_jobs, dry_run)
     user_config = load_user_config()
     session = load_session()
     if session is None:
         return 1
+    if batch_file is not None:
+        if len(args) > 0 or interactive:
+            prettyprint.error("--batch takes the commands from the file, and can not be interactive")
+            return 1
+        return exec_batch(batch_file.read(), session, keep_going=(on_error == "continue"), dry_run=dry_run)
     command = " ".join(args)
-    session.write_container_env_file(verbose=verbose)
+    # Not fatal: ssh falls back to a direct connection if the master connection is still down
+    ensure_container_connection(session)
     if session.remote_delay > 0.0:
-        time.sleep(session.remote_delay)
+        trace.sleep(session.remote_delay, reason="remote delay")
     interactive = interactive or user_config.always_interactive
-    retval, container_work_dir = run_container_command(command=command, session=session, interactive=interactive)
+    retval, container_work_dir, stats = run_container_command(
+        command=command, session=session, interactive=interactive
+    )
+    if container_work_dir == Path() or dry_run:
+        return retval
+    stats.wall_time = time.time() - process_start_time()
+    stats.local_time = stats.wall_time - (stats.ssh_time or 0.0) - (stats.remote_time or 0.0)
+    session.record_command(command, container_work_dir, exit_code=retval, stats=stats)
     if retval != 0:
         return retval
-    session.record_command(command, container_work_dir)
     session.save()
     return 0
 
 
+@cli.command()
+@click.option("--slowest", type=int, default=10, help="Number of slowest commands to show")
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def stats(slowest: int, verbose: bool, dry_run: bool) -> int:
+    """Show latency statistics of the commands executed in the container"""
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    store = session.history_store
+    rows = []
+    for column, label in (
+        ("wall_time", "total"),
+        ("local_time", "local"),
+        ("ssh_time", "ssh"),
+        ("remote_time", "remote"),
+    ):
+        values = store.timings(column)
+        rows.append((label, len(values), [percentile(values, q) for q in STATS_PERCENTILES]))
+    prettyprint.info("Command latency (seconds):")
+    prettyprint.latency_table(rows, STATS_PERCENTILES)
+    prettyprint.info(f"Slowest {slowest} commands:")
+    prettyprint.slowest_commands(store.slowest_commands(slowest))
+    return 0
+
+
+def check_session_hosts(entries: List[IndexedSession], jobs: int) -> Dict[str, Optional[HostStatus]]:
+    """
+    List the containers and images on each host of the sessions, one helper query per host, all hosts in parallel.
+    Returns the answer for each host, None if the host could not be checked.
+    """
+    representatives: Dict[str, IndexedSession] = {}
+    for entry in entries:
+        representatives.setdefault(entry.host, entry)
+    host_statuses: Dict[str, Optional[HostStatus]] = {}
+
+    def check(entry: IndexedSession) -> int:
+        with trace.span("check host", "ls", host=entry.host):
+            if entry.remote_host is None:
+                host_status = query_local_status(helper_queries(all_images=True, all_containers=True))
+            else:
+                # The helper is installed in the build directory of the session
+                try:
+                    session = Session.load(entry.session_dir)
+                except (OSError, ValueError, TypeError, yaml.YAMLError) as e:
+                    prettyprint.warning(f"Not checking {entry.host}: cannot load session {entry.name}: {e}")
+                    host_statuses[entry.host] = None
+                    return 1
+                host_status = query_host_status(session, all_images=True, all_containers=True)
+        host_statuses[entry.host] = host_status
+        return 0 if host_status is not None else 1
+
+    run_pipeline(
+        [Step(host, partial(check, entry)) for host, entry in representatives.items()],
+        max_workers=jobs,
+    )
+    return host_statuses
+
+
+@cli.command(name="ls")
+@click.option("--cached", is_flag=True, help="Show the indexed state, without checking the hosts")
+@click.option("-j", "--jobs", type=int, default=MAX_WORKERS, help="Number of hosts to check in parallel")
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def ls(cached: bool, jobs: int, verbose: bool, dry_run: bool) -> int:
+    """List all sessions"""
+    set_execution_mode(verbose, dry_run)
+    entries = load_session_index(dry_run)
+    if len(entries) == 0:
+        prettyprint.info("No sessions")
+        return 0
+    host_statuses = check_session_hosts(entries, jobs) if not cached else {}
+
+    rows = []
+    for entry in sorted(entries, key=lambda entry: entry.last_active(), reverse=True):
+        host_status = host_statuses.get(entry.host)
+        if host_status is not None and host_status.containers is not None:
+            container = host_status.find_container(entry.container_name)
+            state = str(container.get("State", "unknown")) if container is not None else "nothing"
+        else:
+            # Not verified: as of the last dockerdo command
+            state = f"{entry.container_state}?"
+        image = entry.image_tag or "-"
+        if host_status is not None and entry.image_tag is not None:
+            size = next(
+                (
+                    str(image_entry["Size"]) for image_entry in host_status.images or []
+                    if f"{image_entry.get('Repository')}:{image_entry.get('Tag')}" == entry.image_tag
+                    and "Size" in image_entry
+                ),
+                None,
+            )
+            if size is not None:
+                image = f"{image} ({size})"
+        port = str(entry.ssh_port_on_remote_host) if entry.ssh_port_on_remote_host is not None else "-"
+        rows.append((entry.name, state, entry.host, image, port, entry.last_active()))
+    prettyprint.session_table(rows, now=time.time())
+    return 0
+
+
 @cli.command()
 @click.option("-v", "--verbose", is_flag=True, help="Print commands")
 @click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
@@ -702,29 +1260,129 @@ def status(verbose: bool, dry_run: bool) -> int:
     else:
         prettyprint.warning(f"No Dockerfile found in {dockerfile}")
 
-    # Check existence of image
-    if session.image_tag is not None:
+    user_config = load_user_config()
+    engine: Optional[DockerEngine] = None
+    host_status: Optional[HostStatus] = None
+    # The local checks run concurrently with the queries to docker
+    # None for a mount that did not respond within MOUNT_PROBE_TIMEOUT
+    is_mount: Dict[Path, Optional[bool]] = {}
+    socket_exists: Dict[str, bool] = {}
+    supervisor_health: Dict[str, Any] = {}
+
+    def connect() -> int:
+        nonlocal engine, host_status
+        engine = open_docker_engine(session, user_config.docker_transport)
+        # Query the remote host in a single round trip
+        host_status = query_host_status(
+            session, image=session.image_tag, container=session.container_name, disk=True
+        ) if engine is None else None
+        return 0
+
+    def show_images() -> int:
+        # Check existence of image
+        if session.image_tag is None:
+            return 0
         prettyprint.info(f"Docker images with tag: {session.image_tag}")
         command = f"docker images {session.image_tag}"
-        if session.remote_host is None:
+        if host_status is not None and host_status.images is not None:
+            prettyprint.docker_table(
+                ("REPOSITORY", "TAG", "IMAGE ID", "SIZE"),
+                ((image["Repository"], image["Tag"], image["ID"], image["Size"]) for image in host_status.images),
+            )
+        elif engine is not None:
+            images = engine.images(reference=session.image_tag) if not dry_run else []
+            prettyprint.docker_table(
+                ("IMAGE ID", "TAGS", "SIZE"),
+                ((image["Id"], ", ".join(image.get("RepoTags") or []), str(image["Size"])) for image in images),
+            )
+        elif session.remote_host is None:
             run_local_command(command, cwd=session.local_work_dir)
         else:
             run_remote_command(command, session)
+        return 0
 
-    # Check status of container
-    verify_container_state(session)
-    if session.container_state == "running":
+    def check_container() -> int:
+        verify_container_state(
+            session, max_age=user_config.container_state_ttl, engine=engine, host_status=host_status
+        )
+        return 0
+
+    def show_containers() -> int:
+        # Check status of container
+        if session.container_state != "running":
+            return 0
         prettyprint.info(f"Containers named {session.container_name}")
-        command = f"docker ps -a --filter name={session.container_name}"
-        if session.remote_host is None:
+        command = f"docker ps -a --filter name=^{session.container_name}$"
+        if host_status is not None and host_status.containers is not None:
+            prettyprint.docker_table(
+                ("CONTAINER ID", "IMAGE", "STATUS", "NAMES"),
+                (
+                    (container["ID"], container["Image"], container["Status"], container["Names"])
+                    for container in host_status.containers
+                ),
+            )
+        elif engine is not None:
+            containers = engine.containers(name=session.container_name) if not dry_run else []
+            prettyprint.docker_table(
+                ("CONTAINER ID", "IMAGE", "STATUS", "NAMES"),
+                (
+                    (
+                        container["Id"][:12],
+                        container["Image"],
+                        container["Status"],
+                        ", ".join(container_entry_names(container)),
+                    )
+                    for container in containers
+                ),
+            )
+        elif session.remote_host is None:
             run_local_command(command, cwd=session.local_work_dir)
         else:
             run_remote_command(command, session)
+        return 0
+
+    def check_mounts() -> int:
+        # is_mount blocks on a hung sshfs mount, so the mount point is probed with a timeout first
+        for mount_point in (session.sshfs_remote_mount_point, session.sshfs_container_mount_point):
+            if mount_point is None:
+                continue
+            if probe_path(mount_point, MOUNT_PROBE_TIMEOUT):
+                is_mount[mount_point] = mount_point.is_mount()
+            elif mount_point.parent.is_dir() and mount_point.name in os.listdir(mount_point.parent):
+                # Listing the parent does not touch the mount
+                is_mount[mount_point] = None
+            else:
+                is_mount[mount_point] = False
+        return 0
+
+    def check_sockets() -> int:
+        for socket_name in ("ssh-socket-remote", "ssh-socket-container"):
+            socket_exists[socket_name] = os.path.exists(session.session_dir / socket_name)
+        supervisor_health.update(send_supervisor_request(session, "status") or {})
+        return 0
+
+    run_pipeline([
+        Step("connect", connect),
+        Step("images", show_images, ("connect",)),
+        Step("container", check_container, ("connect",)),
+        # Depends on images only to keep the order of the output
+        Step("containers", show_containers, ("images", "container")),
+        Step("mounts", check_mounts),
+        Step("sockets", check_sockets),
+    ])
+
+    if host_status is not None and host_status.disk is not None:
+        available_gb = host_status.disk.available_kb / (1 << 20)
+        prettyprint.info(f"Remote host build directory has {available_gb:.1f} GB available")
 
     # Check status of mounts
     sshfs_remote_mount_point = session.sshfs_remote_mount_point
     if sshfs_remote_mount_point is not None:
-        if sshfs_remote_mount_point.is_mount():
+        if is_mount[sshfs_remote_mount_point] is None:
+            prettyprint.warning(
+                f"Remote host build directory mount at {sshfs_remote_mount_point} is not responding"
+            )
+        elif is_mount[sshfs_remote_mount_point]:
             prettyprint.info(
                 f"Remote host build directory mounted at {sshfs_remote_mount_point}"
             )
@@ -734,7 +1392,11 @@ def status(verbose: bool, dry_run: bool) -> int:
             )
     sshfs_container_mount_point = session.sshfs_container_mount_point
     if session.container_state == "running":
-        if sshfs_container_mount_point.is_mount():
+        if is_mount[sshfs_container_mount_point] is None:
+            prettyprint.warning(
+                f"Container filesystem mount at {sshfs_container_mount_point} is not responding"
+            )
+        elif is_mount[sshfs_container_mount_point]:
             prettyprint.info(
                 f"Container filesystem mounted at {sshfs_container_mount_point}"
             )
@@ -745,20 +1407,27 @@ def status(verbose: bool, dry_run: bool) -> int:
 
     # Check status of SSH sockets
     if session.remote_host is not None:
-        if os.path.exists(session.session_dir / "ssh-socket-remote"):
+        if socket_exists["ssh-socket-remote"]:
             prettyprint.info(f"SSH socket to remote host found at {session.session_dir}/ssh-socket-remote")
         else:
             prettyprint.warning(
                 f"SSH socket to remote host not found at {session.session_dir}/ssh-socket-remote"
             )
     if session.container_state == "running":
-        if os.path.exists(session.session_dir / "ssh-socket-container"):
+        if socket_exists["ssh-socket-container"]:
             prettyprint.info(f"SSH socket to container found at {session.session_dir}/ssh-socket-container")
         else:
             prettyprint.warning(
                 f"SSH socket to container not found at {session.session_dir}/ssh-socket-container"
             )
 
+    # Check health of the session supervisor
+    if supervisor_health:
+        prettyprint.info(f"Session supervisor running with pid {supervisor_health['pid']}")
+        prettyprint.supervisor_health(supervisor_health["components"])
+    elif session.container_state == "running":
+        prettyprint.warning("No session supervisor running")
+
     prettyprint.container_status(session.container_state)
     prettyprint.info("Session status:")
     rich.print(
@@ -779,6 +1448,10 @@ def stop(verbose: bool, dry_run: bool) -> int:
     if session is None:
         return 1
 
+    # The supervisor unmounts the container filesystem and closes the ssh master connection
+    if not dry_run and stop_supervisor(session):
+        prettyprint.action("local", "Stopped", "session supervisor")
+
     # unmount container filesystem
     if session.sshfs_container_mount_point.is_mount():
         with prettyprint.LongAction(
@@ -794,63 +1467,838 @@ def stop(verbose: bool, dry_run: bool) -> int:
             task.set_status("OK")
 
     command = f"docker stop {session.container_name}"
+    engine = open_docker_engine(session, load_user_config().docker_transport)
     with prettyprint.LongAction(
         host="container",
         running_verb="Stopping",
         done_verb="Stopped" if not dry_run else "Would stop",
         running_message=f"container {session.container_name}",
     ) as task:
-        if session.remote_host is None:
+        if engine is not None:
+            retval = run_engine_call(
+                f"POST /containers/{session.container_name}/stop",
+                lambda: engine.stop_container(session.container_name),
+            )
+        elif session.remote_host is None:
             retval = run_local_command(command, cwd=session.local_work_dir)
         else:
             retval = run_remote_command(command, session)
         if retval != 0:
             return retval
+        record_container_state(session, "exited")
         session.container_state = "stopped"
         session.save()
+        index_session(session)
         task.set_status("OK")
     return 0
 
 
+def show_snapshots(session: Session) -> None:
+    if len(session.snapshots) == 0:
+        prettyprint.info("No snapshots")
+        return
+    now = time.time()
+    prettyprint.docker_table(
+        ["snapshot", "image", "parent", "created", "message"],
+        [
+            (
+                f"{snapshot.name} *" if snapshot.name == session.snapshot else snapshot.name,
+                snapshot.image_tag,
+                snapshot.parent,
+                prettyprint.format_age(snapshot.created_at, now),
+                snapshot.message or "",
+            )
+            for snapshot in session.snapshots
+        ],
+    )
+    if session.snapshot is not None:
+        prettyprint.info(f"The container was created from snapshot {session.snapshot} (*)")
+
+
+def next_snapshot_name(session: Session) -> str:
+    number = len(session.snapshots) + 1
+    while session.find_snapshot(str(number)) is not None:
+        number += 1
+    return str(number)
+
+
 @cli.command()
+@click.argument("name", type=str, required=False)
+@click.option("-m", "--message", type=str, default=None, help="Describe the snapshot")
+@click.option("--list", "list_snapshots", is_flag=True, help="List the snapshots of the session")
 @click.option("-v", "--verbose", is_flag=True, help="Print commands")
 @click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
-def history(verbose: bool, dry_run: bool) -> int:
-    """Show the history of a container"""
+def snapshot(name: Optional[str], message: Optional[str], list_snapshots: bool, verbose: bool, dry_run: bool) -> int:
+    """
+    Commit the state of the container as a snapshot
+
+    Only the changes since the image the container was created from are committed, as a single new layer.
+    The image is committed on the host of the container: nothing is transferred.
+    Named 1, 2, 3, ... by default.
+    """
     set_execution_mode(verbose, dry_run)
     session = load_session()
     if session is None:
         return 1
+    if list_snapshots:
+        show_snapshots(session)
+        return 0
+    if session.image_tag is None:
+        prettyprint.error("Must 'dockerdo build' first")
+        return 1
+    if name is None:
+        name = next_snapshot_name(session)
+    elif not RE_SNAPSHOT_NAME.match(name):
+        prettyprint.error(f"Invalid snapshot name {name}: use letters, digits, '_', '.' and '-'")
+        return 1
+    elif session.find_snapshot(name) is not None:
+        prettyprint.error(f"Snapshot {name} already exists")
+        return 1
+    user_config = load_user_config()
+    engine = open_docker_engine(session, user_config.docker_transport)
+    host_status = query_host_status(session, container=session.container_name) if engine is None else None
+    verify_container_state(session, max_age=user_config.container_state_ttl, engine=engine, host_status=host_status)
+    if session.container_state == "nothing":
+        prettyprint.error("No container to snapshot: must 'dockerdo run' first")
+        return 1
 
-    if len(session.env) > 0:
-        prettyprint.info("Environment variables:")
-        for key, value in session.env.items():
-            print(f"{key}={value}")
-    if session.record_inotify:
-        prettyprint.info("Modified files:")
-        for file in session.get_modified_files():
-            print(file)
-    else:
-        prettyprint.info("Recording of modified files is disabled")
-    prettyprint.info("Command history:")
-    prettyprint.command_history(session.get_command_history())
+    parent = session.container_image
+    assert parent is not None
+    image_tag = session.snapshot_tag(name)
+    host: Literal["local", "remote"] = "local" if session.remote_host is None else "remote"
+    with prettyprint.LongAction(
+        host=host,
+        running_verb="Committing",
+        done_verb="Committed" if not dry_run else "Would commit",
+        running_message=f"snapshot {name} of container {session.container_name}",
+    ) as task:
+        if engine is not None:
+            repository, tag = split_image_reference(image_tag)
+            retval = run_engine_call(
+                f"POST /commit {session.container_name}",
+                lambda: engine.commit_container(session.container_name, repository, tag),
+            )
+        else:
+            retval = run_on_host(
+                f"sh -c 'docker commit {session.container_name} {image_tag} > /dev/null'", session
+            )
+        if retval != 0:
+            return retval
+        task.set_status("OK")
+    if dry_run:
+        return 0
+    session.snapshots.append(
+        Snapshot(name=name, image_tag=image_tag, parent=parent, created_at=time.time(), message=message)
+    )
+    session.save()
     return 0
 
 
 @cli.command()
-@click.option("-f", "--force", is_flag=True, help="Force removal of container")
-@click.option("--delete", is_flag=True, help="Delete session directory")
-@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.argument("name", type=str, required=False)
+@click.option("--base", is_flag=True, help="Restore the image of the session, without any snapshot")
+@click.option("--record", is_flag=True, help="Record filesystem events")
+@click.option("--exec-server", is_flag=True, help="Run commands through an exec server in the container")
+@click.option(
+    "--remote-delay",
+    type=float,
+    default=None,
+    help="Delay to add to all remote commands, to allow slow sshfs to catch up",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
 @click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
-def rm(force: bool, delete: bool, verbose: bool, dry_run: bool) -> int:
-    """Remove a container"""
+def restore(
+    name: Optional[str],
+    base: bool,
+    record: bool,
+    exec_server: bool,
+    remote_delay: Optional[float],
+    verbose: bool,
+    dry_run: bool,
+) -> int:
+    """
+    Replace the container with a new one, created from a snapshot
+
+    Restores the latest snapshot, unless a name is given.
+    The container must be stopped first. Later runs of the session also start from the snapshot.
+
+    Always run this command backgrounded, by adding an ampersand (&) at the end.
+    """
     set_execution_mode(verbose, dry_run)
     session = load_session()
     if session is None:
         return 1
-    verify_container_state(session)
+    restored: Optional[Snapshot] = None
+    if not base:
+        if len(session.snapshots) == 0:
+            prettyprint.error("No snapshots: must 'dockerdo snapshot' first")
+            return 1
+        restored = session.find_snapshot(name) if name is not None else session.snapshots[-1]
+        if restored is None:
+            prettyprint.error(f"No snapshot named {name}")
+            return 1
+    user_config = load_user_config()
+    engine = open_docker_engine(session, user_config.docker_transport)
+    host_status = query_host_status(session, container=session.container_name) if engine is None else None
+    verify_container_state(session, max_age=user_config.container_state_ttl, engine=engine, host_status=host_status)
+    if session.container_state == "running":
+        prettyprint.error(f"Container {session.container_name} is running: must 'dockerdo stop' first")
+        return 1
 
-    if session.remote_host is not None:
+    if session.container_state == "stopped":
+        with prettyprint.LongAction(
+            host="container",
+            running_verb="Removing",
+            done_verb="Removed" if not dry_run else "Would remove",
+            running_message=f"container {session.container_name}",
+        ) as task:
+            if engine is not None:
+                retval = run_engine_call(
+                    f"DELETE /containers/{session.container_name}",
+                    lambda: engine.remove_container(session.container_name),
+                )
+            else:
+                retval = run_on_host(f"docker rm {session.container_name}", session, silent=True)
+            if retval != 0:
+                return retval
+            record_container_state(session, None)
+            task.set_status("OK")
+        session.container_state = "nothing"
+    session.snapshot = restored.name if restored is not None else None
+    # The port registry hands back the port of the removed container
+    session.ssh_port_on_remote_host = None
+    if not dry_run:
+        session.save()
+        index_session(session)
+    docker_run_args = session.docker_run_args.split() if session.docker_run_args is not None else []
+    return run_or_start(
+        docker_command="run",
+        docker_args=docker_run_args,
+        record=record,
+        remote_delay=remote_delay,
+        verbose=verbose,
+        dry_run=dry_run,
+        session=session,
+        exec_server=exec_server,
+    )
+
+
+@cli.command()
+@click.option(
+    "--path", "path_prefix", type=Path, default=None, help="Only show history under this path in the container"
+)
+@click.option("--since", type=click.DateTime(), default=None, help="Only show commands run after this time")
+@click.option("--until", type=click.DateTime(), default=None, help="Only show commands run before this time")
+@click.option("--match", "pattern", type=str, default=None, help="Only show commands matching this glob, e.g. 'apt*'")
+@click.option("--all", "include_failed", is_flag=True, help="Also show commands that failed")
+@click.option("--limit", type=int, default=None, help="Show at most this many commands")
+@click.option("--offset", type=int, default=0, help="Skip this many commands")
+@click.option("--dockerfile", is_flag=True, help="Synthesize a Dockerfile from the history, instead of listing it")
+@click.option(
+    "-o", "--output", type=Path, default=None, help="With --dockerfile, write the Dockerfile to this file"
+)
+@click.option(
+    "--verify", is_flag=True,
+    help="With --dockerfile and --output, build the Dockerfile, with its directory as the build context",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def history(
+    path_prefix: Optional[Path],
+    since: Optional[datetime],
+    until: Optional[datetime],
+    pattern: Optional[str],
+    include_failed: bool,
+    limit: Optional[int],
+    offset: int,
+    dockerfile: bool,
+    output: Optional[Path],
+    verify: bool,
+    verbose: bool,
+    dry_run: bool,
+) -> int:
+    """Show the history of a container"""
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    if dockerfile:
+        rows = session.get_command_history(
+            path_prefix=path_prefix,
+            since=since.timestamp() if since is not None else None,
+            until=until.timestamp() if until is not None else None,
+            pattern=pattern,
+            successful_only=True,
+            limit=limit,
+            offset=offset,
+        )
+        content = format_history_dockerfile(
+            base_image=session.base_image,
+            commands=[(row["command"], Path(row["cwd"])) for row in rows],
+            env=session.env,
+            modified_files=list(session.get_modified_files(path_prefix=path_prefix)),
+        )
+        return write_history_dockerfile(session, content, output, verify, dry_run)
+    elif output is not None or verify:
+        prettyprint.error("--output and --verify require --dockerfile")
+        return 1
+
+    if len(session.env) > 0:
+        prettyprint.info("Environment variables:")
+        for key, value in session.env.items():
+            print(f"{key}={value}")
+    if session.record_inotify:
+        prettyprint.info("Modified files:")
+        for file in session.get_modified_files(path_prefix=path_prefix):
+            print(file)
+    else:
+        prettyprint.info("Recording of modified files is disabled")
+    prettyprint.info("Command history:")
+    prettyprint.command_history(
+        session.get_command_history(
+            path_prefix=path_prefix,
+            since=since.timestamp() if since is not None else None,
+            until=until.timestamp() if until is not None else None,
+            pattern=pattern,
+            successful_only=not include_failed,
+            limit=limit,
+            offset=offset,
+        )
+    )
+    return 0
+
+
+@cli.command(name="export-files")
+@click.argument("path_prefixes", nargs=-1, type=Path, metavar="[PATH]...")
+@click.option(
+    "-o", "--output", type=Path, default=Path("."),
+    help=f"Build context directory. The files are written under {COPY_CONTEXT_DIR}/ in it",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def export_files(path_prefixes: List[Path], output: Path, verbose: bool, dry_run: bool) -> int:
+    """
+    Copy the modified files out of the container into a build context
+
+    Only the recorded modified files are copied, optionally only those under the given paths in the container.
+    They are streamed as one tar over the ssh connection. Prints a COPY block for the Dockerfile.
+    """
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    paths = [
+        path for path in session.get_modified_files()
+        if len(path_prefixes) == 0 or any(path.is_relative_to(prefix) for prefix in path_prefixes)
+    ]
+    if len(paths) == 0:
+        if session.record_inotify:
+            prettyprint.info("No modified files recorded")
+        else:
+            prettyprint.info("Recording of modified files is disabled")
+        return 0
+    destination = output / COPY_CONTEXT_DIR
+    ensure_container_connection(session)
+    with prettyprint.LongAction(
+        host="container",
+        running_verb="Exporting",
+        done_verb="Exported" if not dry_run else "Would export",
+        running_message=f"{len(paths)} modified files to {destination}",
+    ) as task:
+        retval, extracted = run_container_tar_export(session, paths, destination)
+        if retval != 0:
+            task.set_status("FAIL")
+            return retval
+        task.set_status("OK")
+    if dry_run:
+        print(format_copy_block(paths))
+        return 0
+    missing = len(paths) - len(extracted)
+    if missing > 0:
+        prettyprint.warning(f"{missing} of the recorded files no longer exist in the container, or are not files")
+    print(format_copy_block([Path("/") / path for path in extracted]))
+    return 0
+
+
+def show_transfer_progress(task: prettyprint.LongAction, message: str, progress: TransferProgress) -> threading.Event:
+    """Update the message of the task with the bytes transferred, until the returned event is set"""
+    done = threading.Event()
+
+    def update() -> None:
+        while not done.wait(PROGRESS_INTERVAL):
+            task.set_message(f"{message}: {prettyprint.format_transfer(progress.byte_count, progress.elapsed)}")
+
+    threading.Thread(target=update, daemon=True).start()
+    return done
+
+
+@cli.command(name="cp")
+@click.argument("sources", nargs=-1, required=True, metavar="SRC...")
+@click.argument("destination", metavar="DST")
+@click.option(
+    "-j", "--jobs", type=click.IntRange(min=1), default=1,
+    help="Tar streams to run in parallel, splitting the files between them",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def copy_files(sources: Tuple[str, ...], destination: str, jobs: int, verbose: bool, dry_run: bool) -> int:
+    """
+    Copy files and directories between the local host, the remote host and the container
+
+    Prefix the paths on the remote host with remote: and those in the container with container:.
+    The sources are copied into the destination directory, which is created if needed.
+    The files are streamed as tar over the ssh master connections, instead of through the sshfs mount.
+    """
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    try:
+        source_locations = [resolve_location(parse_location(source), session) for source in sources]
+        destination_location = resolve_location(parse_location(destination), session)
+        source_hosts = {location.host for location in source_locations}
+        if len(source_hosts) > 1:
+            raise TransferError("All the sources must be on the same host")
+        (source_host,) = source_hosts
+        if "container" in (source_host, destination_location.host):
+            ensure_container_connection(session)
+        shards = group_sources([location.path for location in source_locations])
+        if jobs > 1:
+            shards = [
+                split for shard in shards
+                for split in split_shard(shard, list_transfer_files(source_host, session, shard), jobs)
+            ]
+    except TransferError as e:
+        prettyprint.error(str(e))
+        return 1
+
+    def copy_shard(shard: TransferShard) -> int:
+        return run_tar_stream(source_host, shard, destination_location, session, progress)
+
+    source_text = ", ".join(str(location) for location in source_locations)
+    message = f"{source_text} to {destination_location}"
+    progress = TransferProgress()
+    with prettyprint.LongAction(
+        host=destination_location.host,
+        running_verb="Copying",
+        done_verb="Copied" if not dry_run else "Would copy",
+        running_message=message,
+    ) as task:
+        done = show_transfer_progress(task, message, progress)
+        steps = [Step(f"stream {index}", partial(copy_shard, shard)) for index, shard in enumerate(shards)]
+        retval = first_failure(run_pipeline(steps, max_workers=jobs))
+        done.set()
+        if not dry_run:
+            transfer = prettyprint.format_transfer(progress.byte_count, progress.elapsed)
+            task.set_message(f"{message}: {transfer}", done_message=f"{message}: {transfer}")
+        if retval != 0:
+            task.set_status("FAIL")
+            return retval
+        task.set_status("OK")
+    return 0
+
+
+def run_container_search(program: SearchProgram, args: List[str]) -> int:
+    """
+    Run grep or find in the container, in the directory matching the current directory,
+    streaming back the results with the container paths rewritten to the local sshfs mount
+    """
+    session = load_session()
+    if session is None:
+        return 1
+    container_work_dir = get_container_work_dir(session)
+    if not container_work_dir:
+        prettyprint.error(
+            f"Current working directory is not inside the container mount point {session.sshfs_container_mount_point}"
+        )
+        return 1
+    ensure_container_connection(session)
+    stdout: OutputDestination = sys.stdout.buffer
+    if rewrites_paths(program, args):
+        stdout = LocalPathOutput(sys.stdout.buffer, session.sshfs_container_mount_point)
+    retval, _ = run_container_command_unattended(
+        format_search_command(program, args), session, container_work_dir, stdout=stdout, stderr=sys.stderr.buffer
+    )
+    if isinstance(stdout, LocalPathOutput):
+        stdout.close()
+    return retval
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True, allow_interspersed_args=False))
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def grep(args: List[str]) -> int:
+    """
+    Run grep in the container, with the paths of the matches in the local mount
+
+    The search runs next to the files, instead of reading them through sshfs.
+    All the arguments are passed to grep. Absolute paths in the output are rewritten to the local sshfs mount,
+    relative paths are valid as they are.
+    """
+    return run_container_search("grep", list(args))
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True, allow_interspersed_args=False))
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def find(args: List[str]) -> int:
+    """
+    Run find in the container, with the paths found in the local mount
+
+    The search runs next to the files, instead of listing the directories through sshfs.
+    All the arguments are passed to find. Absolute paths in the output are rewritten to the local sshfs mount,
+    relative paths are valid as they are.
+    """
+    return run_container_search("find", list(args))
+
+
+def find_indexed_session(name: str) -> Optional[Session]:
+    """Load a session by name from the session index"""
+    entries = load_session_index()
+    try:
+        (entry,) = select_sessions(entries, [name], all_running=False)
+    except FanoutError as e:
+        prettyprint.error(str(e))
+        return None
+    return Session.load(entry.session_dir)
+
+
+@cli.command()
+@click.option(
+    "--session", "source_name", type=str, default=None,
+    help="Replay the history of this session, instead of the active session",
+)
+@click.option(
+    "--from", "start", type=click.IntRange(min=1), default=1,
+    help="Start from this command, e.g. to resume after a failure",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def replay(source_name: Optional[str], start: int, verbose: bool, dry_run: bool) -> int:
+    """
+    Replay the command history into the container of the active session
+
+    The successful commands of the history are run in their working directories, with the environment of the session,
+    as one batch over a single connection. Replaying another session reproduces its environment in a new container.
+    """
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    source = find_indexed_session(source_name) if source_name is not None else session
+    if source is None:
+        return 1
+    replay_into_other = source.session_dir != session.session_dir
+    rows = list(source.get_command_history(successful_only=True))
+    commands = [
+        # Quoted like dodo quotes its arguments
+        BatchCommand(command=shlex.join(shlex.split(row["command"])), work_dir=Path(row["cwd"]), line_number=number)
+        for number, row in enumerate(rows, start=1)
+    ][start - 1:]
+    if len(commands) == 0:
+        prettyprint.info("No commands to replay")
+        return 0
+    if dry_run:
+        prettyprint.command_history({"cwd": str(c.work_dir), "command": c.command} for c in commands)
+        prettyprint.action(
+            "container", "Would replay", f"{len(commands)} commands from session {source.name}"
+        )
+        return 0
+    if replay_into_other:
+        for key, value in source.env.items():
+            session.export(key, value)
+        session.save()
+    ensure_container_connection(session)
+    if session.remote_delay > 0.0:
+        trace.sleep(session.remote_delay, reason="remote delay")
+
+    def show_progress(result: BatchResult) -> None:
+        if result.exit_code == 0:
+            progress = f"[{result.command.line_number}/{len(rows)}]"
+            prettyprint.action("container", "Replayed", f"{progress} {result.command.command}")
+
+    retval, results = run_container_batch(
+        commands, session, local_time=time.time() - process_start_time(), on_result=show_progress
+    )
+    if replay_into_other:
+        # The source session already has these commands in its history
+        for result in results:
+            session.record_command(
+                result.command.command, result.command.work_dir, exit_code=result.exit_code, stats=result.stats
+            )
+    if retval == 0:
+        prettyprint.action("container", "Replayed", f"{len(results)} commands from session {source.name}")
+        return 0
+    if len(results) > 0 and results[-1].exit_code != 0:
+        failed = results[-1].command
+        prettyprint.error(f"Command {failed.line_number} exited with status {results[-1].exit_code}: {failed.command}")
+        resume_from = failed.line_number
+    else:
+        resume_from = commands[len(results)].line_number if len(results) < len(commands) else start
+        prettyprint.error(f"Replay interrupted with status {retval}")
+    session_option = f" --session {source.name}" if replay_into_other else ""
+    prettyprint.info(f"To resume, fix the problem and run: dockerdo replay{session_option} --from {resume_from}")
+    return retval
+
+
+def write_history_dockerfile(
+    session: Session, content: str, output: Optional[Path], verify: bool, dry_run: bool
+) -> int:
+    """Print or write the synthesized Dockerfile, optionally checking that it builds"""
+    if output is None:
+        if verify:
+            prettyprint.error("--verify requires --output, the directory of the Dockerfile is the build context")
+            return 1
+        print(content, end="")
+        return 0
+    if not dry_run:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, "w") as fout:
+            fout.write(content)
+    prettyprint.action("local", "Wrote" if not dry_run else "Would write", f"Dockerfile {output}")
+    if not verify:
+        return 0
+    if f"COPY {COPY_CONTEXT_DIR}/ /" in content and not (output.parent / COPY_CONTEXT_DIR).is_dir():
+        prettyprint.warning(f"The modified files are copied from {output.parent / COPY_CONTEXT_DIR}, which is missing")
+    # Layers that did not change are reused from the build cache of earlier verifications
+    tag = f"dockerdo-verify-{session.name}:latest"
+    with prettyprint.LongAction(
+        host="local",
+        running_verb="Building",
+        done_verb="Built" if not dry_run else "Would build",
+        running_message=f"image {tag} from {output}",
+    ) as task:
+        retval = run_local_command(
+            f"docker build -t {tag} -f {output.name} .", cwd=output.parent.resolve()
+        )
+        if retval != 0:
+            task.set_status("FAIL")
+            return retval
+        task.set_status("OK")
+    return 0
+
+
+# The files that dockerdo creates in the session directory
+SESSION_FILES = [
+    "activate",
+    "command_history.jsonl",
+    "command_history.jsonl.migrated",
+    "container_state.json",
+    "docker.sock",
+    "env.list",
+    "exec.sock",
+    "history.sqlite",
+    "modified_files",
+    "modified_files.migrated",
+    "session.yaml",
+    "ssh-socket-container",
+    "ssh-socket-remote",
+    "supervisor.sock",
+]
+CLEANUP_LOCK = "cleanup.lock"
+
+
+def remove_session_files(session_dir: Path) -> bool:
+    """Delete the files that dockerdo created in the session directory, and the directory if nothing else is left"""
+    for file_name in SESSION_FILES:
+        file_path = session_dir / file_name
+        if file_path.exists():
+            file_path.unlink()
+    try:
+        session_dir.rmdir()
+    except OSError:
+        return False
+    return True
+
+
+def execute_cleanup(plan: CleanupPlan, session: Session, sessions: Dict[Path, Session], force: bool) -> int:
+    """
+    Remove everything in the plan, using the ssh connection of one of the sessions on the host.
+    sessions holds the loaded sessions of the plan, by session directory.
+    """
+
+    host: Literal["local", "remote"] = "local" if session.remote_host is None else "remote"
+    if plan.containers:
+        force_flag = "-f " if force else ""
+        retval = run_on_host(f"docker rm {force_flag}{' '.join(plan.containers)}", session, silent=True)
+        if retval != 0:
+            # The sessions are kept, so that the next cleanup tries again
+            prettyprint.error(f"Error removing containers on {plan.host}: {' '.join(plan.containers)}")
+            return retval
+        prettyprint.action("container", "Removed", f"{len(plan.containers)} containers on {plan.host}")
+    retval = 0
+    if plan.images:
+        # An image that is still in use by a container is not removed
+        if run_on_host(f"docker rmi {' '.join(plan.images)}", session, silent=True) != 0:
+            prettyprint.warning(f"Some images on {plan.host} could not be removed")
+            retval = 1
+        else:
+            prettyprint.action(host, "Deleted", f"{len(plan.images)} images on {plan.host}")
+    if plan.tarballs:
+        if run_on_host(f"rm -f {' '.join(plan.tarballs)}", session, silent=True) != 0:
+            prettyprint.warning(f"Error deleting tarballs in {plan.host}:{plan.build_dir}")
+            retval = 1
+        else:
+            prettyprint.action(host, "Deleted", f"{len(plan.tarballs)} tarballs in {plan.host}:{plan.build_dir}")
+    index = SessionIndex(get_user_state_dir())
+    for entry in plan.sessions:
+        # As when removing a single session, the remote host build directory is unmounted first
+        entry_session = sessions[entry.session_dir]
+        sshfs_remote_mount_point = entry_session.sshfs_remote_mount_point
+        if sshfs_remote_mount_point is not None and sshfs_remote_mount_point.is_mount():
+            command = f"fusermount -u {sshfs_remote_mount_point}"
+            if run_local_command(command, cwd=entry_session.local_work_dir, silent=True) != 0:
+                prettyprint.warning(f"Error unmounting {sshfs_remote_mount_point}: session {entry.name} kept")
+                retval = 1
+                continue
+            prettyprint.action("local", "Unmounted", f"remote host build directory of session {entry.name}")
+        release_ports(get_user_state_dir(), entry.session_dir)
+        if remove_session_files(entry.session_dir):
+            index.remove(entry.session_dir)
+            prettyprint.action("local", "Deleted", f"session {entry.name}")
+        else:
+            prettyprint.warning(f"There are extraneous files in {entry.session_dir}: not deleted")
+            retval = 1
+    index.close()
+    return retval
+
+
+def remove_sessions(remove_all: bool, idle_days: float, force: bool, jobs: int, dry_run: bool) -> int:
+    """
+    Garbage collect the sessions that are stale (or all of them), and the images and tarballs left behind.
+    Hosts are checked and cleaned up in parallel. Never prompts, and only one cleanup runs at a time,
+    so that it can be run from cron.
+    """
+    state_dir = get_user_state_dir()
+    state_dir.mkdir(parents=True, exist_ok=True)
+    with open(state_dir / CLEANUP_LOCK, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            prettyprint.info("Another cleanup is already running")
+            return 0
+        entries = load_session_index(dry_run)
+
+        groups: Dict[PlanKey, List[IndexedSession]] = {}
+        representatives: Dict[PlanKey, Session] = {}
+        sessions: Dict[Path, Session] = {}
+        for entry in entries:
+            try:
+                session = Session.load(entry.session_dir)
+            except (OSError, ValueError, TypeError, yaml.YAMLError):
+                prettyprint.warning(f"Could not load session {entry.name}: left alone")
+                continue
+            sessions[entry.session_dir] = session
+            # Tarballs are left in the build directory of each session
+            key = (entry.host, session.remote_host_build_dir if session.remote_host is not None else None)
+            groups.setdefault(key, []).append(entry)
+            representatives.setdefault(key, session)
+        host_statuses: Dict[PlanKey, Optional[HostStatus]] = {}
+
+        def check(key: PlanKey) -> int:
+            session = representatives[key]
+            with trace.span("check host", "cleanup", host=key[0]):
+                if session.remote_host is None:
+                    host_status = query_local_status(helper_queries(all_images=True, all_containers=True))
+                else:
+                    # A dry run does not install the helper: a host without it is not checked
+                    host_status = query_host_status(
+                        session, all_images=True, all_containers=True, tarballs=True, install_helper=not dry_run
+                    )
+            host_statuses[key] = host_status
+            return 0 if host_status is not None else 1
+
+        # One helper query per host and build directory
+        run_pipeline([Step(f"check {key}", partial(check, key)) for key in groups], max_workers=jobs)
+        plans, skipped = plan_cleanup(
+            groups, host_statuses, now=time.time(), max_idle=idle_days * 86400, remove_all=remove_all
+        )
+        for host in skipped:
+            prettyprint.warning(f"Could not check {host}: its sessions are left alone")
+        if len(plans) == 0:
+            prettyprint.info("Nothing to clean up")
+            return 0
+        prettyprint.docker_table(
+            ["host", "build dir", "sessions", "containers", "images", "tarballs", "reclaimable"],
+            [
+                (
+                    plan.host,
+                    str(plan.build_dir) if plan.build_dir is not None else "-",
+                    " ".join(entry.name for entry in plan.sessions) or "-",
+                    str(len(plan.containers)),
+                    str(len(plan.images)),
+                    str(len(plan.tarballs)),
+                    prettyprint.format_bytes(plan.reclaimable_bytes),
+                )
+                for plan in plans
+            ],
+        )
+        total = sum(plan.reclaimable_bytes for plan in plans)
+        prettyprint.info(
+            f"{'Would reclaim' if dry_run else 'Reclaiming'} {prettyprint.format_bytes(total)}"
+            " of images and tarballs"
+        )
+        if dry_run:
+            return 0
+        results = run_pipeline(
+            [
+                Step(f"clean {plan.host}:{plan.build_dir}", partial(
+                    execute_cleanup, plan, representatives[(plan.host, plan.build_dir)], sessions, force
+                ))
+                for plan in plans
+            ],
+            max_workers=jobs,
+        )
+        return first_failure(results)
+
+
+@cli.command()
+@click.option("-f", "--force", is_flag=True, help="Force removal of container")
+@click.option("--delete", is_flag=True, help="Delete session directory")
+@click.option("--stale", is_flag=True, help="Remove all stale sessions, and their images and tarballs")
+@click.option("--all", "remove_all", is_flag=True, help="Remove all sessions, and their images and tarballs")
+@click.option(
+    "--idle-days", type=float, default=None,
+    help="With --stale: sessions unused this long are stale [default: stale_after_days in the user config]",
+)
+@click.option("-j", "--jobs", type=int, default=MAX_WORKERS, help="Number of hosts to clean up in parallel")
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def rm(
+    force: bool,
+    delete: bool,
+    stale: bool,
+    remove_all: bool,
+    idle_days: Optional[float],
+    jobs: int,
+    verbose: bool,
+    dry_run: bool,
+) -> int:
+    """
+    Remove a container
+
+    With --stale or --all, removes many sessions at once, across all hosts.
+    """
+    if stale or remove_all:
+        # The hosts are checked even in a dry run, to report what would be reclaimed.
+        # Nothing is removed, and neither the index nor the hosts are changed.
+        set_execution_mode(verbose, dry_run_mode=False)
+        if idle_days is None:
+            idle_days = load_user_config().stale_after_days
+        return remove_sessions(remove_all, idle_days, force=force, jobs=jobs, dry_run=dry_run)
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    user_config = load_user_config()
+    engine = open_docker_engine(session, user_config.docker_transport)
+    # Check the container and the image in a single round trip
+    host_status = query_host_status(
+        session, image=session.image_tag if delete else None, container=session.container_name
+    ) if engine is None else None
+    verify_container_state(session, max_age=user_config.container_state_ttl, engine=engine, host_status=host_status)
+
+    group = prettyprint.ActionGroup()
+
+    def unmount_remote() -> int:
         # Unmount remote host build directory
         sshfs_remote_mount_point = session.sshfs_remote_mount_point
         assert sshfs_remote_mount_point is not None
@@ -860,14 +2308,20 @@ def rm(force: bool, delete: bool, verbose: bool, dry_run: bool) -> int:
                 running_verb="Unmounting",
                 done_verb="Unmounted" if not dry_run else "Would unmount",
                 running_message="remote host build directory",
+                group=group,
             ) as task:
                 run_local_command(
                     f"fusermount -u {sshfs_remote_mount_point}",
                     cwd=session.local_work_dir,
                 )
                 task.set_status("OK")
+        return 0
 
-    if session.container_state != "nothing":
+    def remove_container() -> int:
+        if session.container_state == "nothing":
+            return 0
+        if not dry_run:
+            stop_supervisor(session)
         force_flag = "-f" if force else ""
         command = f"docker rm {force_flag} {session.container_name}"
         with prettyprint.LongAction(
@@ -875,65 +2329,79 @@ def rm(force: bool, delete: bool, verbose: bool, dry_run: bool) -> int:
             running_verb="Removing",
             done_verb="Removed" if not dry_run else "Would remove",
             running_message=f"container {session.container_name}",
+            group=group,
         ) as task:
-            if session.remote_host is None:
+            if engine is not None:
+                retval = run_engine_call(
+                    f"DELETE /containers/{session.container_name}",
+                    lambda: engine.remove_container(session.container_name, force=force),
+                )
+            elif session.remote_host is None:
                 retval = run_local_command(command, cwd=session.local_work_dir, silent=True)
             else:
                 retval = run_remote_command(command, session)
             if retval != 0:
                 return retval
+            record_container_state(session, None)
+            release_ports(get_user_state_dir(), session.session_dir)
             session.container_state = "nothing"
             session.save()
+            index_session(session)
             task.set_status("OK")
+        return 0
 
-    if delete:
-        # Delete the image
-        if session.image_tag is not None:
-            host: Literal["local", "remote"] = "local" if session.remote_host is None else "remote"
-            with prettyprint.LongAction(
-                host=host,
-                running_verb="Deleting",
-                done_verb="Deleted" if not dry_run else "Would delete",
-                running_message=f"image {session.image_tag}",
-            ) as task:
-                if session.remote_host is not None:
-                    retval = run_remote_command(
-                        f"docker rmi {session.image_tag}", session
-                    )
-                else:
-                    retval = run_local_command(
-                        f"docker rmi {session.image_tag}", cwd=session.local_work_dir, silent=True
-                    )
-                if retval != 0:
-                    return retval
-                task.set_status("OK")
+    def delete_image() -> int:
+        image_missing = host_status is not None and host_status.images is not None and not host_status.has_image()
+        if image_missing:
+            prettyprint.info(f"Image {session.image_tag} not found on remote host")
+            return 0
+        if session.image_tag is None:
+            return 0
+        host: Literal["local", "remote"] = "local" if session.remote_host is None else "remote"
+        # Snapshots are layered on top of the image of the session
+        image_tags = [snapshot.image_tag for snapshot in reversed(session.snapshots)] + [session.image_tag]
+        running_message = f"image {session.image_tag}"
+        if len(session.snapshots) > 0:
+            running_message += f" and {len(session.snapshots)} snapshots"
+        with prettyprint.LongAction(
+            host=host,
+            running_verb="Deleting",
+            done_verb="Deleted" if not dry_run else "Would delete",
+            running_message=running_message,
+            group=group,
+        ) as task:
+            if engine is not None:
+                retval = 0
+                for image_tag in image_tags:
+                    retval = run_engine_call(
+                        f"DELETE /images/{image_tag}", partial(engine.remove_image, image_tag)
+                    ) or retval
+            elif session.remote_host is not None:
+                retval = run_remote_command(
+                    f"docker rmi {' '.join(image_tags)}", session
+                )
+            else:
+                retval = run_local_command(
+                    f"docker rmi {' '.join(image_tags)}", cwd=session.local_work_dir, silent=True
+                )
+            if retval != 0:
+                return retval
+            task.set_status("OK")
+        return 0
 
-        # Delete session directory
+    def delete_session_dir() -> int:
         with prettyprint.LongAction(
             host="local",
             running_verb="Deleting",
             done_verb="Deleted" if not dry_run else "Would delete",
             running_message=f"session directory {session.session_dir}",
+            group=group,
         ) as task:
             if not dry_run:
-                # delete the expected directory contents first
-                for file_name in [
-                    "activate",
-                    "command_history.jsonl",
-                    "env.list",
-                    "modified_files",
-                    "session.yaml",
-                    "ssh-socket-container",
-                    "ssh-socket-remote",
-                ]:
-                    file_path = session.session_dir / file_name
-                    if file_path.exists():
-                        file_path.unlink()
-                # Now the directory should be empty, so we can delete it
-                try:
-                    session.session_dir.rmdir()
+                if remove_session_files(session.session_dir):
+                    index_session(session, remove=True)
                     task.set_status("OK")
-                except OSError:
+                else:
                     prettyprint.error(f"There are extraneous files in {session.session_dir}")
                     for file in session.session_dir.iterdir():
                         print(file)
@@ -941,6 +2409,22 @@ def rm(force: bool, delete: bool, verbose: bool, dry_run: bool) -> int:
                     return 1
             else:
                 task.set_status("OK")
+        return 0
+
+    # The image can only be deleted after the container,
+    # and the session directory holds the sockets used by all the other steps
+    steps = [
+        Step("remove_container", remove_container),
+    ]
+    if session.remote_host is not None:
+        steps.append(Step("unmount_remote", unmount_remote))
+    if delete:
+        steps.append(Step("delete_image", delete_image, ("remove_container",)))
+        steps.append(Step("delete_session_dir", delete_session_dir, tuple(step.name for step in steps)))
+    with group:
+        retval = first_failure(run_pipeline(steps))
+    if retval != 0:
+        return retval
 
     if session.remote_host is not None:
         prettyprint.info("Remember to foreground and close the ssh master process")
@@ -948,5 +2432,98 @@ def rm(force: bool, delete: bool, verbose: bool, dry_run: bool) -> int:
     return 0
 
 
+@cli.group()
+def pool() -> None:
+    """
+    Pool of pre-started containers
+
+    When pool_size is set in the user config, dockerdo run claims a container from the pool,
+    and tops up the pool in the background.
+    """
+
+
+@pool.command(name="fill")
+@click.option("--size", type=int, default=None, help="Number of containers [default: pool_size in the user config]")
+@click.option("-j", "--jobs", type=int, default=MAX_WORKERS, help="Number of containers to start in parallel")
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def pool_fill(size: Optional[int], jobs: int, verbose: bool, dry_run: bool) -> int:
+    """Start containers for the image of the session, until the pool is full"""
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    if session.image_tag is None:
+        prettyprint.error("Must 'dockerdo build' first")
+        return 1
+    user_config = load_user_config()
+    size = size if size is not None else user_config.pool_size
+    return fill_pool(session, user_config, size, jobs=jobs, dry_run=dry_run)
+
+
+@pool.command(name="ls")
+def pool_ls() -> int:
+    """List the containers in the pool"""
+    now = time.time()
+    containers = load_pool(get_user_state_dir()).containers
+    if len(containers) == 0:
+        prettyprint.info("The pool is empty")
+        return 0
+    prettyprint.docker_table(
+        ["host", "image", "docker run args", "container", "port", "started"],
+        [
+            (
+                container.host,
+                container.image_tag,
+                container.docker_run_args or "-",
+                container.container_name,
+                str(container.port),
+                prettyprint.format_age(container.created_at, now),
+            )
+            for container in containers
+        ],
+    )
+    return 0
+
+
+@pool.command(name="drain")
+@click.option("-v", "--verbose", is_flag=True, help="Print commands")
+@click.option("-n", "--dry-run", is_flag=True, help="Do not execute commands")
+def pool_drain(verbose: bool, dry_run: bool) -> int:
+    """Remove the pooled containers for the image of the session"""
+    set_execution_mode(verbose, dry_run)
+    session = load_session()
+    if session is None:
+        return 1
+    state_dir = get_user_state_dir()
+    host = session.remote_host if session.remote_host is not None else "localhost"
+    drained = [
+        container for container in load_pool(state_dir).containers
+        if container.host == host and container.image_tag == session.image_tag
+    ]
+    if len(drained) == 0:
+        prettyprint.info("No pooled containers for this session")
+        return 0
+    names = [container.container_name for container in drained]
+    with prettyprint.LongAction(
+        host="container",
+        running_verb="Removing",
+        done_verb="Removed" if not dry_run else "Would remove",
+        running_message=f"{len(names)} pooled containers",
+    ) as task:
+        if not dry_run:
+            # Out of the pool first, so that they are not claimed meanwhile
+            remove_containers(state_dir, names)
+        retval = run_on_host(f"docker rm -f {' '.join(names)}", session, silent=True)
+        if not dry_run:
+            for name in names:
+                release_ports(state_dir, port_owner_dir(state_dir, name))
+                shutil.rmtree(port_owner_dir(state_dir, name), ignore_errors=True)
+        if retval != 0:
+            return retval
+        task.set_status("OK")
+    return 0
+
+
 if __name__ == "__main__":
     sys.exit(cli())  # pragma: no cover
@@ -0,0 +1,179 @@
+"""Minimal client for the Docker Engine API over a unix socket"""
+
+import http.client
+import json
+import queue
+import socket
+from pathlib import Path
+from typing import Optional, Any, Dict, List, Iterable
+from urllib.parse import quote, urlencode
+
+API_VERSION = "v1.41"
+POOL_SIZE = 4
+STREAM_CHUNK_SIZE = 1 << 20
+
+
+class DockerEngineError(Exception):
+    """Error response from the Docker Engine API"""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix domain socket"""
+
+    def __init__(self, socket_path: Path, timeout: Optional[float] = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(str(self.socket_path))
+        self.sock = sock
+
+
+class DockerEngine:
+    """
+    Talks to the Docker Engine API through a unix socket, which may be forwarded from a remote host.
+    Connections are kept alive and reused, so each call costs a single round trip.
+    """
+
+    def __init__(self, socket_path: Path, timeout: Optional[float] = 60.0) -> None:
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._pool: "queue.LifoQueue[UnixHTTPConnection]" = queue.LifoQueue(maxsize=POOL_SIZE)
+
+    def _acquire(self) -> UnixHTTPConnection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def _release(self, connection: UnixHTTPConnection) -> None:
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Optional[Any] = None,
+        stream: Optional[Iterable[bytes]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        """
+        Make an API call, and return the decoded json response (None for empty responses).
+        Either body (json encoded) or stream (sent with chunked transfer encoding) can be given.
+        """
+        url = f"/{API_VERSION}{path}"
+        if params:
+            url = f"{url}?{urlencode(params)}"
+        request_headers = dict(headers) if headers else {}
+        encoded: Any = None
+        if body is not None:
+            encoded = json.dumps(body).encode("utf-8")
+            request_headers["Content-Type"] = "application/json"
+        elif stream is not None:
+            encoded = stream
+            request_headers.setdefault("Content-Type", "application/x-tar")
+        # A pooled connection may have been closed by the server: retry once on a fresh connection
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                connection.request(
+                    method, url, body=encoded, headers=request_headers, encode_chunked=stream is not None
+                )
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.RemoteDisconnected, http.client.CannotSendRequest):
+                connection.close()
+                if attempt == 0 and stream is None:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            break
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get("message", "")
+            except ValueError:
+                message = data.decode("utf-8", errors="replace")
+            raise DockerEngineError(response.status, message)
+        if len(data) == 0:
+            return None
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            try:
+                return json.loads(data)
+            except ValueError:
+                # Streaming endpoints return a sequence of json objects
+                return [json.loads(line) for line in data.splitlines() if line.strip()]
+        return data.decode("utf-8", errors="replace")
+
+    def ping(self) -> bool:
+        try:
+            return self.request("GET", "/_ping") == "OK"
+        except (OSError, DockerEngineError, http.client.HTTPException):
+            return False
+
+    def containers(self, name: Optional[str] = None, all: bool = True) -> List[Dict[str, Any]]:
+        """List containers, optionally with an exact name match"""
+        params: Dict[str, Any] = {"all": "1" if all else "0"}
+        if name is not None:
+            params["filters"] = json.dumps({"name": [f"^/{name}$"]})
+        result = self.request("GET", "/containers/json", params=params)
+        return list(result) if result else []
+
+    def start_container(self, name: str) -> None:
+        self.request("POST", f"/containers/{quote(name)}/start")
+
+    def stop_container(self, name: str) -> None:
+        self.request("POST", f"/containers/{quote(name)}/stop")
+
+    def remove_container(self, name: str, force: bool = False) -> None:
+        self.request("DELETE", f"/containers/{quote(name)}", params={"force": "1" if force else "0"})
+
+    def commit_container(self, name: str, repository: str, tag: str) -> None:
+        """Create an image from the changes in the container. The container is paused while committing."""
+        self.request("POST", "/commit", params={"container": name, "repo": repository, "tag": tag, "pause": "1"})
+
+    def images(self, reference: Optional[str] = None) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {}
+        if reference is not None:
+            params["filters"] = json.dumps({"reference": [reference]})
+        result = self.request("GET", "/images/json", params=params)
+        return list(result) if result else []
+
+    def remove_image(self, reference: str) -> None:
+        self.request("DELETE", f"/images/{quote(reference, safe='/:')}")
+
+    def load_image(self, stream: Iterable[bytes]) -> Any:
+        """Load an image from a (possibly compressed) tarball, streamed from the iterable"""
+        return self.request("POST", "/images/load", params={"quiet": "1"}, stream=stream)
+
+
+def container_entry_names(entry: Dict[str, Any]) -> List[str]:
+    """Names of a container in an API listing, without the leading slash"""
+    names = entry.get("Names", [])
+    if isinstance(names, str):
+        names = names.split(",")
+    return [name.lstrip("/") for name in names]
@@ -0,0 +1,223 @@
+"""
+Exec server, run inside the container by the session supervisor, reachable through the ssh master connection.
+
+Each connection runs one command: the server forks and execs the shell in the working directory given in the request,
+streams the output back and reports the exit status. The environment is that of the ssh login of the server,
+the session environment is exported by the command itself. This saves the ssh channel, the login shell
+and the writing and sourcing of the env file of every dodo.
+
+The script is sent to the container on the command line, and only uses the standard library of python3.
+The server exits when its stdin is closed, i.e. when the supervisor stops it.
+
+Protocol: the client sends the request as a length-prefixed json object, then stdin frames.
+The server answers with frames. A frame is a type byte, a 4-byte big-endian length, and the payload.
+"""
+
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import IO, Any, Dict, Optional, Tuple
+
+FRAME_HEADER = struct.Struct(">cI")
+# Client to server: stdin data, an empty frame closes stdin
+FRAME_STDIN = b"i"
+# Server to client
+FRAME_STARTED = b"s"
+FRAME_STDOUT = b"o"
+FRAME_STDERR = b"e"
+FRAME_EXIT = b"x"
+CHUNK_SIZE = 1 << 16
+REMOTE_SOCKET = "/tmp/dockerdo-exec.sock"
+
+
+def recv_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    """Read exactly size bytes, or None if the connection is closed first"""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def send_frame(sock: socket.socket, frame_type: bytes, payload: bytes = b"") -> None:
+    sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> Optional[Tuple[bytes, bytes]]:
+    """Returns (type, payload), or None if the connection is closed"""
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    frame_type, length = FRAME_HEADER.unpack(header)
+    payload = recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return frame_type, payload
+
+
+def send_request(sock: socket.socket, request: Dict[str, Any]) -> None:
+    data = json.dumps(request).encode("utf-8")
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+
+def recv_request(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    header = recv_exactly(sock, 4)
+    if header is None:
+        return None
+    data = recv_exactly(sock, struct.unpack(">I", header)[0])
+    if data is None:
+        return None
+    return dict(json.loads(data.decode("utf-8")))
+
+
+def exit_status(returncode: int) -> int:
+    """Report death by a signal like the shell does"""
+    return 128 - returncode if returncode < 0 else returncode
+
+
+class Connection:
+    """Runs the command requested on one connection"""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.process: Optional[subprocess.Popen] = None
+
+    def send(self, frame_type: bytes, payload: bytes = b"") -> None:
+        with self.lock:
+            try:
+                send_frame(self.sock, frame_type, payload)
+            except OSError:
+                # The client went away: the command is killed by the stdin thread
+                pass
+
+    def pump(self, stream: IO[bytes], frame_type: bytes) -> None:
+        while True:
+            chunk = os.read(stream.fileno(), CHUNK_SIZE)
+            if not chunk:
+                return
+            self.send(frame_type, chunk)
+
+    def forward_stdin(self) -> None:
+        """Relay stdin frames. If the client disconnects, the command is killed."""
+        assert self.process is not None
+        stdin = self.process.stdin
+        while True:
+            try:
+                frame = recv_frame(self.sock)
+            except OSError:
+                frame = None
+            if frame is None:
+                if self.process.poll() is None:
+                    try:
+                        os.killpg(self.process.pid, signal.SIGHUP)
+                    except OSError:
+                        pass
+                return
+            frame_type, payload = frame
+            if frame_type != FRAME_STDIN or stdin is None:
+                continue
+            try:
+                if payload:
+                    stdin.write(payload)
+                    stdin.flush()
+                else:
+                    stdin.close()
+                    stdin = None
+            except OSError:
+                # The command exited without reading all of its input
+                stdin = None
+
+    def run(self) -> None:
+        try:
+            request = recv_request(self.sock)
+            if request is None:
+                return
+            shell = os.environ.get("SHELL", "/bin/sh")
+            start = time.time()
+            try:
+                self.process = subprocess.Popen(
+                    [shell, "-c", request["command"]],
+                    cwd=request["cwd"],
+                    stdin=subprocess.PIPE if request.get("stdin") else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True,
+                )
+            except OSError as e:
+                # E.g. the working directory does not exist: fail like cd would
+                self.send(FRAME_STARTED)
+                self.send(FRAME_STDERR, "dockerdo exec server: {}\n".format(e).encode("utf-8"))
+                self.send(FRAME_EXIT, json.dumps({"status": 1, "remote_time": 0.0}).encode("utf-8"))
+                return
+            self.send(FRAME_STARTED)
+            stdin_thread = threading.Thread(target=self.forward_stdin)
+            stdin_thread.daemon = True
+            stdin_thread.start()
+            pumps = [
+                threading.Thread(target=self.pump, args=(self.process.stdout, FRAME_STDOUT)),
+                threading.Thread(target=self.pump, args=(self.process.stderr, FRAME_STDERR)),
+            ]
+            for pump in pumps:
+                pump.daemon = True
+                pump.start()
+            returncode = self.process.wait()
+            for pump in pumps:
+                pump.join()
+            result = {"status": exit_status(returncode), "remote_time": time.time() - start}
+            self.send(FRAME_EXIT, json.dumps(result).encode("utf-8"))
+        finally:
+            self.sock.close()
+
+
+def serve(socket_path: str, stop: Optional[threading.Event] = None) -> None:
+    """Accept connections until stop is set, running each command in its own thread"""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(64)
+    server.settimeout(0.5)
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                sock, _ = server.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(None)
+            thread = threading.Thread(target=Connection(sock).run)
+            thread.daemon = True
+            thread.start()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main() -> None:
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else REMOTE_SOCKET
+    stop = threading.Event()
+
+    def wait_for_eof() -> None:
+        while sys.stdin.buffer.read(CHUNK_SIZE):
+            pass
+        stop.set()
+
+    thread = threading.Thread(target=wait_for_eof)
+    thread.daemon = True
+    thread.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    serve(socket_path, stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Run a command in several sessions at once, with the output of each session prefixed by its name"""
+
+import threading
+from typing import BinaryIO, Dict, List, Sequence
+
+from dockerdo.line_output import LineOutput
+from dockerdo.session_index import IndexedSession
+
+
+class FanoutError(Exception):
+    pass
+
+
+class PrefixedOutput(LineOutput):
+    """
+    Write the output of one session to a destination shared by all sessions, a line at a time,
+    each line prefixed by the name of the session. Lines of concurrent sessions are never mixed.
+    """
+
+    def __init__(self, destination: BinaryIO, prefix: bytes, lock: threading.Lock) -> None:
+        super().__init__(destination, lambda line: prefix + line, lock=lock, end_last_line=True)
+
+
+def select_sessions(entries: List[IndexedSession], names: Sequence[str], all_running: bool) -> List[IndexedSession]:
+    """
+    Select the sessions by name, in the given order, or all the sessions with a running container.
+    The container state is that of the last dockerdo command in each session.
+    """
+    if all_running:
+        return [entry for entry in entries if entry.container_state == "running"]
+    selected = []
+    for name in names:
+        matches = [entry for entry in entries if entry.name == name]
+        if len(matches) == 0:
+            raise FanoutError(f"Unknown session {name}")
+        if len(matches) > 1:
+            raise FanoutError(f"Several sessions are named {name}")
+        if matches[0] not in selected:
+            selected.append(matches[0])
+    return selected
+
+
+def format_prefixes(names: Sequence[str]) -> Dict[str, bytes]:
+    """Prefixes for the output lines of each session, aligned"""
+    width = max((len(name) for name in names), default=0)
+    return {name: f"{name:<{width}} | ".encode("utf-8") for name in names}
@@ -0,0 +1,168 @@
+"""Transfer files to and from the container as tar streams, instead of reading each file through sshfs"""
+
+import shlex
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import IO, Dict, List, Literal, NamedTuple, Sequence
+
+# Python versions with the extraction filters, that refuse members escaping the destination
+HAS_DATA_FILTER = hasattr(tarfile, "data_filter")
+
+
+# Prefixes of the locations of dockerdo cp. Paths without a prefix are local.
+LOCATION_PREFIXES: Dict[str, Literal["remote", "container"]] = {"remote:": "remote", "container:": "container"}
+
+
+class TransferError(Exception):
+    pass
+
+
+class Location(NamedTuple):
+    host: Literal["local", "remote", "container"]
+    path: Path
+
+    def __str__(self) -> str:
+        return str(self.path) if self.host == "local" else f"{self.host}:{self.path}"
+
+
+class TransferShard(NamedTuple):
+    """The files sent as one tar stream: names relative to the root, directories are recursed into"""
+
+    root: Path
+    names: List[str]
+
+
+class TransferProgress:
+    """Bytes transferred by all the streams of a copy, counted as they pass through"""
+
+    def __init__(self) -> None:
+        self.byte_count = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, size: int) -> None:
+        with self._lock:
+            self.byte_count += size
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.start
+
+
+class CountingReader:
+    """Count the bytes read from a stream. Only read is passed through: enough for a tar stream, or a pipe."""
+
+    def __init__(self, stream: IO[bytes], progress: TransferProgress) -> None:
+        self.stream = stream
+        self.progress = progress
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.progress.add(len(data))
+        return data
+
+
+def parse_location(text: str) -> Location:
+    """Parse a location of dockerdo cp: remote:PATH, container:PATH, or a local path"""
+    for prefix, host in LOCATION_PREFIXES.items():
+        if text.startswith(prefix):
+            path = text[len(prefix):]
+            if path == "":
+                raise TransferError(f"No path given in {text}")
+            return Location(host, Path(path))
+    return Location("local", Path(text))
+
+
+def group_sources(sources: Sequence[Path]) -> List[TransferShard]:
+    """One tar stream per parent directory of the sources, which keep their names at the destination"""
+    shards: Dict[Path, List[str]] = {}
+    for source in sources:
+        if source.name in ("", ".", ".."):
+            raise TransferError(f"Can not copy {source}: name the directory to copy instead")
+        shards.setdefault(source.parent, []).append(source.name)
+    return [TransferShard(root, names) for root, names in shards.items()]
+
+
+def split_shard(shard: TransferShard, files: Sequence[str], jobs: int) -> List[TransferShard]:
+    """
+    Split the files listed under the root of the shard into at most jobs streams.
+    The files are dealt out in turn, so that large and small files are spread over the streams.
+    """
+    shards = [TransferShard(shard.root, list(files[index::jobs])) for index in range(jobs)]
+    return [shard for shard in shards if len(shard.names) > 0]
+
+
+def format_tar_pack_script(root: Path) -> str:
+    """Shell script that writes a tar of the names listed on stdin to stdout, relative to the root"""
+    return f"cd {shlex.quote(str(root))} && tar -cf - -T -"
+
+
+def format_tar_unpack_script(destination: Path) -> str:
+    """Shell script that extracts a tar read from stdin into the destination directory, creating it"""
+    quoted = shlex.quote(str(destination))
+    return f"mkdir -p {quoted} && cd {quoted} && tar -xf -"
+
+
+def format_list_files_script(shard: TransferShard) -> str:
+    """
+    Shell script that lists the files under the names of the shard, one per line.
+    Empty directories are listed too, but not the directories that have contents.
+    """
+    names = " ".join(shlex.quote(name) for name in shard.names)
+    return f"cd {shlex.quote(str(shard.root))} && find {names} ! -type d -o -type d -empty"
+
+
+def parse_file_list(output: str) -> List[str]:
+    return [line for line in output.splitlines() if line != ""]
+
+
+def format_tar_create_script(root: Path = Path("/")) -> str:
+    """
+    Shell script that writes a tar of the files listed on stdin to stdout, relative to the root.
+    Files that no longer exist are skipped, and directories are not recursed into.
+    Works with busybox tar.
+    """
+    return (
+        f"cd {shlex.quote(str(root))} && "
+        "while IFS= read -r f; do if [ -f \"$f\" ] || [ -L \"$f\" ]; then printf '%s\\n' \"$f\"; fi; done"
+        " | tar -cf - -T -"
+    )
+
+
+def format_file_list(paths: Sequence[Path]) -> bytes:
+    """The list of files for the tar script, relative to the root"""
+    return "".join(f"{path.relative_to('/') if path.is_absolute() else path}\n" for path in paths).encode("utf-8")
+
+
+def is_safe_member(member: tarfile.TarInfo) -> bool:
+    """Without the extraction filters, only extract plain files and directories inside the destination"""
+    name = Path(member.name)
+    return (member.isfile() or member.isdir()) and not name.is_absolute() and ".." not in name.parts
+
+
+def extract_tar_stream(stream: IO[bytes], destination: Path) -> List[Path]:
+    """
+    Extract a tar stream as it arrives, without buffering it.
+    Returns the paths of the extracted files, relative to the destination.
+    """
+    destination.mkdir(parents=True, exist_ok=True)
+    extracted = []
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as archive:
+            for member in archive:
+                if HAS_DATA_FILTER:
+                    try:
+                        archive.extract(member, destination, filter="data")
+                    except tarfile.FilterError:
+                        continue
+                elif is_safe_member(member):
+                    archive.extract(member, destination)
+                else:
+                    continue
+                if member.isfile() or member.issym():
+                    extracted.append(Path(member.name))
+    except tarfile.ReadError as e:
+        raise TransferError(f"Invalid tar stream: {e}")
+    return extracted
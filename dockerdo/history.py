@@ -0,0 +1,253 @@
+"""Indexed storage for the session history"""
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Optional, Iterator, Dict, Any, List, Tuple
+
+HISTORY_DB = "history.sqlite"
+LEGACY_COMMAND_HISTORY = "command_history.jsonl"
+LEGACY_MODIFIED_FILES = "modified_files"
+MIGRATED_SUFFIX = ".migrated"
+FETCH_SIZE = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL,
+    cwd TEXT NOT NULL,
+    command TEXT NOT NULL,
+    exit_code INTEGER
+);
+CREATE INDEX IF NOT EXISTS commands_cwd ON commands (cwd);
+CREATE INDEX IF NOT EXISTS commands_timestamp ON commands (timestamp);
+CREATE TABLE IF NOT EXISTS modified_files (
+    path TEXT PRIMARY KEY,
+    timestamp REAL
+);
+"""
+
+# Schema changes after the initial version, indexed by the resulting schema version
+SCHEMA_UPGRADES = {
+    2: """
+ALTER TABLE commands ADD COLUMN wall_time REAL;
+ALTER TABLE commands ADD COLUMN local_time REAL;
+ALTER TABLE commands ADD COLUMN ssh_time REAL;
+ALTER TABLE commands ADD COLUMN remote_time REAL;
+ALTER TABLE commands ADD COLUMN stdout_bytes INTEGER;
+ALTER TABLE commands ADD COLUMN stderr_bytes INTEGER;
+""",
+}
+TIMING_COLUMNS = ("wall_time", "local_time", "ssh_time", "remote_time")
+
+
+class ExecStats(BaseModel):
+    """
+    Timing and output volume of a single executed command.
+
+    wall_time = local_time + ssh_time + remote_time.
+    The remote time is measured inside the container, the rest of the time spent in ssh is attributed to ssh.
+    Values that could not be measured are None.
+    """
+
+    wall_time: Optional[float] = None
+    local_time: Optional[float] = None
+    ssh_time: Optional[float] = None
+    remote_time: Optional[float] = None
+    stdout_bytes: Optional[int] = None
+    stderr_bytes: Optional[int] = None
+
+
+def path_prefix_clause(column: str, prefix: Path) -> Tuple[str, List[str]]:
+    """
+    Make an index-friendly SQL clause matching the path prefix and everything below it.
+    The character after '/' in ASCII is '0', so the range [prefix/, prefix0) covers all subpaths.
+    """
+    prefix_str = str(prefix).rstrip("/")
+    if prefix_str == "":
+        return "1", []
+    return (
+        f"({column} = ? OR ({column} >= ? AND {column} < ?))",
+        [prefix_str, f"{prefix_str}/", f"{prefix_str}0"],
+    )
+
+
+class HistoryStore:
+    """SQLite database in the session directory, holding the command history and modified files"""
+
+    def __init__(self, session_dir: Path) -> None:
+        self.session_dir = session_dir
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.session_dir / HISTORY_DB)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.executescript(SCHEMA)
+            self._upgrade_schema()
+            self._migrate_legacy_files()
+        return self._connection
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _upgrade_schema(self) -> None:
+        """Apply the schema changes made since the database was created"""
+        assert self._connection is not None
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        version = int(row["value"]) if row is not None else 1
+        for target_version in sorted(SCHEMA_UPGRADES):
+            if target_version <= version:
+                continue
+            self._connection.executescript(SCHEMA_UPGRADES[target_version])
+            version = target_version
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (str(version),)
+            )
+
+    def _migrate_legacy_files(self) -> None:
+        """One-time import of the append-only files used by older versions of dockerdo"""
+        assert self._connection is not None
+        connection = self._connection
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() is not None:
+            return
+        command_history_path = self.session_dir / LEGACY_COMMAND_HISTORY
+        modified_files_path = self.session_dir / LEGACY_MODIFIED_FILES
+        with connection:
+            if command_history_path.exists():
+                with open(command_history_path, "r") as fin:
+                    for line in fin:
+                        try:
+                            entry = json.loads(line)
+                            cwd, command = entry["cwd"], entry["command"]
+                        except (json.JSONDecodeError, KeyError, TypeError):
+                            # Skipped rather than failing the migration, which would be retried on every run
+                            continue
+                        # Only successful commands were recorded in the legacy file
+                        connection.execute(
+                            "INSERT INTO commands (timestamp, cwd, command, exit_code) VALUES (NULL, ?, ?, 0)",
+                            (cwd, command),
+                        )
+            if modified_files_path.exists():
+                with open(modified_files_path, "r") as fin:
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO modified_files (path, timestamp) VALUES (?, NULL)",
+                        ((line.strip(),) for line in fin if line.strip()),
+                    )
+            connection.execute("INSERT INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+        for path in (command_history_path, modified_files_path):
+            if path.exists():
+                path.rename(path.with_name(path.name + MIGRATED_SUFFIX))
+
+    def record_command(
+        self,
+        command: str,
+        cwd: Path,
+        exit_code: int = 0,
+        stats: Optional[ExecStats] = None,
+        timestamp: Optional[float] = None,
+    ) -> None:
+        """Append a command to the history"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        stats = stats if stats is not None else ExecStats()
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO commands"
+                " (timestamp, cwd, command, exit_code,"
+                " wall_time, local_time, ssh_time, remote_time, stdout_bytes, stderr_bytes)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    timestamp, str(cwd), command, exit_code,
+                    stats.wall_time, stats.local_time, stats.ssh_time, stats.remote_time,
+                    stats.stdout_bytes, stats.stderr_bytes,
+                ),
+            )
+
+    def record_modified_file(self, path: Path, timestamp: Optional[float] = None) -> bool:
+        """Record a modified file. Returns False if the file was already recorded."""
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO modified_files (path, timestamp) VALUES (?, ?)",
+                (str(path), timestamp),
+            )
+        return cursor.rowcount == 1
+
+    def iter_commands(
+        self,
+        path_prefix: Optional[Path] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        pattern: Optional[str] = None,
+        successful_only: bool = False,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Stream the command history in the order the commands were run.
+        The pattern is a glob, matched against the whole command.
+        """
+        clauses: List[str] = []
+        params: List[Any] = []
+        if successful_only:
+            clauses.append("exit_code = 0")
+        if path_prefix is not None:
+            clause, clause_params = path_prefix_clause("cwd", path_prefix)
+            clauses.append(clause)
+            params.extend(clause_params)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        if pattern is not None:
+            clauses.append("command GLOB ?")
+            params.append(pattern)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        query = f"SELECT * FROM commands {where} ORDER BY id LIMIT ? OFFSET ?"
+        params.extend([limit if limit is not None else -1, offset])
+        cursor = self.connection.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+
+    def timings(self, column: str) -> List[float]:
+        """All measured values of a timing column, for computing percentiles"""
+        assert column in TIMING_COLUMNS
+        cursor = self.connection.execute(f"SELECT {column} FROM commands WHERE {column} IS NOT NULL")
+        return [row[0] for row in cursor]
+
+    def slowest_commands(self, limit: int) -> List[Dict[str, Any]]:
+        """The commands with the longest wall time"""
+        cursor = self.connection.execute(
+            "SELECT * FROM commands WHERE wall_time IS NOT NULL ORDER BY wall_time DESC LIMIT ?", (limit,)
+        )
+        return [dict(row) for row in cursor]
+
+    def iter_modified_files(self, path_prefix: Optional[Path] = None) -> Iterator[Path]:
+        """Stream the modified files in sorted order"""
+        if path_prefix is not None:
+            clause, params = path_prefix_clause("path", path_prefix)
+        else:
+            clause, params = "1", []
+        cursor = self.connection.execute(f"SELECT path FROM modified_files WHERE {clause} ORDER BY path", params)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield Path(row["path"])
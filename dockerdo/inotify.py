@@ -1,11 +1,77 @@
-from inotify_simple import INotify, flags   # type: ignore
-from typing import Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from inotify_simple import INotify, Event, flags   # type: ignore
+from typing import Optional, Dict, List, Iterable, Tuple
 from pathlib import Path
+import os
+import time
 
 from dockerdo.config import Session
 from dockerdo import prettyprint
 
-IGNORE_PATHS = {Path(x) for x in ("/proc", "/dev", "/sys")}
+SCAN_WORKERS = 16
+
+
+def is_excluded(path_inside_container: Path, exclude_globs: Iterable[str]) -> bool:
+    """Check if a path inside the container matches any of the exclude globs"""
+    path_str = str(path_inside_container)
+    return any(fnmatch(path_str, pattern) for pattern in exclude_globs)
+
+
+def _scan_one(directory: Path) -> List[Path]:
+    """List the subdirectories of a single directory, without following symlinks"""
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                Path(entry.path) for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+            ]
+    except OSError:
+        return []
+
+
+def scan_directories(
+    mount_point: Path,
+    include_paths: Iterable[Path],
+    exclude_globs: Iterable[str],
+    max_workers: int = SCAN_WORKERS,
+) -> List[Tuple[Path, Path]]:
+    """
+    Walk the container filesystem under mount_point, starting from the include paths.
+
+    Directories are listed concurrently, one level at a time, to hide the latency of sshfs.
+    Directories matching an exclude glob are pruned together with their subtrees.
+    Returns (local path, path inside container) pairs for all found directories.
+    """
+    exclude_globs = list(exclude_globs)
+    result: List[Tuple[Path, Path]] = []
+    seen = set()
+    frontier: List[Path] = []
+    for include_path in include_paths:
+        path_inside_container = Path("/") / include_path
+        local_path = mount_point / path_inside_container.relative_to(Path("/"))
+        if path_inside_container in seen or not local_path.is_dir():
+            continue
+        if is_excluded(path_inside_container, exclude_globs):
+            continue
+        seen.add(path_inside_container)
+        result.append((local_path, path_inside_container))
+        frontier.append(local_path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            next_frontier: List[Path] = []
+            for subdirs in executor.map(_scan_one, frontier):
+                for local_path in subdirs:
+                    path_inside_container = Path("/") / local_path.relative_to(mount_point)
+                    if path_inside_container in seen:
+                        continue
+                    if is_excluded(path_inside_container, exclude_globs):
+                        continue
+                    seen.add(path_inside_container)
+                    result.append((local_path, path_inside_container))
+                    next_frontier.append(local_path)
+            frontier = next_frontier
+    return result
 
 
 class InotifyListener:
@@ -18,41 +84,44 @@ class InotifyListener:
     def register_listeners(self) -> None:
         """
         Register listeners recursively for the session's container mount point.
+        Only the configured include paths are watched, excluding paths matching the exclude globs.
         """
         self.inotify = INotify()
-        for path in self.session.sshfs_container_mount_point.rglob("*"):
-            path_inside_container = Path("/") / path.relative_to(
-                self.session.sshfs_container_mount_point
-            )
-            if any(path_inside_container.is_relative_to(x) for x in IGNORE_PATHS):
-                continue
-            if path.is_dir():
-                try:
-                    wd = self.inotify.add_watch(path, mask=self.watch_flags)
-                    self.watch_descriptors[wd] = path_inside_container
-                except PermissionError:
-                    pass
-                except OSError:
-                    pass
-
-    def listen(self, verbose: bool = False) -> None:
-        if self.inotify is None:
-            raise RuntimeError("Listeners not registered")
-        while self.session.container_state == "running":
-            for event in self.inotify.read(timeout=5000):
-                try:
-                    wd, mask, cookie, name = event
-                    if mask & flags.UNMOUNT:
-                        # Backing filesystem unmounted
-                        if verbose:
-                            prettyprint.info('Backing filesystem unmounted')
-                        return
-                    path = self.watch_descriptors[wd] / name
-                    if not self.session.record_modified_file(path):
-                        continue
+        start_time = time.monotonic()
+        directories = scan_directories(
+            self.session.sshfs_container_mount_point,
+            include_paths=self.session.record_include_paths,
+            exclude_globs=self.session.record_exclude_globs,
+        )
+        scan_time = time.monotonic() - start_time
+        for path, path_inside_container in directories:
+            try:
+                wd = self.inotify.add_watch(path, mask=self.watch_flags)
+                self.watch_descriptors[wd] = path_inside_container
+            except PermissionError:
+                pass
+            except OSError:
+                pass
+        prettyprint.info(
+            f"Watching {len(self.watch_descriptors)} directories"
+            f" (scanned {len(directories)} in {scan_time:.1f} s)"
+        )
+
+    def handle_events(self, events: Iterable[Event], verbose: bool = False) -> bool:
+        """Record the modified files. Returns False if the backing filesystem was unmounted."""
+        for event in events:
+            try:
+                wd, mask, cookie, name = event
+                if mask & flags.UNMOUNT:
+                    # Backing filesystem unmounted
                     if verbose:
-                        prettyprint.info(f"Recorded modified file: {path}")
-                except KeyError:
-                    pass
-            # Reload the session to update the container state
-            self.session = Session.load(self.session.session_dir)
+                        prettyprint.info('Backing filesystem unmounted')
+                    return False
+                path = self.watch_descriptors[wd] / name
+                if not self.session.record_modified_file(path):
+                    continue
+                if verbose:
+                    prettyprint.info(f"Recorded modified file: {path}")
+            except KeyError:
+                pass
+        return True
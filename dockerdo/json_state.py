@@ -0,0 +1,41 @@
+"""State shared by all local sessions, kept as JSON files in the user state directory"""
+
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Iterator, Type, TypeVar
+
+StateT = TypeVar("StateT", bound=BaseModel)
+
+
+def load_state(path: Path, model: Type[StateT]) -> StateT:
+    """
+    Read the state without locking: the file is always replaced atomically.
+    A missing or unreadable file gives the empty state.
+    """
+    try:
+        with open(path, "r") as fin:
+            return model.model_validate_json(fin.read())
+    except (OSError, ValueError):
+        return model()
+
+
+def save_state(path: Path, state: BaseModel) -> None:
+    """Write the state atomically, so that concurrent readers never see a partial file"""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fout:
+        fout.write(state.model_dump_json(indent=2))
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def locked_state(path: Path, lock_path: Path, model: Type[StateT]) -> Iterator[StateT]:
+    """Read, modify and write back the state while holding an exclusive lock on lock_path"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state(path, model)
+        yield state
+        save_state(path, state)
@@ -0,0 +1,54 @@
+"""Output streams that pass on whole lines, each line transformed on the way"""
+
+import threading
+from contextlib import nullcontext
+from typing import BinaryIO, Callable, ContextManager, Optional
+
+
+class LineOutput:
+    """
+    Write to the destination a line at a time, applying transform to each line.
+    Partial lines are held back until they are complete. With a lock shared by several outputs,
+    their lines are never mixed in the destination.
+    """
+
+    def __init__(
+        self,
+        destination: BinaryIO,
+        transform: Callable[[bytes], bytes],
+        lock: Optional[threading.Lock] = None,
+        end_last_line: bool = False,
+    ) -> None:
+        self.destination = destination
+        self.transform = transform
+        self.lock = lock
+        # Add a newline to a last line without one
+        self.end_last_line = end_last_line
+        self.byte_count = 0
+        self._pending = b""
+
+    def _write_lines(self, data: bytes) -> None:
+        lines = b"".join(self.transform(line) for line in data.splitlines(keepends=True))
+        lock: ContextManager = self.lock if self.lock is not None else nullcontext()
+        with lock:
+            self.destination.write(lines)
+            # Lines show up as soon as they are complete, e.g. when piped into an editor
+            self.destination.flush()
+
+    def write(self, data: bytes) -> None:
+        self.byte_count += len(data)
+        pending = self._pending + data
+        end = pending.rfind(b"\n") + 1
+        if end > 0:
+            self._write_lines(pending[:end])
+        self._pending = pending[end:]
+
+    def flush(self) -> None:
+        # Partial lines are held back until they are complete
+        pass
+
+    def close(self) -> None:
+        """Write out a last line without a newline"""
+        if len(self._pending) > 0:
+            self._write_lines(self._pending + b"\n" if self.end_last_line else self._pending)
+            self._pending = b""
@@ -0,0 +1,62 @@
+"""Run the independent steps of a command concurrently"""
+
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Tuple
+
+MAX_WORKERS = 8
+
+
+class Step(NamedTuple):
+    """
+    A step of a command. run returns an exit status, like the commands themselves.
+    The step starts when all the steps it depends on have succeeded.
+    """
+
+    name: str
+    run: Callable[[], int]
+    depends_on: Tuple[str, ...] = ()
+
+
+def run_pipeline(steps: Sequence[Step], max_workers: int = MAX_WORKERS) -> Dict[str, Optional[int]]:
+    """
+    Run the steps as a dependency graph, each step in a thread as soon as its dependencies are done.
+    Returns the exit status of each step. Steps that were skipped, because a dependency failed, get None.
+    The wall time approaches that of the slowest chain of steps, instead of the sum of all steps.
+    """
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        for dependency in step.depends_on:
+            if dependency not in by_name:
+                raise ValueError(f"Step {step.name} depends on unknown step {dependency}")
+    results: Dict[str, Optional[int]] = {}
+    pending = list(steps)
+    running: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            changed = True
+            while changed:
+                changed = False
+                for step in list(pending):
+                    if any(dependency in results and results[dependency] != 0 for dependency in step.depends_on):
+                        # A dependency failed or was skipped
+                        results[step.name] = None
+                    elif all(dependency in results for dependency in step.depends_on):
+                        running[executor.submit(step.run)] = step.name
+                    else:
+                        continue
+                    pending.remove(step)
+                    changed = True
+            if not running:
+                if pending:
+                    names = ", ".join(step.name for step in pending)
+                    raise ValueError(f"Dependency cycle between steps {names}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+def first_failure(results: Dict[str, Optional[int]]) -> int:
+    """The exit status of the command: the first nonzero exit status of its steps"""
+    return next((retval for retval in results.values() if retval), 0)
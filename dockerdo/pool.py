@@ -0,0 +1,84 @@
+"""Pool of pre-started containers, claimed by dockerdo run instead of starting a new container"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from pydantic import BaseModel, Field
+from typing import Iterator, List, Optional
+
+from dockerdo.json_state import load_state, locked_state
+from dockerdo.utils import ephemeral_container_name
+
+POOL_FILE = "pool.json"
+POOL_LOCK = "pool.lock"
+FILL_LOCK = "pool-fill.lock"
+# Owners of the ports of the pooled containers in the port registry
+POOL_OWNERS_DIR = "pool"
+POOL_CONTAINER_PREFIX = "dockerdo-pool-"
+POOL_LABEL = "dockerdo.pool"
+
+
+class PooledContainer(BaseModel):
+    """A running container, started with the given arguments for docker run"""
+
+    host: str
+    image_tag: str
+    docker_run_args: str
+    container_name: str
+    port: int
+    created_at: float
+
+
+class ContainerPool(BaseModel):
+    containers: List[PooledContainer] = Field(default_factory=list)
+
+    def available(self, host: str, image_tag: str, docker_run_args: str) -> List[PooledContainer]:
+        return [
+            container for container in self.containers
+            if container.host == host and container.image_tag == image_tag
+            and container.docker_run_args == docker_run_args
+        ]
+
+
+def pooled_container_name() -> str:
+    return f"{POOL_CONTAINER_PREFIX}{ephemeral_container_name()}"
+
+
+def port_owner_dir(state_dir: Path, container_name: str) -> Path:
+    """Stands in for a session directory in the port registry, as long as the container is in the pool"""
+    return state_dir / POOL_OWNERS_DIR / container_name
+
+
+def load_pool(state_dir: Path) -> ContainerPool:
+    return load_state(state_dir / POOL_FILE, ContainerPool)
+
+
+@contextmanager
+def locked_pool(state_dir: Path) -> Iterator[ContainerPool]:
+    """Read, modify and write back the pool while holding an exclusive lock"""
+    with locked_state(state_dir / POOL_FILE, state_dir / POOL_LOCK, ContainerPool) as pool:
+        yield pool
+
+
+def claim_container(
+    state_dir: Path, host: str, image_tag: str, docker_run_args: str
+) -> Optional[PooledContainer]:
+    """Take the oldest matching container out of the pool. Concurrent claims get different containers."""
+    with locked_pool(state_dir) as pool:
+        available = pool.available(host, image_tag, docker_run_args)
+        if len(available) == 0:
+            return None
+        claimed = min(available, key=lambda container: container.created_at)
+        pool.containers.remove(claimed)
+    return claimed
+
+
+def add_container(state_dir: Path, container: PooledContainer) -> None:
+    with locked_pool(state_dir) as pool:
+        pool.containers.append(container)
+
+
+def remove_containers(state_dir: Path, container_names: List[str]) -> None:
+    with locked_pool(state_dir) as pool:
+        pool.containers = [
+            container for container in pool.containers if container.container_name not in container_names
+        ]
@@ -0,0 +1,134 @@
+"""Registry of the container ssh ports assigned on each host, shared by all local sessions"""
+
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from pydantic import BaseModel, Field
+from typing import Collection, Iterator, List, Optional
+
+from dockerdo.json_state import load_state, locked_state
+
+REGISTRY_FILE = "ports.json"
+LOCK_FILE = "ports.lock"
+
+
+class PortAllocationError(Exception):
+    pass
+
+
+class PortAssignment(BaseModel):
+    host: str
+    port: int
+    session_name: str
+    session_dir: Path
+    assigned_at: float
+
+
+class PortRegistry(BaseModel):
+    assignments: List[PortAssignment] = Field(default_factory=list)
+
+    def find(self, host: str, session_dir: Path) -> Optional[PortAssignment]:
+        for assignment in self.assignments:
+            if assignment.host == host and assignment.session_dir == session_dir:
+                return assignment
+        return None
+
+    def prune_stale(self) -> List[PortAssignment]:
+        """Forget the ports of sessions whose directory no longer exists. Returns the pruned assignments."""
+        stale = [assignment for assignment in self.assignments if not assignment.session_dir.exists()]
+        self.assignments = [assignment for assignment in self.assignments if assignment not in stale]
+        return stale
+
+
+def load_registry(registry_dir: Path) -> PortRegistry:
+    return load_state(registry_dir / REGISTRY_FILE, PortRegistry)
+
+
+@contextmanager
+def locked_registry(registry_dir: Path) -> Iterator[PortRegistry]:
+    """
+    Read, modify and write back the registry while holding an exclusive lock,
+    so that sessions started in parallel never claim the same port.
+    """
+    with locked_state(registry_dir / REGISTRY_FILE, registry_dir / LOCK_FILE, PortRegistry) as registry:
+        yield registry
+
+
+def choose_port(
+    registry: PortRegistry,
+    host: str,
+    session_dir: Path,
+    in_use: Collection[int],
+    port_range: range,
+    requested: Optional[int] = None,
+) -> int:
+    """
+    Choose the port for a session: the requested port, the port previously assigned to the session,
+    or the lowest port in the range that is neither assigned to another session nor listening on the host.
+    """
+    taken = {
+        assignment.port
+        for assignment in registry.assignments
+        if assignment.host == host and assignment.session_dir != session_dir
+    }
+    if requested is not None:
+        if requested in taken:
+            owner = next(a for a in registry.assignments if a.host == host and a.port == requested)
+            raise PortAllocationError(f"Port {requested} on {host} is assigned to session {owner.session_name}")
+        return requested
+    previous = registry.find(host, session_dir)
+    if previous is not None and previous.port not in in_use:
+        return previous.port
+    for port in port_range:
+        if port not in taken and port not in in_use:
+            return port
+    raise PortAllocationError(f"No free port on {host} between {port_range.start} and {port_range.stop - 1}")
+
+
+def allocate_port(
+    registry_dir: Path,
+    host: str,
+    session_name: str,
+    session_dir: Path,
+    in_use: Collection[int],
+    port_range: range,
+    requested: Optional[int] = None,
+) -> int:
+    """Choose a port for the session, and record the assignment atomically"""
+    with locked_registry(registry_dir) as registry:
+        registry.prune_stale()
+        port = choose_port(registry, host, session_dir, in_use, port_range, requested)
+        registry.assignments = [
+            assignment for assignment in registry.assignments
+            if not (assignment.host == host and assignment.session_dir == session_dir)
+        ]
+        registry.assignments.append(
+            PortAssignment(
+                host=host, port=port, session_name=session_name, session_dir=session_dir, assigned_at=time.time()
+            )
+        )
+    return port
+
+
+def reassign_port(registry_dir: Path, host: str, port: int, session_name: str, session_dir: Path) -> None:
+    """Hand over an assigned port to another session, e.g. when a pooled container is claimed"""
+    with locked_registry(registry_dir) as registry:
+        registry.assignments = [
+            assignment for assignment in registry.assignments
+            if not (assignment.host == host and (assignment.port == port or assignment.session_dir == session_dir))
+        ]
+        registry.assignments.append(
+            PortAssignment(
+                host=host, port=port, session_name=session_name, session_dir=session_dir, assigned_at=time.time()
+            )
+        )
+
+
+def release_ports(registry_dir: Path, session_dir: Path) -> None:
+    """Forget all the ports assigned to the session"""
+    if not (registry_dir / REGISTRY_FILE).exists():
+        return
+    with locked_registry(registry_dir) as registry:
+        registry.assignments = [
+            assignment for assignment in registry.assignments if assignment.session_dir != session_dir
+        ]
@@ -0,0 +1,55 @@
+"""Warm the sshfs cache of the container mount, so that editors do not pay a round trip for each stat"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+PREFETCH_WORKERS = 16
+
+
+class PrefetchStats(NamedTuple):
+    directories: int
+    entries: int
+    # The walk stopped at the maximum number of entries, before listing all the directories
+    truncated: bool
+
+
+def _list_one(directory: Path) -> Tuple[List[Path], int]:
+    """List a single directory, returning its subdirectories and the number of entries. Symlinks are not followed."""
+    try:
+        with os.scandir(directory) as entries:
+            listed = list(entries)
+    except OSError:
+        return [], 0
+    return [Path(entry.path) for entry in listed if entry.is_dir(follow_symlinks=False)], len(listed)
+
+
+def prefetch_tree(
+    mount_point: Path,
+    paths: Sequence[Path],
+    max_entries: int,
+    stop: Optional[threading.Event] = None,
+    max_workers: int = PREFETCH_WORKERS,
+) -> PrefetchStats:
+    """
+    List the directories under the paths inside the container through the mount.
+
+    sshfs caches the attributes of all the entries of a directory listing,
+    so the stat calls that follow, e.g. when an editor opens the project, are answered without a round trip.
+    Directories are listed concurrently, one level at a time, so that many requests are in flight at once.
+    The walk ends after max_entries entries, as the cache holds no more, or when stop is set.
+    """
+    frontier = [mount_point / (Path("/") / path).relative_to(Path("/")) for path in paths]
+    directories = 0
+    entries = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier and entries < max_entries and not (stop is not None and stop.is_set()):
+            next_frontier: List[Path] = []
+            for subdirs, count in executor.map(_list_one, frontier):
+                directories += 1
+                entries += count
+                next_frontier.extend(subdirs)
+            frontier = next_frontier
+    return PrefetchStats(directories=directories, entries=entries, truncated=len(frontier) > 0)
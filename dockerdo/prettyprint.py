@@ -2,11 +2,16 @@
 
 import rich
 import sys
+import threading
 from rich.text import Text
 from typing import Union
-from rich.console import Console
+from rich.console import Console, Group
 from rich.live import Live
-from typing import Literal, Optional, List, Dict, Any
+from rich.table import Table
+from contextlib import AbstractContextManager
+from typing import Literal, Optional, Iterable, Dict, Any, List, Tuple, Sequence
+
+from dockerdo import trace
 
 Host = Literal["local", "remote", "container"]
 ActionStatus = Literal["RUNNING", "OK", "WARN", "FAIL"]
@@ -88,7 +93,7 @@ def container_status(status: str) -> None:
     info(f"Container status: [bold {color}]{status}[/bold {color}]")
 
 
-def command_history(history: List[Dict[str, str]]) -> None:
+def command_history(history: Iterable[Dict[str, Any]]) -> None:
     prev_path = None
     for command in history:
         if command["cwd"] != prev_path:
@@ -97,8 +102,153 @@ def command_history(history: List[Dict[str, str]]) -> None:
         print(command["command"], file=sys.stderr)
 
 
+def _format_seconds(value: Optional[float]) -> str:
+    return f"{value:.3f}" if value is not None else "-"
+
+
+def latency_table(rows: List[Tuple[str, int, List[Optional[float]]]], percentiles: Sequence[int]) -> None:
+    table = Table(box=None)
+    table.add_column("phase", style="bold")
+    table.add_column("n", justify="right")
+    for q in percentiles:
+        table.add_column("max" if q == 100 else f"p{q}", justify="right")
+    for label, count, values in rows:
+        table.add_row(label, str(count), *(_format_seconds(value) for value in values))
+    Console(stderr=True).print(table)
+
+
+def format_bytes(size: int) -> str:
+    """Human readable size in decimal units, like the docker cli"""
+    value = float(size)
+    for unit in ("B", "kB", "MB", "GB"):
+        if value < 1000:
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1000
+    return f"{value:.1f}TB"
+
+
+def format_transfer(byte_count: int, seconds: float) -> str:
+    """Amount transferred and the throughput"""
+    if seconds <= 0:
+        return format_bytes(byte_count)
+    return f"{format_bytes(byte_count)} at {format_bytes(int(byte_count / seconds))}/s"
+
+
+def format_age(timestamp: float, now: float) -> str:
+    seconds = max(0.0, now - timestamp)
+    for unit, length in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= length:
+            return f"{int(seconds // length)}{unit} ago"
+    return "just now"
+
+
+def session_table(rows: List[Tuple[str, str, str, str, str, float]], now: float) -> None:
+    """Sessions with their state, host, image, port and last activity, most recently active first"""
+    table = Table(box=None)
+    for column in ("session", "state", "host", "image", "port", "last active"):
+        table.add_column(column, style="bold" if column == "session" else None)
+    for name, state, host, image, port, last_active in rows:
+        style = "green" if state == "running" else "dim" if state.endswith("?") else None
+        table.add_row(name, Text(state, style=style or ""), host, image, port, format_age(last_active, now))
+    Console(stderr=True).print(table)
+
+
+def fanout_summary(rows: List[Tuple[str, Optional[int], Optional[float]]]) -> None:
+    """Exit status and wall time of a command run in several sessions"""
+    table = Table(box=None)
+    table.add_column("session", style="bold")
+    table.add_column("exit", justify="right")
+    table.add_column("total", justify="right")
+    for name, exit_code, wall_time in rows:
+        if exit_code is None:
+            status = Text("-", style="dim")
+        else:
+            status = Text(str(exit_code), style="green" if exit_code == 0 else "bold red")
+        table.add_row(name, status, _format_seconds(wall_time))
+    Console(stderr=True).print(table)
+
+
+def slowest_commands(commands: List[Dict[str, Any]]) -> None:
+    table = Table(box=None)
+    for column in ("total", "local", "ssh", "remote", "exit", "stdout", "stderr"):
+        table.add_column(column, justify="right")
+    table.add_column("command", style="bold")
+    for command in commands:
+        table.add_row(
+            _format_seconds(command["wall_time"]),
+            _format_seconds(command["local_time"]),
+            _format_seconds(command["ssh_time"]),
+            _format_seconds(command["remote_time"]),
+            str(command["exit_code"]),
+            str(command["stdout_bytes"]) if command["stdout_bytes"] is not None else "-",
+            str(command["stderr_bytes"]) if command["stderr_bytes"] is not None else "-",
+            command["command"],
+        )
+    Console(stderr=True).print(table)
+
+
+def supervisor_health(components: Dict[str, Dict[str, Any]]) -> None:
+    table = Table(box=None)
+    for column in ("component", "state", "pid", "restarts", "last exit"):
+        table.add_column(column)
+    for name, health in components.items():
+        state = health["state"]
+        table.add_row(
+            name,
+            Text(state, style="bold green" if state == "running" else "bold yellow"),
+            str(health["pid"]) if health["pid"] is not None else "-",
+            str(health["restarts"]),
+            str(health["last_exit"]) if health["last_exit"] is not None else "-",
+        )
+    Console(stderr=True).print(table)
+
+
+def docker_table(columns: Sequence[str], rows: Iterable[Sequence[str]]) -> None:
+    """Print a listing from the Docker Engine API, in the style of the docker cli"""
+    table = Table(box=None)
+    for column in columns:
+        table.add_column(column)
+    for row in rows:
+        table.add_row(*row)
+    Console(stderr=True).print(table)
+
+
+class ActionGroup:
+    """A live display of several LongActions running concurrently, one line each"""
+
+    def __init__(self) -> None:
+        self.actions: List["LongAction"] = []
+        self._live: Optional[Live] = None
+        self._lock = threading.Lock()
+
+    def add(self, action: "LongAction") -> None:
+        with self._lock:
+            self.actions.append(action)
+        self.refresh()
+
+    def refresh(self) -> None:
+        with self._lock:
+            if self._live:
+                self._live.update(Group(*(action._render() for action in self.actions)), refresh=True)
+
+    def __enter__(self) -> "ActionGroup":
+        console = Console(stderr=True)
+        self._live = Live(Group(), auto_refresh=False, console=console).__enter__()
+        return self
+
+    def __exit__(self, *args: Any, **kwargs: Any) -> None:
+        assert self._live is not None
+        self.refresh()
+        with self._lock:
+            self._live.__exit__(*args, **kwargs)
+            self._live = None
+
+
 class LongAction:
-    """A status tracker for long tasks that don't report intermediary results"""
+    """
+    A status tracker for long tasks that don't report intermediary results.
+    Actions running concurrently are displayed together in an ActionGroup.
+    """
 
     def __init__(
         self,
@@ -107,6 +257,7 @@ class LongAction:
         done_verb: str,
         running_message: Union[str, Text],
         done_message: Optional[Union[str, Text]] = None,
+        group: Optional[ActionGroup] = None,
     ):
         self.host = host
         self.running_verb = running_verb
@@ -115,12 +266,26 @@ class LongAction:
         self.done_message = Text.assemble(done_message) if done_message else running_message
         self.bullet: Text = Text("")
         self.status: ActionStatus = "RUNNING"
+        self.group = group
         self._live: Optional[Live] = None
+        self._span: Optional[AbstractContextManager] = None
 
     def set_status(self, status: ActionStatus) -> None:
         self.status = status
         self.bullet = format_bullet(status)
-        if self._live:
+        if self.group:
+            self.group.refresh()
+        elif self._live:
+            self._live.update(self._render(), refresh=True)
+
+    def set_message(self, running_message: Union[str, Text], done_message: Optional[Union[str, Text]] = None) -> None:
+        """Update the message while the action runs, e.g. to show progress"""
+        self.running_message = Text.assemble(running_message)
+        if done_message is not None:
+            self.done_message = Text.assemble(done_message)
+        if self.group:
+            self.group.refresh()
+        elif self._live:
             self._live.update(self._render(), refresh=True)
 
     def _render(self) -> Text:
@@ -131,12 +296,25 @@ class LongAction:
         return format_action(self.host, verb, message, self.status)
 
     def __enter__(self) -> "LongAction":
+        self._span = trace.span(
+            f"{self.running_verb} {self.running_message.plain}", "action", host=self.host
+        )
+        self._span.__enter__()
         self.set_status("RUNNING")
+        if self.group:
+            self.group.add(self)
+            return self
         console = Console(stderr=True)
         self._live = Live(self._render(), auto_refresh=False, console=console).__enter__()
         return self
 
     def __exit__(self, *args: Any, **kwargs: Any) -> None:
+        if self.group:
+            if self.status == "RUNNING":
+                self.set_status("FAIL")
+            self.group.refresh()
+            self._exit_span()
+            return
         assert self._live is not None
         if self.status == "RUNNING":
             # If you didn't set a status before exit, then it failed
@@ -146,6 +324,12 @@ class LongAction:
             self._live.update(self._render(), refresh=True)
         self._live.__exit__(*args, **kwargs)
         self._live = None
+        self._exit_span()
+
+    def _exit_span(self) -> None:
+        assert self._span is not None
+        self._span.__exit__(None, None, None)
+        self._span = None
 
     def __bool__(self) -> bool:
         return True
@@ -0,0 +1,84 @@
+"""Batched queries about the remote host, answered by a helper script in a single round trip"""
+
+import importlib.resources
+import shlex
+from pydantic import BaseModel
+from typing import Optional, List, Dict, Any
+
+from dockerdo.engine import container_entry_names
+
+HELPER_RESOURCE = "dockerdo-helper.sh"
+HELPER_VERSION = 3
+# The version is part of the name, so that an upgraded dockerdo installs its own helper
+HELPER_NAME = f".dockerdo-helper-v{HELPER_VERSION}.sh"
+
+
+class DiskUsage(BaseModel):
+    total_kb: int
+    used_kb: int
+    available_kb: int
+
+
+class Tarball(BaseModel):
+    name: str
+    size: int
+    mtime: float
+
+
+class HostStatus(BaseModel):
+    """
+    Answers from the helper script. Queries that were not asked, or that failed, are None.
+    images and containers are in the json format of the docker cli.
+    """
+
+    version: int
+    images: Optional[List[Dict[str, Any]]] = None
+    containers: Optional[List[Dict[str, Any]]] = None
+    ports: Optional[List[int]] = None
+    disk: Optional[DiskUsage] = None
+    files: Optional[List[str]] = None
+    tarballs: Optional[List[Tarball]] = None
+
+    def find_container(self, container_name: str) -> Optional[Dict[str, Any]]:
+        for entry in self.containers or []:
+            if container_name in container_entry_names(entry):
+                return entry
+        return None
+
+    def has_image(self) -> bool:
+        return bool(self.images)
+
+
+def read_helper_script() -> str:
+    return importlib.resources.files("dockerdo").joinpath(HELPER_RESOURCE).read_text()
+
+
+def helper_queries(
+    image: Optional[str] = None,
+    container: Optional[str] = None,
+    ports: bool = False,
+    disk: bool = False,
+    files: bool = False,
+    all_images: bool = False,
+    all_containers: bool = False,
+    tarballs: bool = False,
+) -> List[str]:
+    """The arguments of the helper script for a batch of queries"""
+    args = []
+    if all_images:
+        args.append("images")
+    elif image is not None:
+        args.append(f"image={image}")
+    if all_containers:
+        args.append("containers")
+    elif container is not None:
+        args.append(f"container={container}")
+    for name, enabled in (("ports", ports), ("disk", disk), ("files", files), ("tarballs", tarballs)):
+        if enabled:
+            args.append(name)
+    return args
+
+
+def format_helper_args(queries: List[str]) -> str:
+    """The command line for a batch of queries"""
+    return " ".join(shlex.quote(arg) for arg in ["sh", HELPER_NAME] + queries)
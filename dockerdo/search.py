@@ -0,0 +1,38 @@
+"""Search the files of the container inside the container, instead of crawling them through the sshfs mount"""
+
+import os
+import shlex
+from pathlib import Path
+from typing import BinaryIO, Literal, Sequence
+
+from dockerdo.line_output import LineOutput
+
+SearchProgram = Literal["grep", "find"]
+NO_FILENAME_FLAGS = {"-h", "--no-filename"}
+
+
+def format_search_command(program: SearchProgram, args: Sequence[str]) -> str:
+    """
+    The search command run in the container.
+    grep always prints the file name, so that the paths of the matches can be rewritten, unless disabled with -h.
+    """
+    if program == "grep" and not NO_FILENAME_FLAGS.intersection(args):
+        args = ["-H", *args]
+    return shlex.join([program, *args])
+
+
+def rewrites_paths(program: SearchProgram, args: Sequence[str]) -> bool:
+    """Without file names, the lines of the output of grep are contents of the files"""
+    return not (program == "grep" and NO_FILENAME_FLAGS.intersection(args))
+
+
+class LocalPathOutput(LineOutput):
+    """
+    Write the output of a search a line at a time, rewriting an absolute container path at the start of a line
+    to the same path in the local sshfs mount. Relative paths are left as they are:
+    the search runs in the container directory that the current directory is mounted from.
+    """
+
+    def __init__(self, destination: BinaryIO, mount_point: Path) -> None:
+        prefix = os.fsencode(mount_point)
+        super().__init__(destination, lambda line: prefix + line if line.startswith(b"/") else line)
@@ -0,0 +1,150 @@
+"""Index of all the sessions on this machine, for listing them without loading each session directory"""
+
+import sqlite3
+import time
+import yaml
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Optional, List
+
+from dockerdo.config import Session
+
+INDEX_DB = "sessions.sqlite"
+# The history database is written by every exec, so its mtime tells the last activity for free
+ACTIVITY_FILE = "history.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_dir TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    container_name TEXT NOT NULL,
+    remote_host TEXT,
+    image_tag TEXT,
+    container_state TEXT NOT NULL,
+    ssh_port_on_remote_host INTEGER,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class IndexedSession(BaseModel):
+    session_dir: Path
+    name: str
+    container_name: str
+    remote_host: Optional[str] = None
+    image_tag: Optional[str] = None
+    container_state: str
+    ssh_port_on_remote_host: Optional[int] = None
+    updated_at: float
+
+    @classmethod
+    def from_session(cls, session: Session) -> "IndexedSession":
+        return cls(
+            session_dir=session.session_dir,
+            name=session.name,
+            container_name=session.container_name,
+            remote_host=session.remote_host,
+            image_tag=session.image_tag,
+            container_state=session.container_state,
+            ssh_port_on_remote_host=session.ssh_port_on_remote_host,
+            updated_at=time.time(),
+        )
+
+    @property
+    def host(self) -> str:
+        return self.remote_host if self.remote_host is not None else "localhost"
+
+    def last_active(self) -> float:
+        try:
+            return max(self.updated_at, (self.session_dir / ACTIVITY_FILE).stat().st_mtime)
+        except OSError:
+            return self.updated_at
+
+
+class SessionIndex:
+    """SQLite database shared by all sessions, updated when a session is created or changes state"""
+
+    def __init__(self, state_dir: Path) -> None:
+        self.state_dir = state_dir
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            # Sessions started in parallel update the index concurrently
+            self._connection = sqlite3.connect(self.state_dir / INDEX_DB, timeout=10.0)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def update(self, session: Session) -> None:
+        entry = IndexedSession.from_session(session)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions"
+                " (session_dir, name, container_name, remote_host, image_tag, container_state,"
+                " ssh_port_on_remote_host, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(entry.session_dir),
+                    entry.name,
+                    entry.container_name,
+                    entry.remote_host,
+                    entry.image_tag,
+                    entry.container_state,
+                    entry.ssh_port_on_remote_host,
+                    entry.updated_at,
+                ),
+            )
+
+    def remove(self, session_dir: Path) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM sessions WHERE session_dir = ?", (str(session_dir),))
+
+    def sessions(self) -> List[IndexedSession]:
+        rows = self.connection.execute("SELECT * FROM sessions ORDER BY name").fetchall()
+        return [IndexedSession(**dict(row)) for row in rows]
+
+    def missing(self) -> List[IndexedSession]:
+        """The indexed sessions whose directory no longer exists, e.g. ephemeral sessions in a cleaned /tmp"""
+        return [entry for entry in self.sessions() if not (entry.session_dir / "session.yaml").exists()]
+
+    def prune_missing(self) -> List[IndexedSession]:
+        """Forget the sessions whose directory no longer exists"""
+        missing = self.missing()
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM sessions WHERE session_dir = ?", [(str(entry.session_dir),) for entry in missing]
+            )
+        return missing
+
+    def unindexed(self, sessions_dir: Path) -> List[Session]:
+        """
+        The persistent sessions that are not in the index yet, e.g. created by an older version of dockerdo.
+        Only the unknown session directories are loaded.
+        """
+        if not sessions_dir.is_dir():
+            return []
+        known = {str(row["session_dir"]) for row in self.connection.execute("SELECT session_dir FROM sessions")}
+        found = []
+        for session_dir in sorted(sessions_dir.iterdir()):
+            if str(session_dir) in known or not (session_dir / "session.yaml").exists():
+                continue
+            try:
+                found.append(Session.load(session_dir))
+            except (OSError, ValueError, TypeError, yaml.YAMLError):
+                continue
+        return found
+
+    def discover(self, sessions_dir: Path) -> List[Path]:
+        """Index the persistent sessions that are not in the index yet. Returns the newly indexed directories."""
+        discovered = self.unindexed(sessions_dir)
+        for session in discovered:
+            self.update(session)
+        return [session.session_dir for session in discovered]
@@ -1,19 +1,86 @@
 """Shell related functions"""
 
+import base64
+import importlib.resources
 import json
 import os
+import re
 import shlex
+import socket
 import sys
+import threading
+import time
+import zlib
 from pathlib import Path
-from subprocess import Popen, PIPE, DEVNULL, check_output, CalledProcessError
-from typing import Optional, TextIO, Tuple, Literal
+from subprocess import Popen, PIPE, DEVNULL, check_output, CalledProcessError, run
+from typing import Optional, TextIO, Tuple, Literal, IO, Dict, Any, Callable, List, Protocol, Sequence, cast
 
-from dockerdo import prettyprint
-from dockerdo.config import Session
+from dockerdo import prettyprint, trace
+from dockerdo.batch import BatchCommand, BatchResult, BatchRun, format_batch_script
+from dockerdo.config import Session, SSH_KEEPALIVE_OPTIONS, SSHFS_RECONNECT_OPTIONS
+from dockerdo.container_state import (
+    CachedContainerState,
+    load_cached_state,
+    save_cached_state,
+)
+from dockerdo.exec_server import (
+    FRAME_EXIT,
+    FRAME_STARTED,
+    FRAME_STDERR,
+    FRAME_STDIN,
+    FRAME_STDOUT,
+    REMOTE_SOCKET,
+    recv_frame,
+    send_frame,
+    send_request,
+)
+from dockerdo.engine import DockerEngine, DockerEngineError, container_entry_names, STREAM_CHUNK_SIZE
+from dockerdo.file_transfer import (
+    CountingReader,
+    Location,
+    TransferError,
+    TransferProgress,
+    TransferShard,
+    extract_tar_stream,
+    format_file_list,
+    format_list_files_script,
+    format_tar_create_script,
+    format_tar_pack_script,
+    format_tar_unpack_script,
+    parse_file_list,
+)
+from dockerdo.history import ExecStats
+from dockerdo.remote_helper import (
+    HostStatus,
+    HELPER_NAME,
+    format_helper_args,
+    helper_queries,
+    read_helper_script,
+)
+from dockerdo.supervisor import (
+    CONTROL_SOCKET,
+    Component,
+    EventsComponent,
+    PrefetchComponent,
+    ProcessComponent,
+    RecorderComponent,
+    Supervisor,
+)
+from dockerdo.utils import probe_path, ssh_master_alive
 
 verbose = False
 dry_run = False
 
+DOCKER_SOCKET = Path("/var/run/docker.sock")
+SUPERVISOR_TIMEOUT = 5.0
+RECONNECT_TIMEOUT = 20.0
+MOUNT_PROBE_TIMEOUT = 2.0
+# The ssh master answers from its own event loop: a slow answer means that it is stuck
+SSH_CHECK_TIMEOUT = 1.0
+# Forwarded by the ssh master connection to the exec server in the container
+EXEC_SOCKET = "exec.sock"
+EXEC_CONNECT_TIMEOUT = 2.0
+
 
 def set_execution_mode(verbose_mode: bool, dry_run_mode: bool) -> None:
     """Set the execution mode"""
@@ -27,6 +94,16 @@ def get_user_config_dir() -> Path:
     return Path("~/.config/dockerdo").expanduser()
 
 
+def get_user_data_dir() -> Path:
+    """Get the directory of the persistent sessions"""
+    return Path("~/.local/share/dockerdo").expanduser()
+
+
+def get_user_state_dir() -> Path:
+    """Get the directory for state shared by all sessions, e.g. the port registry"""
+    return Path("~/.local/state/dockerdo").expanduser()
+
+
 def get_container_work_dir(session: Session) -> Optional[Path]:
     """
     Get the container work directory.
@@ -59,15 +136,147 @@ def run_local_command(command: str, cwd: Path, silent: bool = False) -> int:
             print(f"+ {command}", file=sys.stderr)
     args = shlex.split(command)
     if not dry_run:
-        with Popen(
-            args, stdin=sys.stdin, stdout=stdout, stderr=stderr, cwd=cwd
-        ) as process:
-            process.wait()
-            return process.returncode
+        with trace.span(args[0], "subprocess", command=command) as span_args:
+            with Popen(
+                args, stdin=sys.stdin, stdout=stdout, stderr=stderr, cwd=cwd
+            ) as process:
+                process.wait()
+                span_args["returncode"] = process.returncode
+                return process.returncode
     else:
         return 0
 
 
+# The container reports the start and end of the command on stderr, after all other output
+TIMING_MARKER = b"\x1edockerdo-timing"
+# Any line starting with the marker, also if date in the container does not support %N
+RE_TIMING_MARKER = re.compile(rb"^\x1edockerdo-timing[^\n]*\n?", re.MULTILINE)
+RE_TIMING_VALUES = re.compile(rb"\x1edockerdo-timing (\d+) (\d+)\n?")
+MAX_TIMING_MARKER_LEN = 64
+PUMP_CHUNK_SIZE = 65536
+
+
+class OutputDestination(Protocol):
+    """Where the output of a command is relayed: our own stdout or stderr, or a filter in front of them"""
+
+    def write(self, __data: bytes) -> Any: ...
+
+    def flush(self) -> Any: ...
+
+
+def split_timing_marker(data: bytes) -> Tuple[bytes, Optional[float]]:
+    """
+    Remove the lines starting with the timing marker from the data.
+    Returns the remaining data, and the remote runtime in seconds if a marker could be parsed.
+    """
+    remote_time = None
+    for match in RE_TIMING_MARKER.finditer(data):
+        values = RE_TIMING_VALUES.fullmatch(match.group())
+        if values is not None:
+            remote_time = (int(values.group(2)) - int(values.group(1))) / 1e9
+    return RE_TIMING_MARKER.sub(b"", data), remote_time
+
+
+class StreamWriter:
+    """Write to our own output in real time, counting the bytes"""
+
+    def __init__(self, destination: OutputDestination) -> None:
+        self.destination = destination
+        self.byte_count = 0
+        self._broken = False
+
+    def write(self, data: bytes) -> None:
+        self.byte_count += len(data)
+        if self._broken:
+            return
+        try:
+            self.destination.write(data)
+            self.destination.flush()
+        except BrokenPipeError:
+            # Keep draining the source, so that the subprocess doesn't block
+            self._broken = True
+
+
+class OutputPump(threading.Thread):
+    """
+    Copy an output stream of a subprocess to our own output in real time, counting the bytes.
+    Optionally holds back a possible timing marker, so that it can be removed from the output.
+    """
+
+    def __init__(self, source: IO[bytes], destination: OutputDestination, strip_timing: bool = False) -> None:
+        super().__init__(daemon=True)
+        self.source = source
+        self.writer = StreamWriter(destination)
+        self.strip_timing = strip_timing
+        self.remote_time: Optional[float] = None
+
+    @property
+    def byte_count(self) -> int:
+        return self.writer.byte_count
+
+    def _write(self, data: bytes) -> None:
+        if len(data) > 0:
+            self.writer.write(data)
+
+    def run(self) -> None:
+        fd = self.source.fileno()
+        pending = b""
+        while True:
+            chunk = os.read(fd, PUMP_CHUNK_SIZE)
+            if not chunk:
+                break
+            pending += chunk
+            marker_index = pending.rfind(TIMING_MARKER[:1]) if self.strip_timing else -1
+            if marker_index == -1 or len(pending) - marker_index > MAX_TIMING_MARKER_LEN:
+                self._write(pending)
+                pending = b""
+            else:
+                self._write(pending[:marker_index])
+                pending = pending[marker_index:]
+        if self.strip_timing:
+            pending, self.remote_time = split_timing_marker(pending)
+        self._write(pending)
+
+
+def run_local_command_measured(
+    command: str,
+    cwd: Path,
+    strip_timing: bool = False,
+    stdout: Optional[OutputDestination] = None,
+    stderr: Optional[OutputDestination] = None,
+) -> Tuple[int, ExecStats]:
+    """
+    Run a command on the local host like run_local_command, measuring the time and the amount of output.
+    Stdout and stderr are relayed in real time through pipes, by default to our own stdout and stderr.
+    """
+    if verbose:
+        print(f"+ {command}", file=sys.stderr)
+    args = shlex.split(command)
+    if dry_run:
+        return 0, ExecStats()
+    start_time = time.monotonic()
+    with trace.span(args[0], "subprocess", command=command) as span_args:
+        with Popen(args, stdin=sys.stdin, stdout=PIPE, stderr=PIPE, cwd=cwd) as process:
+            assert process.stdout is not None and process.stderr is not None
+            stdout_pump = OutputPump(process.stdout, stdout or sys.stdout.buffer)
+            stderr_pump = OutputPump(process.stderr, stderr or sys.stderr.buffer, strip_timing=strip_timing)
+            stdout_pump.start()
+            stderr_pump.start()
+            process.wait()
+            stdout_pump.join()
+            stderr_pump.join()
+        span_args["returncode"] = process.returncode
+        span_args["remote_time"] = stderr_pump.remote_time
+    elapsed = time.monotonic() - start_time
+    stats = ExecStats(
+        remote_time=stderr_pump.remote_time,
+        ssh_time=elapsed - stderr_pump.remote_time if stderr_pump.remote_time is not None else elapsed,
+        stdout_bytes=stdout_pump.byte_count,
+        stderr_bytes=stderr_pump.byte_count,
+    )
+    return process.returncode, stats
+
+
 def make_remote_command(command: str, session: Session) -> str:
     """
     Wrap a command in ssh to run on the remote host.
@@ -111,55 +320,442 @@ def ssh_stdin_flags(interactive: bool, session: Session) -> str:
             return f"-n -S {session.session_dir}/ssh-socket-container"
 
 
-def run_container_command(command: str, session: Session, interactive: bool = False) -> Tuple[int, Path]:
+def format_container_shell_command(
+    command: str, env_file_path: Path, container_work_dir: Path, measure: bool
+) -> str:
+    """
+    Format the shell command run inside the container.
+    If measure is True, the command is wrapped to report its runtime as a timing marker on stderr.
+    """
+    escaped_command = " ".join(shlex.quote(token) for token in shlex.split(command))
+    if measure:
+        escaped_command = (
+            "{ __dockerdo_start=$(date +%s%N); "
+            f"{escaped_command}; "
+            "__dockerdo_status=$?; __dockerdo_end=$(date +%s%N); "
+            "printf '\\036dockerdo-timing %s %s\\n' $__dockerdo_start $__dockerdo_end >&2; "
+            "exit $__dockerdo_status; }"
+        )
+    return f'"source {env_file_path} && cd {container_work_dir} && {escaped_command}"'
+
+
+def format_container_ssh_destination(session: Session) -> str:
+    """The ssh options and destination for connecting to the container"""
+    assert session.ssh_port_on_remote_host is not None
+    if session.remote_host is None:
+        # remote_host is the same as local_host
+        return f"-p {session.ssh_port_on_remote_host} {session.container_username}@localhost"
+    # remote_host is different from local_host, so jump via remote_host to container
+    return (
+        f"-J {session.remote_host}"
+        f" -p {session.ssh_port_on_remote_host}"
+        f" {session.container_username}@{session.remote_host}"
+    )
+
+
+def format_exec_server_command() -> str:
+    """
+    The remote command that runs the exec server in the container. The script is sent compressed on the command line.
+    Without python3 in the container, it waits to be stopped instead, and dodo keeps using ssh.
+    """
+    source = importlib.resources.files("dockerdo").joinpath("exec_server.py").read_bytes()
+    encoded = base64.b64encode(zlib.compress(source, 9)).decode("ascii")
+    loader = f"import base64,zlib;exec(zlib.decompress(base64.b64decode('{encoded}')))"
+    return (
+        f'if command -v python3 > /dev/null; then exec python3 -c "{loader}" {REMOTE_SOCKET};'
+        " else echo 'dockerdo: no python3 in the container, dodo uses ssh' >&2; exec cat > /dev/null; fi"
+    )
+
+
+def forward_stdin_frames(sock: socket.socket) -> None:
+    """Relay our stdin to the exec server, then close it"""
+    fd = sys.stdin.fileno()
+    try:
+        while True:
+            chunk = os.read(fd, PUMP_CHUNK_SIZE)
+            send_frame(sock, FRAME_STDIN, chunk)
+            if not chunk:
+                return
+    except OSError:
+        # The command finished without reading all of its input
+        return
+
+
+def run_exec_server_command(
+    command: str, session: Session, container_work_dir: Path, interactive: bool = False
+) -> Optional[Tuple[int, ExecStats]]:
+    """
+    Run a command through the exec server in the container, relaying stdin, stdout and stderr.
+    Returns None if the exec server is not available, in which case the command was not started.
+    Interactive commands need a tty, so they always use ssh.
+    """
+    if interactive:
+        return None
+    # Data piped into dodo is relayed. Otherwise stdin is not used, like ssh -n.
+    return run_exec_server_script(
+        format_exec_server_script(command, session),
+        session,
+        container_work_dir,
+        forward_stdin=not sys.stdin.isatty(),
+        description=command,
+    )
+
+
+def format_exec_server_script(command: str, session: Session) -> str:
+    """Like sourcing the env file, and with the same quoting as over ssh"""
+    script = "".join(f"export {key}={value}\n" for key, value in session.env.items())
+    return script + " ".join(shlex.quote(token) for token in shlex.split(command))
+
+
+def run_exec_server_script(
+    script: str,
+    session: Session,
+    container_work_dir: Path,
+    forward_stdin: bool,
+    description: str,
+    stdout_destination: Optional[OutputDestination] = None,
+    stderr_destination: Optional[OutputDestination] = None,
+) -> Optional[Tuple[int, ExecStats]]:
+    """
+    Run a shell script through the exec server, see run_exec_server_command.
+    The output is relayed by default to our own stdout and stderr.
+    """
+    exec_socket = session.session_dir / EXEC_SOCKET
+    if not exec_socket.exists():
+        return None
+    if verbose:
+        print(f"+ {description} > {exec_socket}", file=sys.stderr)
+    if dry_run:
+        return 0, ExecStats()
+    start_time = time.monotonic()
+    stdout = StreamWriter(stdout_destination or sys.stdout.buffer)
+    stderr = StreamWriter(stderr_destination or sys.stderr.buffer)
+    result: Optional[Dict[str, Any]] = None
+    with trace.span("exec server", "exec", command=description) as span_args:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.settimeout(EXEC_CONNECT_TIMEOUT)
+                sock.connect(str(exec_socket))
+                send_request(sock, {"command": script, "cwd": str(container_work_dir), "stdin": forward_stdin})
+                # The ssh master accepts the connection even if the server is not running, and then closes it
+                first_frame = recv_frame(sock)
+            except OSError:
+                return None
+            if first_frame is None or first_frame[0] != FRAME_STARTED:
+                return None
+            sock.settimeout(None)
+            if forward_stdin:
+                threading.Thread(target=forward_stdin_frames, args=(sock,), daemon=True).start()
+            while (frame := recv_frame(sock)) is not None:
+                frame_type, payload = frame
+                if frame_type == FRAME_STDOUT:
+                    stdout.write(payload)
+                elif frame_type == FRAME_STDERR:
+                    stderr.write(payload)
+                elif frame_type == FRAME_EXIT:
+                    result = dict(json.loads(payload))
+                    break
+        span_args["returncode"] = result["status"] if result is not None else None
+    elapsed = time.monotonic() - start_time
+    if result is None:
+        prettyprint.error("Lost the connection to the exec server")
+        # Like ssh, when the connection is lost
+        return 255, ExecStats(ssh_time=elapsed, stdout_bytes=stdout.byte_count, stderr_bytes=stderr.byte_count)
+    remote_time = float(result["remote_time"])
+    stats = ExecStats(
+        remote_time=remote_time,
+        ssh_time=max(0.0, elapsed - remote_time),
+        stdout_bytes=stdout.byte_count,
+        stderr_bytes=stderr.byte_count,
+    )
+    return int(result["status"]), stats
+
+
+def run_container_command(
+    command: str, session: Session, interactive: bool = False
+) -> Tuple[int, Path, ExecStats]:
     """
     Run a command on the container, piping through stdin, stdout, and stderr.
+    Uses the exec server of the session if it is running, otherwise ssh.
+
+    Unless a tty is allocated for an interactive command, the output is relayed through pipes,
+    so that the runtime and the amount of output can be measured.
     """
     container_work_dir = get_container_work_dir(session)
     if not container_work_dir:
         prettyprint.error(
             f"Current working directory is not inside the container mount point {session.sshfs_container_mount_point}"
         )
-        return 1, Path()
-    escaped_command = " ".join(shlex.quote(token) for token in shlex.split(command))
+        return 1, Path(), ExecStats()
+    if session.exec_server:
+        served = run_exec_server_command(command, session, container_work_dir, interactive=interactive)
+        if served is not None:
+            retval, stats = served
+            return retval, container_work_dir, stats
+    session.write_container_env_file(verbose=verbose)
     flags = ssh_stdin_flags(interactive, session)
-    assert session.ssh_port_on_remote_host is not None
-    if session.remote_host is None:
-        # remote_host is the same as local_host
-        wrapped_command = (
-            f"ssh {flags}"
-            f" -p {session.ssh_port_on_remote_host}"
-            f" {session.container_username}@localhost"
-            " -o StrictHostKeyChecking=no"
-            f' "source {session.env_file_path} && cd {container_work_dir} && {escaped_command}"'
+    measure = "-t" not in flags.split()
+    shell_command = format_container_shell_command(
+        command, session.env_file_path, container_work_dir, measure=measure
+    )
+    wrapped_command = (
+        f"ssh {flags}"
+        f" {format_container_ssh_destination(session)}"
+        " -o StrictHostKeyChecking=no"
+        f" {shell_command}"
+    )
+    cwd = Path(os.getcwd())
+    if measure:
+        retval, stats = run_local_command_measured(wrapped_command, cwd=cwd, strip_timing=True)
+        return retval, container_work_dir, stats
+    start_time = time.monotonic()
+    retval = run_local_command(wrapped_command, cwd=cwd)
+    return retval, container_work_dir, ExecStats(ssh_time=time.monotonic() - start_time)
+
+
+def run_container_command_unattended(
+    command: str,
+    session: Session,
+    container_work_dir: Path,
+    stdout: OutputDestination,
+    stderr: OutputDestination,
+) -> Tuple[int, ExecStats]:
+    """
+    Run a command on the container without stdin, relaying the output to the given destinations.
+    Uses the exec server of the session if it is running, otherwise the ssh master connection.
+    Used to run a command in many sessions concurrently.
+    """
+    if session.exec_server:
+        served = run_exec_server_script(
+            format_exec_server_script(command, session),
+            session,
+            container_work_dir,
+            forward_stdin=False,
+            description=command,
+            stdout_destination=stdout,
+            stderr_destination=stderr,
         )
+        if served is not None:
+            return served
+    session.write_container_env_file(verbose=verbose)
+    shell_command = format_container_shell_command(command, session.env_file_path, container_work_dir, measure=True)
+    wrapped_command = (
+        f"ssh -n -S {session.session_dir}/ssh-socket-container"
+        f" {format_container_ssh_destination(session)}"
+        " -o StrictHostKeyChecking=no"
+        f" {shell_command}"
+    )
+    return run_local_command_measured(
+        wrapped_command, cwd=Path(os.getcwd()), strip_timing=True, stdout=stdout, stderr=stderr
+    )
+
+
+def run_container_batch(
+    commands: List[BatchCommand],
+    session: Session,
+    keep_going: bool = False,
+    local_time: float = 0.0,
+    on_result: Optional[Callable[[BatchResult], None]] = None,
+) -> Tuple[int, List[BatchResult]]:
+    """
+    Run a batch of commands in the container as one script: through the exec server if it is running,
+    otherwise over a single ssh channel of the master connection.
+    Returns the exit status of the first failing command, and the result of each command that was run.
+    """
+    if len(commands) == 0:
+        return 0, []
+    script = format_batch_script(commands, session.env, keep_going=keep_going)
+    batch = BatchRun(commands, sys.stdout.buffer, sys.stderr.buffer, local_time=local_time, on_result=on_result)
+    description = f"batch of {len(commands)} commands"
+    served = None
+    if session.exec_server:
+        # Each command changes to its own working directory
+        served = run_exec_server_script(
+            script,
+            session,
+            Path("/"),
+            forward_stdin=False,
+            description=description,
+            stdout_destination=batch.stdout,
+            stderr_destination=batch.stderr,
+        )
+    if served is not None:
+        retval = served[0]
     else:
-        # remote_host is different from local_host, so jump via remote_host to container
+        # The commands do not read stdin, so the master connection can always be used
         wrapped_command = (
-            f"ssh {flags}"
-            f" -J {session.remote_host}"
-            f" -p {session.ssh_port_on_remote_host}"
-            f" {session.container_username}@{session.remote_host}"
+            f"ssh -n -S {session.session_dir}/ssh-socket-container"
+            f" {format_container_ssh_destination(session)}"
             " -o StrictHostKeyChecking=no"
-            f' "source {session.env_file_path} && cd {container_work_dir} && {escaped_command}"'
+            f" {shlex.quote(script)}"
         )
-    cwd = Path(os.getcwd())
-    return run_local_command(wrapped_command, cwd=cwd), container_work_dir
+        retval, _ = run_local_command_measured(
+            wrapped_command, cwd=Path(os.getcwd()), stdout=batch.stdout, stderr=batch.stderr
+        )
+    batch.stderr.close()
+    return retval, batch.results
+
+
+def format_transfer_args(host: prettyprint.Host, session: Session, script: str) -> List[str]:
+    """The command that runs a file transfer script on a host, over the ssh master connection of the session"""
+    if host == "container":
+        return [
+            "ssh",
+            "-S", f"{session.session_dir}/ssh-socket-container",
+            *shlex.split(format_container_ssh_destination(session)),
+            "-o", "StrictHostKeyChecking=no",
+            script,
+        ]
+    if host == "remote" and session.remote_host is not None:
+        return ["ssh", "-S", f"{session.session_dir}/ssh-socket-remote", session.remote_host, script]
+    # remote_host is the same as local_host
+    return ["sh", "-c", script]
+
+
+def write_and_close(stream: IO[bytes], data: bytes) -> None:
+    """Feed the input of a process, from a thread while its output is read"""
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        pass
+
+
+def run_container_tar_export(session: Session, paths: Sequence[Path], destination: Path) -> Tuple[int, List[Path]]:
+    """
+    Stream files out of the container as one tar over the ssh master connection, extracting them under destination.
+    Returns the exit status, and the paths of the extracted files relative to destination.
+    """
+    args = format_transfer_args("container", session, format_tar_create_script())
+    if verbose:
+        print(f"+ {shlex.join(args)}", file=sys.stderr)
+    if dry_run:
+        return 0, []
+    file_list = format_file_list(paths)
+    with trace.span("tar export", "transfer", files=len(paths)) as span_args:
+        with Popen(args, stdin=PIPE, stdout=PIPE) as process:
+            assert process.stdin is not None and process.stdout is not None
+            writer = threading.Thread(target=write_and_close, args=(process.stdin, file_list), daemon=True)
+            writer.start()
+            try:
+                extracted = extract_tar_stream(process.stdout, destination)
+            except TransferError as e:
+                prettyprint.error(str(e))
+                process.kill()
+                return 1, []
+            process.wait()
+        span_args["extracted"] = len(extracted)
+    return process.returncode, extracted
+
+
+def resolve_location(location: Location, session: Session) -> Location:
+    """
+    Make the path of a location absolute.
+    Relative remote paths are relative to the remote host build directory,
+    relative container paths to the current directory in the container.
+    """
+    if location.host == "local":
+        base = Path(os.getcwd())
+    elif location.host == "remote":
+        base = session.remote_host_build_dir
+    else:
+        container_work_dir = get_container_work_dir(session)
+        if container_work_dir is None and not location.path.is_absolute():
+            raise TransferError(
+                f"Relative container path {location.path}: "
+                f"the current directory is not inside the container mount {session.sshfs_container_mount_point}"
+            )
+        base = container_work_dir if container_work_dir is not None else Path("/")
+    return Location(location.host, Path(os.path.normpath(base / location.path)))
+
+
+def list_transfer_files(host: prettyprint.Host, session: Session, shard: TransferShard) -> List[str]:
+    """List the files under the names of the shard, to split them between parallel streams"""
+    args = format_transfer_args(host, session, format_list_files_script(shard))
+    if verbose:
+        print(f"+ {shlex.join(args)}", file=sys.stderr)
+    if dry_run:
+        return shard.names
+    try:
+        with trace.span("list files", "transfer", names=len(shard.names)):
+            output = check_output(args, stdin=DEVNULL)
+    except CalledProcessError as e:
+        raise TransferError(f"Listing the files to copy failed with exit status {e.returncode}")
+    return parse_file_list(output.decode("utf-8", errors="surrogateescape"))
+
+
+def run_tar_stream(
+    source_host: prettyprint.Host,
+    shard: TransferShard,
+    destination: Location,
+    session: Session,
+    progress: TransferProgress,
+) -> int:
+    """
+    Copy the names of the shard into the destination directory as one tar stream.
+    The stream passes through this process, which counts the bytes. A local destination is extracted here.
+    """
+    pack_args = format_transfer_args(source_host, session, format_tar_pack_script(shard.root))
+    unpack_args = (
+        format_transfer_args(destination.host, session, format_tar_unpack_script(destination.path))
+        if destination.host != "local" else None
+    )
+    if verbose:
+        unpack_text = shlex.join(unpack_args) if unpack_args is not None else f"extract into {destination.path}"
+        print(f"+ {shlex.join(pack_args)} | {unpack_text}", file=sys.stderr)
+    if dry_run:
+        return 0
+    file_list = "".join(f"{name}\n" for name in shard.names).encode("utf-8")
+    with trace.span("tar stream", "transfer", files=len(shard.names)):
+        with Popen(pack_args, stdin=PIPE, stdout=PIPE) as packer:
+            assert packer.stdin is not None and packer.stdout is not None
+            writer = threading.Thread(target=write_and_close, args=(packer.stdin, file_list), daemon=True)
+            writer.start()
+            reader = CountingReader(packer.stdout, progress)
+            if unpack_args is None:
+                try:
+                    extract_tar_stream(cast(IO[bytes], reader), destination.path)
+                except TransferError as e:
+                    prettyprint.error(str(e))
+                    packer.kill()
+                    return 1
+                return packer.wait()
+            with Popen(unpack_args, stdin=PIPE) as unpacker:
+                assert unpacker.stdin is not None
+                try:
+                    while True:
+                        chunk = reader.read(PUMP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        unpacker.stdin.write(chunk)
+                    unpacker.stdin.close()
+                except BrokenPipeError:
+                    # The extraction failed, it reports the error
+                    packer.kill()
+                    try:
+                        unpacker.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                unpack_status = unpacker.wait()
+            pack_status = packer.wait()
+    return pack_status if pack_status != 0 else unpack_status
 
 
 def run_docker_save_pipe(
-    image_tag: str, local_work_dir: Path, sshfs_remote_mount_point: Path
+    image_tag: str, local_work_dir: Path, sshfs_remote_mount_point: Path, output_name: str
 ) -> int:
     """Run docker save, piping the output via pigz to compress it, and finally into a file"""
     try:
         command = f"docker save {image_tag}"
-        output_path = sshfs_remote_mount_point / f"{image_tag}.tar.gz"
+        output_path = sshfs_remote_mount_point / output_name
         if verbose:
             print(f"+ {command} | pigz > {output_path}", file=sys.stderr)
         args = shlex.split(command)
         if not dry_run:
-            with Popen(args, stdout=PIPE, cwd=local_work_dir) as docker:
-                output = check_output(("pigz"), stdin=docker.stdout)
+            with trace.span("docker save | pigz", "subprocess", command=command):
+                with Popen(args, stdout=PIPE, cwd=local_work_dir) as docker:
+                    output = check_output(("pigz"), stdin=docker.stdout)
+            with trace.span("sshfs write", "sshfs", path=output_path, bytes=len(output)):
                 with open(output_path, "wb") as fout:
                     fout.write(output)
     except CalledProcessError as e:
@@ -168,11 +764,57 @@ def run_docker_save_pipe(
     return 0
 
 
-def parse_docker_ps_output(output: str) -> Optional[str]:
+def find_container(output: str, container_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Find the container in docker ps output, with one json object per line.
+    The name filter of docker ps matches substrings, so the name is checked for an exact match.
+    If container_name is None, the first container is returned.
+    """
+    for line in output.splitlines():
+        if len(line.strip()) == 0:
+            continue
+        entry = json.loads(line)
+        if container_name is None:
+            return entry
+        if container_name in container_entry_names(entry):
+            return entry
+    return None
+
+
+def run_docker_save_to_engine(image_tag: str, local_work_dir: Path, engine: DockerEngine) -> int:
+    """
+    Run docker save, compress the output with pigz, and stream it directly into the Docker Engine API.
+    Nothing is buffered in memory or written to disk.
+    """
+    command = f"docker save {image_tag}"
+    if verbose:
+        print(f"+ {command} | pigz | POST /images/load", file=sys.stderr)
+    if dry_run:
+        return 0
+    with trace.span("docker save | pigz | POST /images/load", "docker api", command=command):
+        with Popen(shlex.split(command), stdout=PIPE, cwd=local_work_dir) as docker:
+            with Popen(["pigz"], stdin=docker.stdout, stdout=PIPE) as pigz:
+                assert docker.stdout is not None and pigz.stdout is not None
+                # Allow docker save to receive SIGPIPE if pigz exits
+                docker.stdout.close()
+                source = pigz.stdout
+                try:
+                    engine.load_image(iter(lambda: source.read(STREAM_CHUNK_SIZE), b""))
+                except (OSError, DockerEngineError) as e:
+                    prettyprint.error(f"Error loading image: {e}")
+                    return 1
+    if docker.returncode != 0 or pigz.returncode != 0:
+        prettyprint.error(f"Error running docker save: exit status {docker.returncode}, pigz {pigz.returncode}")
+        return docker.returncode or pigz.returncode
+    return 0
+
+
+def parse_docker_ps_output(output: str, container_name: Optional[str] = None) -> Optional[str]:
     """Helper to parse docker ps output"""
-    if len(output) == 0:
+    entry = find_container(output, container_name)
+    if entry is None:
         return None
-    state = json.loads(output).get("State", None)
+    state = entry.get("State", None)
     if state is None:
         return None
     return str(state)
@@ -192,27 +834,256 @@ def determine_acceptable_container_state(
         return None
 
 
-def verify_container_state(session: Session) -> bool:
-    """Orchestrates the container state verification"""
-    command = f"docker ps -a --filter name={session.container_name} --format json"
+def make_docker_command(command: str, session: Session) -> str:
+    """Wrap a docker command in ssh if the docker engine is on the remote host"""
     if session.remote_host is not None:
-        command = make_remote_command(command, session)
+        return make_remote_command(command, session)
+    return command
+
+
+def open_docker_engine(session: Session, transport: Literal["cli", "api"]) -> Optional[DockerEngine]:
+    """
+    Connect to the Docker Engine API, if the api transport is configured.
+
+    For a remote host, the docker socket of the remote host is forwarded to the session directory
+    through the ssh master connection. The forward lives as long as the master connection.
+    Returns None if the cli transport should be used.
+    """
+    if transport != "api" or dry_run:
+        return None
+    if session.remote_host is None:
+        engine = DockerEngine(DOCKER_SOCKET)
+    else:
+        socket_path = session.session_dir / "docker.sock"
+        engine = DockerEngine(socket_path)
+        if not (socket_path.exists() and engine.ping()):
+            if socket_path.exists():
+                # Stale forward from an earlier master connection
+                socket_path.unlink()
+            command = (
+                f"ssh -S {session.session_dir}/ssh-socket-remote -O forward"
+                f" -L {socket_path}:{DOCKER_SOCKET} {session.remote_host}"
+            )
+            run_local_command(command, cwd=session.local_work_dir, silent=not verbose)
+    with trace.span("docker api ping", "docker api"):
+        if engine.ping():
+            return engine
+    prettyprint.warning(f"Docker Engine API not reachable via {engine.socket_path}, falling back to the docker cli")
+    return None
+
+
+def run_engine_call(description: str, call: Callable[[], Any]) -> int:
+    """Make a Docker Engine API call, honoring verbose and dry_run. Returns an exit status, like the commands."""
+    if verbose:
+        print(f"+ {description}", file=sys.stderr)
+    if dry_run:
+        return 0
+    try:
+        with trace.span(description, "docker api"):
+            call()
+    except (OSError, DockerEngineError) as e:
+        prettyprint.error(f"Error in {description}: {e}")
+        return 1
+    return 0
+
+
+def remote_helper_installed(session: Session) -> bool:
+    """Check whether the helper script exists in the remote host build directory"""
+    command = (
+        "ssh"
+        f" -n -S {session.session_dir}/ssh-socket-remote"
+        f" {session.remote_host}"
+        f' "test -f {session.remote_host_build_dir}/{HELPER_NAME}"'
+    )
+    if verbose:
+        print(f"+ {command}", file=sys.stderr)
+    with trace.span("check remote helper", "subprocess", command=command):
+        result = run(shlex.split(command), stdout=DEVNULL, stderr=DEVNULL, cwd=session.local_work_dir)
+    return result.returncode == 0
+
 
+def install_remote_helper(session: Session) -> int:
+    """Copy the helper script into the remote host build directory, which may not exist yet"""
+    command = (
+        "ssh"
+        f" -S {session.session_dir}/ssh-socket-remote"
+        f" {session.remote_host}"
+        f' "mkdir -p {session.remote_host_build_dir}'
+        f' && cd {session.remote_host_build_dir} && cat > {HELPER_NAME}"'
+    )
     if verbose:
         print(f"+ {command}", file=sys.stderr)
     if dry_run:
-        return session.container_state == "running"
+        return 0
+    with trace.span("install remote helper", "subprocess", command=command):
+        result = run(shlex.split(command), input=read_helper_script().encode("utf-8"), cwd=session.local_work_dir)
+    return result.returncode
+
+
+def query_host_status(
+    session: Session,
+    image: Optional[str] = None,
+    container: Optional[str] = None,
+    ports: bool = False,
+    disk: bool = False,
+    files: bool = False,
+    all_images: bool = False,
+    all_containers: bool = False,
+    tarballs: bool = False,
+    install_helper: bool = True,
+) -> Optional[HostStatus]:
+    """
+    Answer a batch of queries about the remote host in a single round trip, using the helper script.
+    The helper is installed on first use: when the query fails and the helper is not there,
+    unless install_helper is False. Returns None for a local session, or on error.
+    """
+    if session.remote_host is None:
+        return None
+    queries = helper_queries(image, container, ports, disk, files, all_images, all_containers, tarballs)
+    command = make_remote_command(format_helper_args(queries), session)
+    if verbose:
+        print(f"+ {command}", file=sys.stderr)
+    if dry_run:
+        return None
+    for attempt in range(2):
+        with trace.span("remote helper", "subprocess", command=command):
+            result = run(shlex.split(command), stdout=PIPE, stderr=PIPE, cwd=session.local_work_dir)
+        if result.returncode != 0 and attempt == 0 and install_helper and not remote_helper_installed(session):
+            if install_remote_helper(session) != 0:
+                prettyprint.error("Error installing the helper script on the remote host")
+                return None
+            continue
+        break
+    if result.returncode != 0:
+        prettyprint.error(f"Error running the helper script on the remote host: exit status {result.returncode}")
+        sys.stderr.write(result.stderr.decode("utf-8", errors="replace"))
+        return None
+    try:
+        return HostStatus.model_validate_json(result.stdout)
+    except ValueError as e:
+        prettyprint.error(f"Error decoding the output of the helper script: {e}")
+        return None
+
 
+def query_listening_ports(session: Session, host_status: Optional[HostStatus] = None) -> Optional[List[int]]:
+    """
+    The ports listening on the host of the container, reusing the answer of an earlier helper query if possible.
+    On the local host the helper script is run directly. Returns None on error.
+    """
+    if host_status is not None and host_status.ports is not None:
+        return host_status.ports
+    if session.remote_host is not None:
+        host_status = query_host_status(session, ports=True)
+    else:
+        host_status = query_local_status(helper_queries(ports=True))
+    return host_status.ports if host_status is not None else None
+
+
+def query_local_status(queries: List[str]) -> Optional[HostStatus]:
+    """Answer a batch of queries about the local host, running the helper script directly. Returns None on error."""
+    if dry_run:
+        return None
+    with trace.span("local helper", "subprocess", queries=queries):
+        result = run(
+            ["sh", "-s"] + queries, input=read_helper_script().encode("utf-8"), stdout=PIPE, stderr=PIPE
+        )
+    if result.returncode != 0:
+        return None
     try:
-        output = check_output(shlex.split(command), cwd=session.local_work_dir)
+        return HostStatus.model_validate_json(result.stdout)
+    except ValueError:
+        return None
+
+
+def query_container_state(
+    session: Session, engine: Optional[DockerEngine] = None, host_status: Optional[HostStatus] = None
+) -> Optional[CachedContainerState]:
+    """Ask docker for the state of the container. Returns None on error."""
+    if host_status is not None and host_status.containers is not None:
+        entry = host_status.find_container(session.container_name)
+        return CachedContainerState(
+            container_name=session.container_name,
+            container_id=str(entry["ID"]) if entry is not None and "ID" in entry else None,
+            state=str(entry["State"]) if entry is not None and "State" in entry else None,
+            checked_at=time.time(),
+        )
+    if engine is not None:
+        try:
+            with trace.span("GET /containers/json", "docker api"):
+                entries = engine.containers(name=session.container_name)
+        except (OSError, DockerEngineError) as e:
+            prettyprint.error(f"Error listing containers: {e}")
+            return None
+        entry = next((entry for entry in entries if session.container_name in container_entry_names(entry)), None)
+        return CachedContainerState(
+            container_name=session.container_name,
+            container_id=str(entry["Id"]) if entry is not None else None,
+            state=str(entry["State"]) if entry is not None else None,
+            checked_at=time.time(),
+        )
+    command = make_docker_command(
+        f"docker ps -a --filter name=^{session.container_name}$ --format json", session
+    )
+    if verbose:
+        print(f"+ {command}", file=sys.stderr)
+    try:
+        with trace.span("docker ps", "subprocess", command=command):
+            output = check_output(shlex.split(command), cwd=session.local_work_dir)
+        entry = find_container(output.decode("utf-8"), session.container_name)
     except CalledProcessError as e:
         prettyprint.error(f"Error running docker ps: {e}")
-        return False
+        return None
     except json.JSONDecodeError as e:
         prettyprint.error(f"Error decoding docker ps output: {e}")
-        return False
+        return None
+    return CachedContainerState(
+        container_name=session.container_name,
+        container_id=str(entry["ID"]) if entry is not None and "ID" in entry else None,
+        state=str(entry["State"]) if entry is not None and "State" in entry else None,
+        checked_at=time.time(),
+    )
+
+
+def record_container_state(session: Session, state: Optional[str]) -> None:
+    """Update the state cache after dockerdo itself changed the state of the container"""
+    if dry_run:
+        return
+    cached = load_cached_state(session.session_dir, session.container_name, max_age=float("inf"))
+    if cached is None:
+        cached = CachedContainerState(container_name=session.container_name, checked_at=time.time())
+    cached.state = state
+    cached.checked_at = time.time()
+    save_cached_state(session.session_dir, cached)
 
-    actual_state = parse_docker_ps_output(output.decode("utf-8"))
+
+def verify_container_state(
+    session: Session,
+    max_age: float = 0.0,
+    engine: Optional[DockerEngine] = None,
+    host_status: Optional[HostStatus] = None,
+) -> bool:
+    """
+    Orchestrates the container state verification.
+    A cached state is used if it is younger than max_age seconds, or kept up to date by docker events.
+    A fresh answer from the helper script takes precedence over the cache.
+    """
+    if dry_run:
+        if verbose:
+            print(f"+ docker ps -a --filter name=^{session.container_name}$ --format json", file=sys.stderr)
+        return session.container_state == "running"
+
+    cached = None
+    if host_status is None or host_status.containers is None:
+        cached = load_cached_state(session.session_dir, session.container_name, max_age=max_age)
+    if cached is None:
+        cached = query_container_state(session, engine=engine, host_status=host_status)
+        if cached is None:
+            return False
+        save_cached_state(session.session_dir, cached)
+    elif verbose:
+        prettyprint.info(f"Using cached container state {cached.state}")
+
+    actual_state = cached.state
     acceptable_state = determine_acceptable_container_state(actual_state)
     if acceptable_state is None:
         prettyprint.error(f"Unexpected container state: {actual_state}")
@@ -226,30 +1097,195 @@ def verify_container_state(session: Session) -> bool:
     return acceptable_state == "running"
 
 
-def run_ssh_master_process(session: Session, remote_host: str, ssh_port_on_remote_host: int) -> Optional[Popen]:
-    """Runs an ssh command with the -M option to create a master connection. This will run indefinitely."""
+def format_ssh_master_command(session: Session, remote_host: str, ssh_port_on_remote_host: int) -> str:
+    """An ssh command with the -M option to create a master connection. This will run indefinitely."""
     if session.remote_host is None:
         jump_flag = ""
     else:
         jump_flag = f"-J {session.remote_host}"
-    command = (
+    forward_flags = ""
+    if session.exec_server:
+        # Reachable as long as the master connection is up. A new master replaces the socket of the previous one.
+        forward_flags = (
+            f" -o StreamLocalBindUnlink=yes -L {session.session_dir / EXEC_SOCKET}:{REMOTE_SOCKET}"
+        )
+    return (
         f"ssh {jump_flag} -M -N -S {session.session_dir}/ssh-socket-container -p {ssh_port_on_remote_host}"
-        f" {session.container_username}@{remote_host} -o StrictHostKeyChecking=no"
+        f" {session.container_username}@{remote_host} -o StrictHostKeyChecking=no {SSH_KEEPALIVE_OPTIONS}"
+        f"{forward_flags}"
     )
-    if verbose:
-        print(f"+ {command}", file=sys.stderr)
-    if not dry_run:
-        try:
-            return Popen(
-                shlex.split(command), stdin=None, stdout=None, stderr=None, cwd=session.local_work_dir
+
+
+def make_session_supervisor(
+    session: Session, remote_host: str, ssh_port_on_remote_host: int, record: bool
+) -> Supervisor:
+    """
+    The components of a running session: the ssh master connection to the container,
+    the sshfs mount of the container filesystem, the docker events subscription,
+    and optionally the prefetch of the hot paths, the recorder and the exec server.
+    """
+    master_socket = session.session_dir / "ssh-socket-container"
+    mount_point = session.sshfs_container_mount_point
+
+    def remove_stale_socket() -> None:
+        if master_socket.exists():
+            master_socket.unlink()
+
+    def unmount_stale_mount() -> None:
+        # A lazy unmount also detaches a hung mount, without waiting for it. Fails harmlessly if not mounted.
+        run_local_command(f"fusermount -u -z {mount_point}", cwd=session.local_work_dir, silent=True)
+        os.makedirs(mount_point, exist_ok=True)
+
+    components: List[Component] = [
+        ProcessComponent(
+            "ssh master",
+            "SSH socket",
+            shlex.split(format_ssh_master_command(session, remote_host, ssh_port_on_remote_host)),
+            cwd=session.local_work_dir,
+            running_verb="Creating",
+            done_verb="Created",
+            ready_check=master_socket.exists,
+            health_check=lambda: ssh_master_alive(master_socket, SSH_CHECK_TIMEOUT),
+            before_start=remove_stale_socket,
+            reconnect=True,
+        ),
+        ProcessComponent(
+            "sshfs",
+            "container filesystem",
+            shlex.split(
+                f"sshfs -f -p {ssh_port_on_remote_host} {SSHFS_RECONNECT_OPTIONS} {session.sshfs_cache_options}"
+                f" {session.container_username}@{remote_host}:/"
+                f" {mount_point}"
+            ),
+            cwd=session.local_work_dir,
+            running_verb="Mounting",
+            done_verb="Mounted",
+            ready_check=mount_point.is_mount,
+            health_check=lambda: probe_path(mount_point, MOUNT_PROBE_TIMEOUT),
+            before_start=unmount_stale_mount,
+            reconnect=True,
+        ),
+    ]
+    if len(session.prefetch_paths) > 0:
+        components.append(PrefetchComponent(session))
+    cached = load_cached_state(session.session_dir, session.container_name, max_age=float("inf"))
+    if cached is None:
+        cached = CachedContainerState(container_name=session.container_name, state="running", checked_at=time.time())
+    events_command = make_docker_command(
+        f"docker events --filter type=container --filter container={session.container_name}"
+        " --format '{{json .}}'",
+        session,
+    )
+    components.append(
+        EventsComponent(shlex.split(events_command), session.local_work_dir, session.session_dir, cached)
+    )
+    if record:
+        components.append(RecorderComponent(session, verbose=verbose))
+    if session.exec_server:
+        exec_socket = session.session_dir / EXEC_SOCKET
+        components.append(
+            ProcessComponent(
+                "exec server",
+                "exec server",
+                [
+                    "ssh", "-S", str(master_socket),
+                    *shlex.split(format_container_ssh_destination(session)),
+                    "-o", "StrictHostKeyChecking=no",
+                    format_exec_server_command(),
+                ],
+                cwd=session.local_work_dir,
+                host="container",
+                ready_check=exec_socket.exists,
+                reconnect=True,
+                keep_stdin_open=True,
             )
-        except CalledProcessError as e:
-            prettyprint.error(f"Error running ssh master process: {e}")
-            return None
-    else:
+        )
+    return Supervisor(session, components)
+
+
+def send_supervisor_request(
+    session: Session, request: Literal["status", "shutdown", "reconnect"]
+) -> Optional[Dict[str, Any]]:
+    """
+    Send a request to the session supervisor through its control socket.
+    Returns None if no supervisor is running.
+    """
+    control_path = session.session_dir / CONTROL_SOCKET
+    if not control_path.exists():
+        return None
+    if verbose:
+        print(f"+ {request} > {control_path}", file=sys.stderr)
+    if dry_run and request != "status":
+        return None
+    try:
+        with trace.span(f"supervisor {request}", "supervisor"):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(SUPERVISOR_TIMEOUT)
+                sock.connect(str(control_path))
+                sock.sendall(f"{request}\n".encode("utf-8"))
+                with sock.makefile("rb") as response:
+                    return dict(json.loads(response.readline()))
+    except (OSError, ValueError):
         return None
 
 
+def container_connection_alive(session: Session) -> bool:
+    """
+    Check that the ssh master connection to the container is alive, and that the sshfs mount responds.
+    Fast: no processes are spawned, the master is given SSH_CHECK_TIMEOUT seconds,
+    and a hung mount MOUNT_PROBE_TIMEOUT seconds.
+    A master whose network connection died still answers until its keepalives time out, about 15 seconds.
+    """
+    mount_point = session.sshfs_container_mount_point
+    return (
+        ssh_master_alive(session.session_dir / "ssh-socket-container", SSH_CHECK_TIMEOUT)
+        and probe_path(mount_point, MOUNT_PROBE_TIMEOUT)
+        and mount_point.is_mount()
+    )
+
+
+def ensure_container_connection(session: Session) -> bool:
+    """
+    Detect a dead ssh master connection or a hung sshfs mount, e.g. after the laptop slept or the network changed.
+    The session supervisor is asked to reconnect immediately, instead of each command hanging until a timeout.
+    Returns False if the connection could not be re-established.
+    """
+    if dry_run or not (session.session_dir / CONTROL_SOCKET).exists():
+        # Without a supervisor there is no connection to keep up
+        return True
+    with trace.span("check connection", "supervisor"):
+        if container_connection_alive(session):
+            return True
+    prettyprint.warning("Connection to the container lost, reconnecting")
+    if send_supervisor_request(session, "reconnect") is None:
+        prettyprint.warning("No session supervisor running to reconnect")
+        return False
+    with trace.span("reconnect", "supervisor"):
+        deadline = time.monotonic() + RECONNECT_TIMEOUT
+        while time.monotonic() < deadline:
+            if container_connection_alive(session):
+                prettyprint.action("local", "Reconnected", "to the container")
+                return True
+            time.sleep(0.2)
+    prettyprint.error("Could not reconnect to the container")
+    return False
+
+
+def stop_supervisor(session: Session) -> bool:
+    """
+    Ask the session supervisor to shut down, and wait until it has stopped its components.
+    Returns False if no supervisor was running.
+    """
+    if send_supervisor_request(session, "shutdown") is None:
+        return False
+    control_path = session.session_dir / CONTROL_SOCKET
+    with trace.span("supervisor shutdown", "supervisor"):
+        deadline = time.monotonic() + SUPERVISOR_TIMEOUT
+        while control_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.1)
+    return True
+
+
 def detect_background() -> bool:
     """Detect if the process is running in the background"""
     try:
@@ -263,7 +1299,8 @@ def detect_ssh_agent() -> bool:
     if "SSH_AUTH_SOCK" not in os.environ:
         return False
     try:
-        output = check_output(["ssh-add", "-l"])
+        with trace.span("ssh-add", "subprocess", command="ssh-add -l"):
+            output = check_output(["ssh-add", "-l"])
         return len(output) > 0
     except CalledProcessError:
         return False
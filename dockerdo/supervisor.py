@@ -0,0 +1,470 @@
+"""Supervisor for the long-running processes of a session"""
+
+import abc
+import asyncio
+import json
+import os
+import signal
+import threading
+import time
+from asyncio.subprocess import DEVNULL, PIPE
+from contextlib import nullcontext, AbstractContextManager
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Callable
+
+from dockerdo import prettyprint, trace
+from dockerdo.config import Session
+from dockerdo.container_state import CachedContainerState, apply_event, save_cached_state
+from dockerdo.prefetch import PrefetchStats, prefetch_tree
+from dockerdo.prettyprint import Host
+
+CONTROL_SOCKET = "supervisor.sock"
+BACKOFF_INITIAL = 1.0
+BACKOFF_MAX = 60.0
+# A component that stayed up at least this long is healthy again, and its backoff is reset
+STABLE_AFTER = 30.0
+READY_TIMEOUT = 30.0
+READY_INTERVAL = 0.1
+STOP_TIMEOUT = 5.0
+# Seconds between health checks of the running components
+WATCHDOG_INTERVAL = 10.0
+
+
+class Component(abc.ABC):
+    """
+    A long-running part of a session, restarted with backoff by the supervisor if it stops.
+    Subclasses implement run, which returns an exit status when the component stops.
+    """
+
+    host: Host = "local"
+    running_verb = "Starting"
+    done_verb = "Started"
+
+    def __init__(self, name: str, message: str) -> None:
+        self.name = name
+        self.message = message
+        self.state = "pending"
+        self.pid: Optional[int] = None
+        self.restarts = 0
+        self.last_exit: Optional[int] = None
+        self.started_at: Optional[float] = None
+        self.was_ready = False
+        self.supervisor: Optional["Supervisor"] = None
+        # Restart immediately on a reconnect request, or when the health check fails
+        self.reconnect = False
+        self.restart_now = False
+        self.wake = asyncio.Event()
+
+    @abc.abstractmethod
+    async def run(self) -> int:
+        """Run the component until it stops, returning its exit status"""
+
+    def ready(self) -> bool:
+        """Whether the component is up. Only checked while starting the session."""
+        return True
+
+    def healthy(self) -> bool:
+        """Whether the running component still works. Checked periodically, outside of the event loop."""
+        return True
+
+    async def stop(self) -> None:
+        pass
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "pid": self.pid,
+            "restarts": self.restarts,
+            "last_exit": self.last_exit,
+            "started_at": self.started_at,
+        }
+
+
+class ProcessComponent(Component):
+    """A component that is a subprocess, e.g. the ssh master connection or sshfs in the foreground"""
+
+    def __init__(
+        self,
+        name: str,
+        message: str,
+        command: List[str],
+        cwd: Path,
+        host: Host = "local",
+        running_verb: str = "Starting",
+        done_verb: str = "Started",
+        ready_check: Optional[Callable[[], bool]] = None,
+        health_check: Optional[Callable[[], bool]] = None,
+        before_start: Optional[Callable[[], None]] = None,
+        on_line: Optional[Callable[[str], None]] = None,
+        reconnect: bool = False,
+        keep_stdin_open: bool = False,
+    ) -> None:
+        super().__init__(name, message)
+        self.command = command
+        self.cwd = cwd
+        self.host = host
+        self.running_verb = running_verb
+        self.done_verb = done_verb
+        self.ready_check = ready_check
+        self.health_check = health_check
+        self.reconnect = reconnect
+        self.before_start = before_start
+        self.on_line = on_line
+        # A remote command run through ssh sees the end of its stdin when the component is stopped
+        self.keep_stdin_open = keep_stdin_open
+        self.process: Optional[asyncio.subprocess.Process] = None
+
+    async def run(self) -> int:
+        if self.before_start is not None:
+            # Cleanup such as unmounting may block, so it must not run in the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.before_start)
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=PIPE if self.keep_stdin_open else DEVNULL,
+            stdout=PIPE if self.on_line is not None else None,
+            cwd=self.cwd,
+        )
+        self.pid = self.process.pid
+        trace.instant(self.name, "supervisor", command=" ".join(self.command), pid=self.pid)
+        if self.supervisor is not None and self.supervisor.shutting_down:
+            # Shutdown was requested while starting, before stop could see the process
+            await self.stop()
+        if self.on_line is None:
+            return await self.process.wait()
+        reader = asyncio.create_task(self._read_lines(self.process.stdout))
+        retval = await self.process.wait()
+        try:
+            # Children of the process may keep the pipe open after it exits
+            await asyncio.wait_for(reader, timeout=STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        return retval
+
+    async def _read_lines(self, stream: Optional[asyncio.StreamReader]) -> None:
+        assert stream is not None and self.on_line is not None
+        async for line in stream:
+            self.on_line(line.decode("utf-8", errors="replace"))
+
+    def ready(self) -> bool:
+        return self.ready_check() if self.ready_check is not None else True
+
+    def healthy(self) -> bool:
+        return self.health_check() if self.health_check is not None else True
+
+    async def stop(self) -> None:
+        process = self.process
+        if process is None or process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+class RecorderComponent(Component):
+    """Records the files modified in the container, driven by inotify events on the event loop"""
+
+    def __init__(self, session: Session, verbose: bool = False) -> None:
+        super().__init__("recorder", "filesystem events")
+        self.session = session
+        self.verbose = verbose
+        self._done: Optional["asyncio.Future[int]"] = None
+
+    async def run(self) -> int:
+        import dockerdo.inotify
+
+        loop = asyncio.get_running_loop()
+        listener = dockerdo.inotify.InotifyListener(self.session)
+        # The initial scan of the directory tree uses its own threads
+        await loop.run_in_executor(None, listener.register_listeners)
+        inotify = listener.inotify
+        assert inotify is not None
+        done: "asyncio.Future[int]" = loop.create_future()
+        self._done = done
+
+        def on_readable() -> None:
+            try:
+                if not listener.handle_events(inotify.read(timeout=0), verbose=self.verbose):
+                    # Backing filesystem unmounted
+                    if not done.done():
+                        done.set_result(0)
+            except OSError as e:
+                prettyprint.error(f"No longer listening to filesystem events due to error: {e}")
+                if not done.done():
+                    done.set_result(1)
+
+        loop.add_reader(inotify.fileno(), on_readable)
+        self.pid = os.getpid()
+        try:
+            return await done
+        finally:
+            loop.remove_reader(inotify.fileno())
+            inotify.close()
+
+    async def stop(self) -> None:
+        if self._done is not None and not self._done.done():
+            self._done.set_result(0)
+
+
+class PrefetchComponent(Component):
+    """
+    Keeps the sshfs cache of the hot paths of the container warm, listing them again whenever the cache expires.
+    Changes made in the container show up once the cached entries expire, like without the prefetch.
+    """
+
+    def __init__(self, session: Session) -> None:
+        super().__init__("prefetch", f"metadata prefetch of {', '.join(str(path) for path in session.prefetch_paths)}")
+        self.session = session
+        self.last_prefetch: Optional[PrefetchStats] = None
+        self._stopping = threading.Event()
+
+    def prefetch(self) -> None:
+        with trace.span("prefetch", "sshfs", paths=len(self.session.prefetch_paths)) as span_args:
+            stats = prefetch_tree(
+                self.session.sshfs_container_mount_point,
+                self.session.prefetch_paths,
+                max_entries=self.session.sshfs_cache_max_size,
+                stop=self._stopping,
+            )
+            span_args.update(stats._asdict())
+        if stats.truncated and self.last_prefetch is None:
+            prettyprint.warning(
+                f"Prefetched the metadata of only {stats.entries} entries: raise sshfs_cache_max_size to cache more"
+            )
+        self.last_prefetch = stats
+
+    async def run(self) -> int:
+        loop = asyncio.get_running_loop()
+        self._stopping.clear()
+        self.pid = os.getpid()
+        while not self._stopping.is_set():
+            await loop.run_in_executor(None, self.prefetch)
+            await loop.run_in_executor(None, self._stopping.wait, self.session.sshfs_cache_timeout)
+        return 0
+
+    async def stop(self) -> None:
+        self._stopping.set()
+
+
+class Supervisor:
+    """
+    Owns the long-running processes of a session on a single event loop:
+    the ssh master connection, the sshfs mount, the docker events subscription and the change recorder.
+    Components are started in order, each when the previous one is ready, and restarted with backoff if they stop.
+    A control socket in the session directory answers health queries and shutdown requests.
+    """
+
+    def __init__(self, session: Session, components: List[Component]) -> None:
+        self.session = session
+        self.components = components
+        for component in components:
+            component.supervisor = self
+        self.control_path = session.session_dir / CONTROL_SOCKET
+        self.started_at = time.time()
+        self.shutdown_reason: Optional[str] = None
+        self._shutdown: Optional[asyncio.Event] = None
+
+    def request_shutdown(self, reason: str) -> None:
+        if self.shutdown_reason is None:
+            self.shutdown_reason = reason
+            trace.instant("shutdown", "supervisor", reason=reason)
+        if self._shutdown is not None:
+            self._shutdown.set()
+        for component in self.components:
+            component.wake.set()
+
+    async def reconnect(self, reason: str) -> None:
+        """Restart the connections immediately, skipping any backoff"""
+        trace.instant("reconnect", "supervisor", reason=reason)
+        for component in self.components:
+            if component.reconnect:
+                await self.restart(component)
+
+    async def restart(self, component: Component) -> None:
+        component.restart_now = True
+        component.wake.set()
+        await component.stop()
+
+    @property
+    def shutting_down(self) -> bool:
+        return self._shutdown is not None and self._shutdown.is_set()
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "session": self.session.name,
+            "uptime": time.time() - self.started_at,
+            "components": {component.name: component.health() for component in self.components},
+        }
+
+    async def run(self, show_progress: bool = True) -> int:
+        """Run until shutdown is requested through the control socket, by a signal, or because the container stopped"""
+        loop = asyncio.get_running_loop()
+        self._shutdown = asyncio.Event()
+        if self.shutdown_reason is not None:
+            self._shutdown.set()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            loop.add_signal_handler(signum, self.request_shutdown, f"signal {signal.Signals(signum).name}")
+        if self.control_path.exists():
+            # Left behind by a supervisor that was killed
+            self.control_path.unlink()
+        server = await asyncio.start_unix_server(self._handle_control, path=str(self.control_path))
+        tasks: List[asyncio.Task] = [asyncio.create_task(self._watchdog())]
+        try:
+            for component in self.components:
+                ctx_mgr: AbstractContextManager = nullcontext()
+                if show_progress:
+                    ctx_mgr = prettyprint.LongAction(
+                        host=component.host,
+                        running_verb=component.running_verb,
+                        done_verb=component.done_verb,
+                        running_message=component.message,
+                    )
+                with ctx_mgr as task:
+                    tasks.append(asyncio.create_task(self._supervise(component)))
+                    if await self._wait_ready(component) and task:
+                        task.set_status("OK")
+            await self._shutdown.wait()
+        finally:
+            # Stop in reverse order: the recorder before the mount, the mount before the ssh master
+            self._shutdown.set()
+            for component in reversed(self.components):
+                await component.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            server.close()
+            await server.wait_closed()
+            if self.control_path.exists():
+                self.control_path.unlink()
+        if self.shutdown_reason is not None:
+            prettyprint.info(f"Session supervisor stopped: {self.shutdown_reason}")
+        return 0
+
+    async def _wait_ready(self, component: Component) -> bool:
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline and not self.shutting_down:
+            if component.state == "running" and component.ready():
+                component.was_ready = True
+                return True
+            await asyncio.sleep(READY_INTERVAL)
+        return False
+
+    async def _supervise(self, component: Component) -> None:
+        assert self._shutdown is not None
+        backoff = BACKOFF_INITIAL
+        while not self.shutting_down:
+            component.state = "running"
+            component.started_at = time.time()
+            started = time.monotonic()
+            try:
+                retval = await component.run()
+            except OSError as e:
+                prettyprint.error(f"Error running {component.name}: {e}")
+                retval = 1
+            component.last_exit = retval
+            component.pid = None
+            if self.shutting_down:
+                break
+            if time.monotonic() - started >= STABLE_AFTER:
+                backoff = BACKOFF_INITIAL
+            if component.restart_now:
+                component.restart_now = False
+                component.restarts += 1
+                backoff = BACKOFF_INITIAL
+                continue
+            component.state = "backoff"
+            if component.was_ready:
+                # Failures while starting up are expected, e.g. sshd in the container is not yet listening
+                prettyprint.warning(f"{component.name} exited with status {retval}, restarting in {backoff:.0f} s")
+            trace.instant(f"{component.name} exited", "supervisor", exit_code=retval, backoff=backoff)
+            component.wake.clear()
+            try:
+                # Woken up early by shutdown or a reconnect request
+                await asyncio.wait_for(component.wake.wait(), timeout=backoff)
+            except asyncio.TimeoutError:
+                pass
+            if component.restart_now:
+                component.restart_now = False
+                backoff = BACKOFF_INITIAL
+            else:
+                backoff = min(backoff * 2, BACKOFF_MAX)
+            component.restarts += 1
+        component.state = "stopped"
+
+    async def _watchdog(self) -> None:
+        """
+        Periodically check the health of the running components, and restart those that no longer work.
+        E.g. a hung sshfs mount does not make sshfs exit, but it does make the mount point unresponsive.
+        """
+        loop = asyncio.get_running_loop()
+        assert self._shutdown is not None
+        while not self.shutting_down:
+            try:
+                await asyncio.wait_for(self._shutdown.wait(), timeout=WATCHDOG_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            for component in self.components:
+                if component.state != "running" or not component.was_ready:
+                    continue
+                if component.started_at is not None and time.time() - component.started_at < WATCHDOG_INTERVAL:
+                    # Give a restarted component time to come up
+                    continue
+                if not await loop.run_in_executor(None, component.healthy):
+                    prettyprint.warning(f"{component.name} is not responding, restarting")
+                    await self.restart(component)
+
+    async def _handle_control(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Line-based protocol: each request is a single word, answered with a single json object"""
+        try:
+            request = (await reader.readline()).decode("utf-8").strip()
+            if request == "status":
+                response: Dict[str, Any] = self.health()
+            elif request == "shutdown":
+                self.request_shutdown("shutdown requested")
+                response = {"ok": True}
+            elif request == "reconnect":
+                await self.reconnect("reconnect requested")
+                response = {"ok": True}
+            else:
+                response = {"error": f"unknown request {request!r}"}
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+class EventsComponent(ProcessComponent):
+    """
+    Subscribes to docker events for the container, and keeps the cached container state up to date.
+    Shuts the supervisor down once the container has stopped or is removed.
+    The command must run `docker events` with json formatting, possibly wrapped in ssh.
+    """
+
+    def __init__(self, command: List[str], cwd: Path, session_dir: Path, cached: CachedContainerState) -> None:
+        super().__init__("events", "docker events", command, cwd, host="remote", on_line=self.on_line)
+        self.session_dir = session_dir
+        self.cached = cached
+
+    async def run(self) -> int:
+        self.cached.watcher_pid = os.getpid()
+        save_cached_state(self.session_dir, self.cached)
+        try:
+            return await super().run()
+        finally:
+            # Without the subscription, the cache is only valid until it expires
+            self.cached.watcher_pid = None
+            self.cached.checked_at = time.time()
+            save_cached_state(self.session_dir, self.cached)
+
+    def on_line(self, line: str) -> None:
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        if apply_event(self.cached, event, watcher_pid=os.getpid()):
+            save_cached_state(self.session_dir, self.cached)
+            # A paused container, e.g. during docker commit, runs again after: only a stop or removal ends the session
+            if self.cached.state in ("exited", None) and self.supervisor is not None:
+                self.supervisor.request_shutdown(f"container {self.cached.state or 'removed'}")
@@ -0,0 +1,113 @@
+"""Timed spans of dockerdo activity, written in Chrome trace-event format"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Iterator
+
+from dockerdo.utils import process_start_time
+
+_trace_path: Optional[Path] = None
+_trace_name = "dockerdo"
+_trace_start: float = 0.0
+_events: List[Dict[str, Any]] = []
+_lock = threading.Lock()
+
+
+def _now_us() -> float:
+    """Wall clock time in microseconds, so that traces of several processes line up"""
+    return time.time() * 1e6
+
+
+def is_enabled() -> bool:
+    return _trace_path is not None
+
+
+def enable(path: Path, name: str = "dockerdo") -> None:
+    """
+    Start collecting spans, to be written to path when the process exits.
+    If path is a directory, each process writes a separate file into it.
+    """
+    global _trace_path, _trace_name, _trace_start
+    if path.is_dir():
+        path = path / f"dockerdo-{name}-{os.getpid()}.json"
+    _trace_path = path
+    _trace_name = name
+    # The span of the whole command includes interpreter startup
+    _trace_start = process_start_time() * 1e6
+    atexit.register(write)
+
+
+def _add_event(event: Dict[str, Any]) -> None:
+    event.setdefault("pid", os.getpid())
+    event.setdefault("tid", threading.get_ident())
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Record a complete event spanning the body of the with statement.
+    The yielded dict can be used to add args that are only known at the end of the span.
+    """
+    if not is_enabled():
+        yield args
+        return
+    start = _now_us()
+    try:
+        yield args
+    finally:
+        _add_event({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": _now_us() - start,
+            "args": {key: str(value) for key, value in args.items()},
+        })
+
+
+def instant(name: str, category: str, **args: Any) -> None:
+    """Record an event without duration"""
+    if not is_enabled():
+        return
+    _add_event({
+        "name": name,
+        "cat": category,
+        "ph": "i",
+        "s": "t",
+        "ts": _now_us(),
+        "args": {key: str(value) for key, value in args.items()},
+    })
+
+
+def sleep(seconds: float, reason: str) -> None:
+    """time.sleep, recorded as a span"""
+    with span("sleep", "sleep", seconds=seconds, reason=reason):
+        time.sleep(seconds)
+
+
+def write() -> None:
+    """Write the collected events, with a span covering the whole command"""
+    if _trace_path is None:
+        return
+    events = [{
+        "name": _trace_name,
+        "cat": "command",
+        "ph": "X",
+        "ts": _trace_start,
+        "dur": _now_us() - _trace_start,
+        "pid": os.getpid(),
+        "tid": threading.main_thread().ident,
+        "args": {"argv": " ".join(sys.argv)},
+    }]
+    with _lock:
+        events.extend(_events)
+    with open(_trace_path, "w") as fout:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fout)
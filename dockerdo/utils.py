@@ -1,10 +1,23 @@
 """Utility functions for dockerdo"""
 
+import math
+import os
 import random
+import socket
 import string
+import struct
+import threading
 import time
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Sequence, List, Tuple
+
+_IMPORT_TIME = time.time()
+SNAPSHOT_TAG_INFIX = "-snapshot-"
+# Messages of the ssh connection multiplexing protocol
+MUX_VERSION = 4
+MUX_MSG_HELLO = 0x00000001
+MUX_C_ALIVE_CHECK = 0x10000004
+MUX_S_ALIVE = 0x80000005
 
 
 def ephemeral_container_name() -> str:
@@ -41,6 +54,117 @@ def make_image_tag(
         return f"{docker_registry}/{image_tag}"
 
 
+def split_image_reference(reference: str) -> Tuple[str, str]:
+    """Split an image reference into repository and tag. The registry may contain a port, e.g. host:5000/image."""
+    repository, _, tag = reference.rpartition(":")
+    if len(repository) == 0 or "/" in tag:
+        return reference, "latest"
+    return repository, tag
+
+
+def make_snapshot_tag(image_tag: str, snapshot_name: str) -> str:
+    """The image of a snapshot is tagged next to the image of the session, e.g. dockerdo-ubuntu:latest-foo-snapshot-1"""
+    repository, tag = split_image_reference(image_tag)
+    return f"{repository}:{tag}{SNAPSHOT_TAG_INFIX}{snapshot_name}"
+
+
+def snapshot_base_image(reference: str) -> str:
+    """The image of the session that a snapshot belongs to, always with a tag. Other images are returned as is."""
+    repository, tag = split_image_reference(reference)
+    return f"{repository}:{tag.split(SNAPSHOT_TAG_INFIX, 1)[0]}"
+
+
 def empty_or_nonexistent(path: Path) -> bool:
     """Check if a path is empty or nonexistent"""
     return not path.exists() or not any(path.iterdir())
+
+
+def process_start_time() -> float:
+    """
+    Get the wall clock time when the current process was started, including interpreter startup.
+    Falls back to the time this module was imported, if /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat", "r") as fin:
+            # The command name may contain spaces, so skip past its closing parenthesis
+            fields = fin.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        with open("/proc/stat", "r") as fin:
+            boot_time = next(int(line.split()[1]) for line in fin if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return _IMPORT_TIME
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Percentile q (0-100) of the values, using linear interpolation. None if there are no values."""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _mux_send(sock: socket.socket, *values: int) -> None:
+    payload = struct.pack(f">{len(values)}I", *values)
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def _mux_receive(sock: socket.socket) -> bytes:
+    """Read one message: a 32 bit length followed by the payload"""
+    data = b""
+    length: Optional[int] = None
+    while length is None or len(data) < length:
+        if length is None and len(data) >= 4:
+            (length,) = struct.unpack(">I", data[:4])
+            data = data[4:]
+            continue
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("control socket closed")
+        data += chunk
+    return data
+
+
+def ssh_master_alive(path: Path, timeout: float) -> bool:
+    """
+    Check that an ssh master answers on its control socket: the equivalent of `ssh -O check`, without spawning ssh.
+    Speaks the connection multiplexing protocol of OpenSSH (PROTOCOL.mux), giving up after timeout seconds.
+    The master answers as long as it runs: when the network is gone, until the keepalives make it give up.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(path))
+            _mux_send(sock, MUX_MSG_HELLO, MUX_VERSION)
+            (message_type,) = struct.unpack(">I", _mux_receive(sock)[:4])
+            if message_type != MUX_MSG_HELLO:
+                return False
+            _mux_send(sock, MUX_C_ALIVE_CHECK, 1)
+            message_type, request_id = struct.unpack(">II", _mux_receive(sock)[:8])
+    except (OSError, struct.error):
+        return False
+    return message_type == MUX_S_ALIVE and request_id == 1
+
+
+def probe_path(path: Path, timeout: float) -> bool:
+    """
+    Check that the path can be stat'ed within the timeout.
+    On a hung FUSE mount stat blocks indefinitely, so it runs in a daemon thread that may be left behind.
+    """
+    result: List[bool] = []
+
+    def stat() -> None:
+        try:
+            os.stat(path)
+            result.append(True)
+        except OSError:
+            # e.g. "Transport endpoint is not connected" after sshfs died
+            result.append(False)
+
+    thread = threading.Thread(target=stat, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return bool(result) and result[0]
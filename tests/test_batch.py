@@ -0,0 +1,78 @@
+"""Test the batch module"""
+
+import io
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from dockerdo.batch import BatchError, BatchMarkerFilter, BatchRun, format_batch_script, parse_batch
+
+
+def test_parse_batch():
+    text = (
+        "# provision\n"
+        "\n"
+        "apt-get update\n"
+        "cd build\n"
+        "echo 'a b' c#d\n"
+        "cd ../../srv\n"
+        "make \\\n"
+        "    install\n"
+    )
+    commands = parse_batch(text, Path("/opt/project"))
+    assert [(c.command, c.work_dir, c.line_number) for c in commands] == [
+        ("apt-get update", Path("/opt/project"), 3),
+        ("echo 'a b' 'c#d'", Path("/opt/project/build"), 5),
+        ("make install", Path("/opt/srv"), 7),
+    ]
+
+
+@pytest.mark.parametrize("text", ["cd\n", "cd a b\n", "echo 'unbalanced\n"])
+def test_parse_batch_invalid(text):
+    with pytest.raises(BatchError, match="Line 1"):
+        parse_batch(text, Path("/"))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_batch_marker_filter(chunk_size):
+    data = (
+        b"out\x1e\n\x1edockerdo-batch 0 2 1000000000 3500000000\n"
+        # date without %N
+        b"\x1edockerdo-batch 1 0 1700000000N 1700000001N\nmore\x1edockerdo-bat"
+    )
+    markers = []
+    destination = io.BytesIO()
+    marker_filter = BatchMarkerFilter(destination, lambda *marker: markers.append(marker))
+    for i in range(0, len(data), chunk_size):
+        marker_filter.write(data[i:i + chunk_size])
+    marker_filter.close()
+    assert markers == [(0, 2, 2.5), (1, 0, None)]
+    assert destination.getvalue() == b"out\x1e\nmore\x1edockerdo-bat"
+    assert marker_filter.byte_count == len(destination.getvalue())
+
+
+@pytest.mark.parametrize("keep_going, expected_status, expected_results", [
+    (False, 3, [("echo $GREETING", 0), ("pwd", 0), ("sh -c 'exit 3'", 3)]),
+    (True, 3, [("echo $GREETING", 0), ("pwd", 0), ("sh -c 'exit 3'", 3), ("true", 0)]),
+])
+def test_format_batch_script(tmp_path, keep_going, expected_status, expected_results):
+    (tmp_path / "sub").mkdir()
+    text = "echo $GREETING\ncd sub\npwd\nsh -c 'exit 3'\ntrue\n"
+    commands = parse_batch(text, tmp_path)
+    script = format_batch_script(commands, {"GREETING": "hello"}, keep_going=keep_going)
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    finished = []
+    batch = BatchRun(commands, stdout, stderr, on_result=finished.append)
+    process = subprocess.run(["sh", "-c", script], capture_output=True)
+    batch.stdout.write(process.stdout)
+    batch.stderr.write(process.stderr)
+    batch.stderr.close()
+    assert process.returncode == expected_status
+    # Quoted in the history like the arguments of dodo, not expanded
+    assert [(r.command.command, r.exit_code) for r in batch.results] == [
+        (command.replace("$GREETING", "'$GREETING'"), status) for command, status in expected_results
+    ]
+    assert stdout.getvalue() == f"$GREETING\n{tmp_path / 'sub'}\n".encode()
+    assert stderr.getvalue() == b""
+    assert finished == batch.results
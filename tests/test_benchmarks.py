@@ -0,0 +1,29 @@
+"""Smoke test the benchmark harness"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+RUN_BENCHMARKS = Path(__file__).resolve().parent.parent / "benchmarks" / "run_benchmarks.py"
+
+
+@pytest.mark.slow
+def test_run_benchmarks(tmp_path):
+    output = tmp_path / "results.json"
+    subprocess.run(
+        [
+            sys.executable, str(RUN_BENCHMARKS),
+            "--only", "exec", "--only", "status", "--only", "push",
+            "--repeat", "1", "--image-mb", "1", "--json", str(output),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    with open(output, "r") as fin:
+        results = json.load(fin)["results"]
+    assert [result["name"] for result in results] == ["exec true", "status", "push 1 MB"]
+    assert all(result["median_s"] > 0 for result in results)
+    assert results[2]["throughput_mb_s"] > 0
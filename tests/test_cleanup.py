@@ -0,0 +1,97 @@
+"""Test the planning of the cleanup of stale sessions"""
+
+import pytest
+from pathlib import Path
+
+from dockerdo.cleanup import parse_docker_size, parse_docker_timestamp, plan_cleanup, TARBALL_MIN_AGE
+from dockerdo.remote_helper import HostStatus, Tarball
+from dockerdo.session_index import IndexedSession
+
+DAY = 86400.0
+NOW = 1_750_000_000.0
+
+
+@pytest.mark.parametrize("size, expected", [
+    ("0B", 0),
+    ("77.9MB", 77_900_000),
+    ("1.2GB", 1_200_000_000),
+    ("512kB", 512_000),
+    ("unknown", 0),
+])
+def test_parse_docker_size(size, expected):
+    assert parse_docker_size(size) == expected
+
+
+def test_parse_docker_timestamp():
+    assert parse_docker_timestamp("2025-03-26 22:31:01 +0200 EET") == 1743021061.0
+    assert parse_docker_timestamp("yesterday") is None
+
+
+def make_entry(tmp_path: Path, name: str, idle_days: float) -> IndexedSession:
+    return IndexedSession(
+        session_dir=tmp_path / name,
+        name=name,
+        container_name=f"{name}_container",
+        remote_host="host",
+        image_tag=f"dockerdo-ubuntu:latest-{name}",
+        container_state="stopped",
+        updated_at=NOW - idle_days * DAY,
+    )
+
+
+def test_plan_cleanup(tmp_path):
+    stale = make_entry(tmp_path, "stale", idle_days=30)
+    running = make_entry(tmp_path, "running", idle_days=30)
+    recent = make_entry(tmp_path, "recent", idle_days=1)
+    key = ("host", Path("."))
+    host_status = HostStatus(
+        version=3,
+        containers=[
+            {"Names": "stale_container", "State": "exited"},
+            {"Names": "running_container", "State": "running"},
+        ],
+        images=[
+            {"Repository": "dockerdo-ubuntu", "Tag": "latest-stale", "Size": "1GB"},
+            {"Repository": "dockerdo-ubuntu", "Tag": "latest-recent", "Size": "1GB"},
+            # Snapshots go with the session
+            {"Repository": "dockerdo-ubuntu", "Tag": "latest-stale-snapshot-1", "Size": "5MB"},
+            {"Repository": "dockerdo-ubuntu", "Tag": "latest-recent-snapshot-1", "Size": "5MB",
+             "CreatedAt": "2024-01-01 00:00:00 +0000 UTC"},
+            # Orphaned, of a session that no longer exists
+            {"Repository": "dockerdo-alpine", "Tag": "latest-gone", "Size": "10MB",
+             "CreatedAt": "2024-01-01 00:00:00 +0000 UTC"},
+            # Not old enough: may belong to a session on another machine
+            {"Repository": "dockerdo-alpine", "Tag": "latest-elsewhere", "Size": "10MB",
+             "CreatedAt": "2025-06-15 00:00:00 +0000 UTC"},
+            {"Repository": "ubuntu", "Tag": "latest", "Size": "78MB", "CreatedAt": "2024-01-01 00:00:00 +0000 UTC"},
+        ],
+        tarballs=[
+            Tarball(name="recent.tar.gz", size=500, mtime=NOW - DAY),
+            # Push in progress
+            Tarball(name="stale.tar.gz", size=500, mtime=NOW - TARBALL_MIN_AGE / 2),
+            # Not ours
+            Tarball(name="backup.tar.gz", size=500, mtime=NOW - 100 * DAY),
+        ],
+    )
+    plans, skipped = plan_cleanup(
+        {key: [stale, running, recent], ("unreachable", Path(".")): [make_entry(tmp_path, "other", 30)]},
+        {key: host_status, ("unreachable", Path(".")): None},
+        now=NOW,
+        max_idle=7 * DAY,
+    )
+    assert skipped == ["unreachable"]
+    assert len(plans) == 1
+    plan = plans[0]
+    assert [entry.name for entry in plan.sessions] == ["stale"]
+    assert plan.containers == ["stale_container"]
+    assert plan.images == [
+        "dockerdo-ubuntu:latest-stale", "dockerdo-ubuntu:latest-stale-snapshot-1", "dockerdo-alpine:latest-gone"
+    ]
+    assert plan.tarballs == ["recent.tar.gz"]
+    assert plan.reclaimable_bytes == 1_000_000_000 + 5_000_000 + 10_000_000 + 500
+
+    plans, _ = plan_cleanup(
+        {key: [stale, running, recent]}, {key: host_status}, now=NOW, max_idle=7 * DAY, remove_all=True
+    )
+    assert [entry.name for entry in plans[0].sessions] == ["stale", "running", "recent"]
+    assert plans[0].containers == ["stale_container", "running_container"]
@@ -3,7 +3,7 @@
 from unittest import mock
 from pathlib import Path
 
-from dockerdo.config import Session, UserConfig
+from dockerdo.config import Session, Snapshot, UserConfig
 
 
 def test_session_from_opts_defaults():
@@ -35,6 +35,10 @@ def test_session_from_opts_defaults():
     assert session.container_username == "root"
     assert session.docker_registry is None
     assert session.record_inotify is False
+    assert session.record_include_paths == [Path("/")]
+    assert session.record_exclude_globs == ["/proc", "/dev", "/sys"]
+    assert session.prefetch_paths == []
+    assert session.sshfs_cache_options == ""
     assert session.session_dir == Path("/tmp/dockerdo_1234a67890")
     assert session.ssh_port_on_remote_host is None
     assert session.remote_host_build_dir == Path(".")
@@ -69,6 +73,10 @@ def test_session_from_opts_override_all():
         default_docker_registry="docker.io",
         default_docker_run_args="--rm",
         always_record_inotify=True,
+        record_include_paths=[Path("/etc"), Path("/opt")],
+        record_exclude_globs=["*/__pycache__"],
+        prefetch_paths=[Path("/opt/project")],
+        sshfs_cache_timeout=120,
     )
     with mock.patch(
         "dockerdo.config.Path.expanduser",
@@ -99,6 +107,10 @@ def test_session_from_opts_override_all():
     assert session.container_username == "ubuntu"
     assert session.docker_registry == "harbor.local"
     assert session.record_inotify is True   # always_record_inotify overrides record_inotify
+    assert session.record_include_paths == [Path("/etc"), Path("/opt")]
+    assert session.record_exclude_globs == ["*/__pycache__"]
+    assert session.prefetch_paths == [Path("/opt/project")]
+    assert session.sshfs_cache_options == "-o cache_timeout=120"
     assert session.session_dir == Path("/home/user/.local/share/dockerdo/my_session")
     assert session.ssh_port_on_remote_host is None
     assert session.remote_host_build_dir == Path("/tmp/build")
@@ -117,13 +129,15 @@ set -x
 export DOCKERDO_SESSION_DIR=/home/user/.local/share/dockerdo/my_session
 export DOCKERDO_SESSION_NAME=my_session
 function deactivate_dockerdo { unset DOCKERDO_SESSION_DIR; unset DOCKERDO_SESSION_NAME; fusermount -u /another/workdir/reno; }
-if [ ! -e /home/user/.local/share/dockerdo/my_session/ssh-socket-remote ]; then
-  ssh -M -N -S /home/user/.local/share/dockerdo/my_session/ssh-socket-remote reno &
+if ! ssh -S /home/user/.local/share/dockerdo/my_session/ssh-socket-remote -O check reno 2> /dev/null; then
+  rm -f /home/user/.local/share/dockerdo/my_session/ssh-socket-remote
+  ssh -M -N -S /home/user/.local/share/dockerdo/my_session/ssh-socket-remote \
+-o ServerAliveInterval=5 -o ServerAliveCountMax=3 reno &
 fi
 if ( ! mountpoint -q /another/workdir/reno ); then
   ssh -S /home/user/.local/share/dockerdo/my_session/ssh-socket-remote reno mkdir -p /tmp/build
   mkdir -p /another/workdir/reno
-  sshfs reno:/tmp/build /another/workdir/reno
+  sshfs -o reconnect -o ServerAliveInterval=5 -o ServerAliveCountMax=3 reno:/tmp/build /another/workdir/reno
 fi
 set +x
 """.lstrip()
@@ -307,3 +321,28 @@ def test_session_dry_run():
         )
         assert session is not None
         assert session.name == "(filled in by mkdtemp)"
+
+
+def test_session_snapshots(tmp_path):
+    """Test that the container is created from the restored snapshot, and that the chain survives a roundtrip"""
+    session = Session(
+        name="snap",
+        container_name="snap_container",
+        distro="ubuntu",
+        base_image="ubuntu:latest",
+        image_tag="dockerdo-ubuntu:latest-snap",
+        session_dir=tmp_path,
+        remote_host_build_dir=Path("/tmp/build"),
+        local_work_dir=tmp_path,
+    )
+    assert session.container_image == "dockerdo-ubuntu:latest-snap"
+    session.snapshots.append(
+        Snapshot(name="1", image_tag=session.snapshot_tag("1"), parent=session.image_tag, created_at=1.0)
+    )
+    session.snapshot = "1"
+    assert session.container_image == "dockerdo-ubuntu:latest-snap-snapshot-1"
+    session.save()
+    loaded = Session.load(tmp_path)
+    assert loaded.snapshots == session.snapshots
+    assert loaded.container_image == "dockerdo-ubuntu:latest-snap-snapshot-1"
+    assert loaded.find_snapshot("2") is None
@@ -0,0 +1,50 @@
+"""Test the container_state module"""
+
+import os
+
+from dockerdo.container_state import (
+    CachedContainerState,
+    load_cached_state,
+    save_cached_state,
+    invalidate_cached_state,
+    apply_event,
+)
+
+
+def test_cache_expiry(tmp_path):
+    cached = CachedContainerState(container_name="foo", container_id="abc", state="running", checked_at=100.0)
+    save_cached_state(tmp_path, cached)
+    assert load_cached_state(tmp_path, "foo", max_age=10.0, now=105.0) == cached
+    assert load_cached_state(tmp_path, "foo", max_age=10.0, now=115.0) is None
+    assert load_cached_state(tmp_path, "bar", max_age=10.0, now=105.0) is None
+
+    # A live event watcher keeps the cache valid indefinitely
+    cached.watcher_pid = os.getpid()
+    save_cached_state(tmp_path, cached)
+    assert load_cached_state(tmp_path, "foo", max_age=10.0, now=1e9) == cached
+
+    invalidate_cached_state(tmp_path)
+    assert load_cached_state(tmp_path, "foo", max_age=10.0, now=105.0) is None
+
+
+def test_apply_event():
+    cached = CachedContainerState(container_name="foo", container_id="abc", state="running", checked_at=0.0)
+    event = {"Type": "container", "Action": "die", "id": "abc", "Actor": {"Attributes": {"name": "foo"}}}
+    # A signal does not stop the container by itself
+    assert not apply_event(cached, {**event, "Action": "kill"}, watcher_pid=42)
+    assert cached.state == "running"
+    assert cached.watcher_pid is None
+    assert apply_event(cached, event, watcher_pid=42)
+    assert cached.state == "exited"
+    assert cached.watcher_pid == 42
+    assert cached.checked_at > 0.0
+
+    # Events of other containers, non-state events and other types are ignored
+    assert not apply_event(cached, {**event, "Actor": {"Attributes": {"name": "foobar"}}}, watcher_pid=42)
+    assert not apply_event(cached, {**event, "Action": "exec_start: bash"}, watcher_pid=42)
+    assert not apply_event(cached, {**event, "Type": "network"}, watcher_pid=42)
+    assert cached.state == "exited"
+
+    assert apply_event(cached, {**event, "Action": "destroy"}, watcher_pid=42)
+    assert cached.state is None
+    assert cached.container_id is None
@@ -1,7 +1,16 @@
 """Test the docker module"""
+import shlex
 from pathlib import Path
 
-from dockerdo.docker import format_dockerfile
+import pytest
+
+from dockerdo.docker import (
+    PackageInstall,
+    format_dockerfile,
+    format_history_dockerfile,
+    is_read_only_command,
+    parse_package_install,
+)
 
 EXPECTED_UBUNTU_DOCKERFILE = r"""
 # syntax=docker/dockerfile:1
@@ -25,3 +34,80 @@ CMD ["/bin/bash", "-c", "/usr/sbin/sshd -D && sleep infinity"]
 def test_ubuntu_dockerfile():
     result = format_dockerfile("ubuntu", "ubuntu:latest", Path("/root"))
     assert result == EXPECTED_UBUNTU_DOCKERFILE
+
+
+@pytest.mark.parametrize("command, expected", [
+    ("ls -la", True),
+    ("sudo cat /etc/hosts", True),
+    ("apt-get update", True),
+    ("apt search curl", True),
+    ("pip freeze", True),
+    ("apt-get install -y curl", False),
+    ("make install", False),
+])
+def test_is_read_only_command(command, expected):
+    assert is_read_only_command(shlex.split(command)) == expected
+
+
+@pytest.mark.parametrize("command, expected", [
+    ("apt install -y curl git curl", PackageInstall("apt", ("apt-get",), (), ("curl", "git"))),
+    (
+        "sudo apt-get -y install --no-install-recommends vim",
+        PackageInstall("apt", ("apt-get",), ("--no-install-recommends",), ("vim",)),
+    ),
+    ("apk add --no-cache bash", PackageInstall("apk", ("apk",), (), ("bash",))),
+    ("python3 -m pip install -U numpy", PackageInstall("pip", ("python3", "-m", "pip"), ("-U",), ("numpy",))),
+    ("pip install -r requirements.txt", None),
+    ("apt-get install -y", None),
+    ("apt-get remove -y curl", None),
+    ("make install", None),
+])
+def test_parse_package_install(command, expected):
+    assert parse_package_install(shlex.split(command)) == expected
+
+
+EXPECTED_HISTORY_DOCKERFILE = r"""
+FROM ubuntu:24.04
+
+RUN apt-get update && DEBIAN_FRONTEND=noninteractive apt-get install -y curl git && rm -rf /var/lib/apt/lists/*
+ENV GREETING="hello world" \
+    PATH=/opt/app/bin:/usr/bin
+
+WORKDIR /
+RUN mkdir -p /opt/app
+WORKDIR /opt/app
+RUN pip install --no-cache-dir numpy scipy
+RUN make \
+    && make install
+WORKDIR /
+RUN add-apt-repository ppa:example/tools
+RUN apt-get update && DEBIAN_FRONTEND=noninteractive apt-get install -y tool && rm -rf /var/lib/apt/lists/*
+
+# Modified files, from files/ in the build context (see dockerdo export-files):
+#   /etc/app.conf
+#   /etc/nginx/nginx.conf
+COPY files/ /
+""".lstrip()
+
+
+def test_format_history_dockerfile():
+    commands = [
+        ("apt-get update", "/"),
+        ("apt-get install -y curl", "/"),
+        ("mkdir -p /opt/app", "/"),
+        ("ls", "/opt/app"),
+        ("pip install numpy", "/opt/app"),
+        ("pip install scipy", "/opt/app"),
+        ("make", "/opt/app"),
+        ("make install", "/opt/app"),
+        ("apt install git", "/opt/app"),
+        ("add-apt-repository ppa:example/tools", "/"),
+        ("apt-get install -y tool", "/"),
+    ]
+    result = format_history_dockerfile(
+        "ubuntu:24.04",
+        [(command, Path(cwd)) for command, cwd in commands],
+        {"PATH": "/opt/app/bin:/usr/bin", "GREETING": "hello world"},
+        [Path("/etc/nginx/nginx.conf"), Path("/etc/app.conf")],
+    )
+    assert result == EXPECTED_HISTORY_DOCKERFILE
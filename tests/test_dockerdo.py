@@ -0,0 +1,62 @@
+"""Test the helpers of the command line interface"""
+
+import time
+from pathlib import Path
+
+from dockerdo.config import Session
+from dockerdo.dockerdo import check_session_hosts, load_session_index, remove_session_files
+from dockerdo.session_index import IndexedSession, SessionIndex
+
+
+def test_check_session_hosts_corrupt_session(tmp_path):
+    session_dir = tmp_path / "broken"
+    session_dir.mkdir()
+    (session_dir / "session.yaml").write_text("name: [unterminated\n")
+    entry = IndexedSession(
+        session_dir=session_dir,
+        name="broken",
+        container_name="broken_container",
+        remote_host="host",
+        container_state="running",
+        updated_at=time.time(),
+    )
+    assert check_session_hosts([entry], jobs=1) == {"host": None}
+
+
+def test_remove_session_files_exec_server(tmp_path):
+    session_dir = tmp_path / "session"
+    session_dir.mkdir()
+    # A session that used the exec server also leaves its forwarded socket behind
+    for file_name in ("session.yaml", "activate", "env.list", "exec.sock", "supervisor.sock", "ssh-socket-container"):
+        (session_dir / file_name).touch()
+    assert remove_session_files(session_dir)
+    assert not session_dir.exists()
+
+    # Files that dockerdo did not create are left alone, and so is the directory
+    session_dir.mkdir()
+    (session_dir / "session.yaml").write_text("")
+    (session_dir / "notes.txt").write_text("")
+    assert not remove_session_files(session_dir)
+    assert [path.name for path in session_dir.iterdir()] == ["notes.txt"]
+
+
+def test_load_session_index(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    sessions_dir = tmp_path / ".local" / "share" / "dockerdo"
+    session = Session(
+        name="older",
+        container_name="older_container",
+        distro="ubuntu",
+        base_image="ubuntu:latest",
+        session_dir=sessions_dir / "older",
+        remote_host_build_dir=Path("."),
+        local_work_dir=tmp_path,
+    )
+    session.save()
+    index = SessionIndex(tmp_path / ".local" / "state" / "dockerdo")
+    # A dry run does not index the session
+    assert [entry.name for entry in load_session_index(dry_run=True)] == ["older"]
+    assert index.sessions() == []
+    assert [entry.name for entry in load_session_index()] == ["older"]
+    assert [entry.name for entry in index.sessions()] == ["older"]
+    index.close()
@@ -0,0 +1,114 @@
+"""Test the engine module against a fake Docker Engine API on a unix socket"""
+
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from dockerdo.engine import DockerEngine, DockerEngineError, container_entry_names
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "fake"
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=None, content_type="application/json"):
+        if body is None:
+            data = b""
+        elif isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_chunked(self):
+        data = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return data
+            data += self.rfile.read(size)
+            self.rfile.readline()
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        if self.path == "/v1.41/_ping":
+            self._respond(200, b"OK", content_type="text/plain")
+        elif self.path.startswith("/v1.41/containers/json"):
+            self._respond(200, [{"Id": "abc", "Names": ["/foo"], "State": "running"}])
+        else:
+            self._respond(404, {"message": "page not found"})
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        if self.path.startswith("/v1.41/images/load"):
+            self.server.loaded.append(self._read_chunked())
+            self._respond(200, b'{"stream":"Loaded"}\n{"stream":"done"}\n')
+        elif self.path == "/v1.41/containers/missing/stop":
+            self._respond(404, {"message": "No such container: missing"})
+        else:
+            self._respond(204)
+
+
+class FakeEngineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def fake_engine(tmp_path):
+    socket_path = tmp_path / "docker.sock"
+    server = FakeEngineServer(str(socket_path), FakeEngineHandler)
+    server.requests = []
+    server.loaded = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    engine = DockerEngine(socket_path, timeout=5.0)
+    yield engine, server
+    engine.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_engine_calls(fake_engine):
+    engine, server = fake_engine
+    assert engine.ping()
+    containers = engine.containers(name="foo")
+    assert containers[0]["Id"] == "abc"
+    assert container_entry_names(containers[0]) == ["foo"]
+    engine.stop_container("foo")
+    with pytest.raises(DockerEngineError) as excinfo:
+        engine.stop_container("missing")
+    assert excinfo.value.status == 404
+    assert excinfo.value.message == "No such container: missing"
+    result = engine.load_image(iter([b"abc", b"def"]))
+    assert result == [{"stream": "Loaded"}, {"stream": "done"}]
+    assert server.loaded == [b"abcdef"]
+    assert server.requests[1][1].startswith("/v1.41/containers/json?all=1&filters=")
+    engine.commit_container("foo", "dockerdo-ubuntu", "latest-snapshot-1")
+    assert server.requests[-1] == (
+        "POST", "/v1.41/commit?container=foo&repo=dockerdo-ubuntu&tag=latest-snapshot-1&pause=1"
+    )
+
+
+def test_engine_unreachable(tmp_path):
+    engine = DockerEngine(tmp_path / "missing.sock", timeout=1.0)
+    assert not engine.ping()
+
+
+def test_container_entry_names():
+    # The docker cli joins the names with commas, the API returns a list
+    assert container_entry_names({"Names": "foo,bar"}) == ["foo", "bar"]
+    assert container_entry_names({"Names": ["/foo"]}) == ["foo"]
+    assert container_entry_names({}) == []
@@ -0,0 +1,98 @@
+"""Test the exec server, and the client in the shell module, over a local unix socket"""
+
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from dockerdo.batch import parse_batch
+from dockerdo.config import Session
+from dockerdo.exec_server import serve
+from dockerdo.shell import EXEC_SOCKET, format_exec_server_command, run_container_batch, run_exec_server_command
+
+
+@pytest.fixture
+def session(tmp_path):
+    session = Session(
+        name="exec",
+        container_name="exec_container",
+        distro="ubuntu",
+        base_image="ubuntu:latest",
+        env={"GREETING": "hello"},
+        session_dir=tmp_path,
+        remote_host_build_dir=Path("/tmp/build"),
+        local_work_dir=tmp_path,
+        exec_server=True,
+    )
+    stop = threading.Event()
+    thread = threading.Thread(target=serve, args=(str(tmp_path / EXEC_SOCKET), stop), daemon=True)
+    thread.start()
+    while not (tmp_path / EXEC_SOCKET).exists():
+        pass
+    yield session
+    stop.set()
+    thread.join()
+
+
+@pytest.fixture
+def stdin_pipe(monkeypatch):
+    """Data piped into dodo"""
+    read_fd, write_fd = os.pipe()
+    stdin = os.fdopen(read_fd, "r")
+    monkeypatch.setattr(sys, "stdin", stdin)
+    yield os.fdopen(write_fd, "wb")
+    stdin.close()
+
+
+def test_exec_server(session, tmp_path, stdin_pipe, capfdbinary):
+    stdin_pipe.write(b"piped\n")
+    stdin_pipe.close()
+    (tmp_path / "workdir").mkdir()
+
+    retval, stats = run_exec_server_command("sh -c 'pwd; echo $GREETING; cat; echo oops >&2'", session, tmp_path)
+    assert retval == 0
+    captured = capfdbinary.readouterr()
+    assert captured.out == f"{tmp_path}\nhello\npiped\n".encode()
+    assert captured.err == b"oops\n"
+    assert stats.stdout_bytes == len(captured.out)
+    assert stats.stderr_bytes == 5
+    assert stats.remote_time is not None and stats.ssh_time is not None
+
+    retval, _ = run_exec_server_command("sh -c 'exit 3'", session, tmp_path / "workdir")
+    assert retval == 3
+    # Fails like cd
+    retval, _ = run_exec_server_command("true", session, tmp_path / "missing")
+    assert retval == 1
+    assert b"missing" in capfdbinary.readouterr().err
+
+
+def test_exec_server_batch(session, tmp_path, capfdbinary):
+    commands = parse_batch("cd workdir\npwd\nsh -c 'echo oops >&2; exit 2'\ntrue\n", tmp_path)
+    (tmp_path / "workdir").mkdir()
+    retval, results = run_container_batch(commands, session)
+    assert retval == 2
+    assert [(result.command.command, result.exit_code) for result in results] == [
+        ("pwd", 0), ("sh -c 'echo oops >&2; exit 2'", 2)
+    ]
+    assert results[1].stats.stderr_bytes == 5
+    captured = capfdbinary.readouterr()
+    assert captured.out == f"{tmp_path / 'workdir'}\n".encode()
+    assert captured.err == b"oops\n"
+
+
+def test_exec_server_unavailable(session, tmp_path):
+    # Interactive commands need a tty
+    assert run_exec_server_command("true", session, tmp_path, interactive=True) is None
+    # The ssh master accepts connections on the forwarded socket even if the server is not running
+    (tmp_path / EXEC_SOCKET).unlink()
+    assert run_exec_server_command("true", session, tmp_path) is None
+
+
+def test_format_exec_server_command():
+    command = format_exec_server_command()
+    assert command.startswith("if command -v python3")
+    # Passed through the remote shell in double quotes
+    loader = command.split('"')[1]
+    assert "$" not in loader and "`" not in loader
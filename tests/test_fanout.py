@@ -0,0 +1,55 @@
+"""Test the fanout module"""
+
+import io
+import threading
+from pathlib import Path
+
+import pytest
+
+from dockerdo.fanout import FanoutError, PrefixedOutput, format_prefixes, select_sessions
+from dockerdo.session_index import IndexedSession
+
+
+def make_entry(name, state, session_dir):
+    return IndexedSession(
+        session_dir=Path(session_dir), name=name, container_name=f"{name}_container",
+        container_state=state, updated_at=0.0,
+    )
+
+
+ENTRIES = [
+    make_entry("alpine", "running", "/tmp/a"),
+    make_entry("debian", "stopped", "/tmp/d"),
+    make_entry("ubuntu", "running", "/tmp/u"),
+    make_entry("twin", "running", "/tmp/t1"),
+    make_entry("twin", "nothing", "/tmp/t2"),
+]
+
+
+def test_select_sessions():
+    assert [e.name for e in select_sessions(ENTRIES, ["ubuntu", "debian", "ubuntu"], False)] == ["ubuntu", "debian"]
+    assert [e.session_dir for e in select_sessions(ENTRIES, [], True)] == [
+        Path("/tmp/a"), Path("/tmp/u"), Path("/tmp/t1")
+    ]
+    with pytest.raises(FanoutError, match="Unknown session fedora"):
+        select_sessions(ENTRIES, ["alpine", "fedora"], False)
+    with pytest.raises(FanoutError, match="Several sessions"):
+        select_sessions(ENTRIES, ["twin"], False)
+
+
+def test_format_prefixes():
+    assert format_prefixes(["a", "ccc"]) == {"a": b"a   | ", "ccc": b"ccc | "}
+
+
+def test_prefixed_output():
+    destination = io.BytesIO()
+    lock = threading.Lock()
+    first = PrefixedOutput(destination, b"a | ", lock)
+    second = PrefixedOutput(destination, b"b | ", lock)
+    first.write(b"one\ntw")
+    second.write(b"x\n")
+    first.write(b"o\nthree")
+    first.close()
+    second.close()
+    assert destination.getvalue() == b"a | one\nb | x\na | two\na | three\n"
+    assert first.byte_count == 13
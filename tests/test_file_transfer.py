@@ -0,0 +1,125 @@
+"""Test the file_transfer module"""
+
+import io
+import subprocess
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from dockerdo.config import Session
+from dockerdo.file_transfer import (
+    Location,
+    TransferError,
+    TransferProgress,
+    TransferShard,
+    extract_tar_stream,
+    format_file_list,
+    format_tar_create_script,
+    group_sources,
+    parse_location,
+    split_shard,
+)
+from dockerdo.shell import list_transfer_files, resolve_location, run_tar_stream
+
+
+def test_tar_export(tmp_path):
+    root = tmp_path / "container"
+    (root / "etc" / "app").mkdir(parents=True)
+    (root / "etc" / "app" / "app.conf").write_text("setting = 1\n")
+    (root / "etc" / "hosts").write_text("127.0.0.1 localhost\n")
+    (root / "etc" / "link").symlink_to("hosts")
+    paths = [Path("/etc/app/app.conf"), Path("/etc/hosts"), Path("/etc/link"), Path("/etc/deleted"), Path("/etc/app")]
+    assert format_file_list(paths[:2]) == b"etc/app/app.conf\netc/hosts\n"
+
+    process = subprocess.Popen(
+        ["sh", "-c", format_tar_create_script(root)], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    assert process.stdin is not None and process.stdout is not None
+    process.stdin.write(format_file_list(paths))
+    process.stdin.close()
+    destination = tmp_path / "context" / "files"
+    extracted = extract_tar_stream(process.stdout, destination)
+    assert process.wait() == 0
+
+    assert extracted == [Path("etc/app/app.conf"), Path("etc/hosts"), Path("etc/link")]
+    assert (destination / "etc" / "app" / "app.conf").read_text() == "setting = 1\n"
+    assert (destination / "etc" / "link").readlink() == Path("hosts")
+
+
+def test_extract_tar_stream_unsafe(tmp_path):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as archive:
+        for name in ("../escaped", "inside"):
+            member = tarfile.TarInfo(name)
+            member.size = 2
+            archive.addfile(member, io.BytesIO(b"x\n"))
+    data.seek(0)
+    destination = tmp_path / "files"
+    assert extract_tar_stream(data, destination) == [Path("inside")]
+    assert not (tmp_path / "escaped").exists()
+
+    with pytest.raises(TransferError):
+        extract_tar_stream(io.BytesIO(b"not a tar" * 100), destination)
+
+
+def test_parse_location():
+    assert parse_location("container:/data") == Location("container", Path("/data"))
+    assert parse_location("remote:build") == Location("remote", Path("build"))
+    assert parse_location("./container:x") == Location("local", Path("container:x"))
+    with pytest.raises(TransferError):
+        parse_location("container:")
+
+
+def test_group_and_split_sources():
+    shards = group_sources([Path("/a/x"), Path("/b/y"), Path("/a/z")])
+    assert shards == [TransferShard(Path("/a"), ["x", "z"]), TransferShard(Path("/b"), ["y"])]
+    with pytest.raises(TransferError):
+        group_sources([Path("/")])
+    assert split_shard(shards[0], ["x/1", "x/2", "x/3", "z"], 3) == [
+        TransferShard(Path("/a"), ["x/1", "z"]),
+        TransferShard(Path("/a"), ["x/2"]),
+        TransferShard(Path("/a"), ["x/3"]),
+    ]
+    assert len(split_shard(shards[1], ["y"], 4)) == 1
+
+
+@pytest.fixture
+def session(tmp_path):
+    # Without a remote host, the remote host is the local host
+    return Session(
+        name="transfer",
+        container_name="transfer_container",
+        distro="ubuntu",
+        base_image="ubuntu:latest",
+        session_dir=tmp_path / "session",
+        remote_host_build_dir=tmp_path / "build",
+        local_work_dir=tmp_path,
+    )
+
+
+def test_tar_stream(session, tmp_path):
+    source = tmp_path / "data"
+    (source / "nested").mkdir(parents=True)
+    (source / "empty").mkdir()
+    (source / "nested" / "large.bin").write_bytes(bytes(300000))
+    (source / "small.txt").write_text("small\n")
+    (source / "link").symlink_to("small.txt")
+    assert resolve_location(Location("remote", Path("out")), session) == Location("remote", tmp_path / "build" / "out")
+
+    shard = TransferShard(tmp_path, ["data"])
+    files = list_transfer_files("local", session, shard)
+    assert sorted(files) == ["data/empty", "data/link", "data/nested/large.bin", "data/small.txt"]
+    for destination in (Location("remote", tmp_path / "remote"), Location("local", tmp_path / "local")):
+        progress = TransferProgress()
+        for split in split_shard(shard, files, 2):
+            assert run_tar_stream("local", split, destination, session, progress) == 0
+        copied = destination.path / "data"
+        assert (copied / "nested" / "large.bin").stat().st_size == 300000
+        assert (copied / "small.txt").read_text() == "small\n"
+        assert (copied / "link").readlink() == Path("small.txt")
+        assert (copied / "empty").is_dir()
+        assert progress.byte_count > 300000
+
+    missing = TransferShard(tmp_path, ["missing"])
+    assert run_tar_stream("local", missing, Location("remote", tmp_path / "remote"), session, TransferProgress()) != 0
@@ -0,0 +1,94 @@
+"""Test the history module"""
+
+import json
+import sqlite3
+from pathlib import Path
+
+from dockerdo.history import HistoryStore, ExecStats, SCHEMA, path_prefix_clause
+
+
+def test_path_prefix_clause():
+    assert path_prefix_clause("cwd", Path("/")) == ("1", [])
+    clause, params = path_prefix_clause("cwd", Path("/opt"))
+    assert clause == "(cwd = ? OR (cwd >= ? AND cwd < ?))"
+    assert params == ["/opt", "/opt/", "/opt0"]
+
+
+def test_migrate_legacy_files(tmp_path):
+    with open(tmp_path / "command_history.jsonl", "w") as fout:
+        for cwd, command in [("/", "apt-get update"), ("/opt", "make"), ("/opt", "make install")]:
+            fout.write(json.dumps({"cwd": cwd, "command": command}) + "\n")
+        fout.write("not json\n")
+    with open(tmp_path / "modified_files", "w") as fout:
+        fout.write("/etc/hosts\n/etc/fstab\n/etc/hosts\n")
+
+    store = HistoryStore(tmp_path)
+    history = list(store.iter_commands())
+    assert [entry["command"] for entry in history] == ["apt-get update", "make", "make install"]
+    assert all(entry["exit_code"] == 0 for entry in history)
+    assert list(store.iter_modified_files()) == [Path("/etc/fstab"), Path("/etc/hosts")]
+    assert not (tmp_path / "command_history.jsonl").exists()
+    assert (tmp_path / "command_history.jsonl.migrated").exists()
+    assert (tmp_path / "modified_files.migrated").exists()
+    store.close()
+
+    # The migration is only done once
+    store = HistoryStore(tmp_path)
+    assert len(list(store.iter_commands())) == 3
+    store.close()
+
+
+def test_migrate_malformed_legacy_lines(tmp_path):
+    with open(tmp_path / "command_history.jsonl", "w") as fout:
+        fout.write(json.dumps({"cwd": "/", "command": "apt-get update"}) + "\n")
+        fout.write(json.dumps({"command": "make"}) + "\n")
+        fout.write(json.dumps(["/opt", "make install"]) + "\n")
+        fout.write(json.dumps({"cwd": "/opt", "command": "make test"}) + "\n")
+
+    store = HistoryStore(tmp_path)
+    assert [entry["command"] for entry in store.iter_commands()] == ["apt-get update", "make test"]
+    assert (tmp_path / "command_history.jsonl.migrated").exists()
+    store.close()
+
+
+def test_record_and_filter(tmp_path):
+    store = HistoryStore(tmp_path)
+    store.record_command("apt-get install -y vim", Path("/"), timestamp=100.0)
+    store.record_command("make", Path("/opt/app"), timestamp=200.0)
+    store.record_command("make test", Path("/opt/app/tests"), exit_code=2, timestamp=300.0)
+    store.record_command("ls", Path("/optional"), timestamp=400.0)
+
+    def commands(**kwargs):
+        return [entry["command"] for entry in store.iter_commands(**kwargs)]
+
+    assert commands() == ["apt-get install -y vim", "make", "make test", "ls"]
+    assert commands(path_prefix=Path("/opt")) == ["make", "make test"]
+    assert commands(since=200.0, until=400.0) == ["make", "make test"]
+    assert commands(pattern="make*") == ["make", "make test"]
+    assert commands(limit=2, offset=1) == ["make", "make test"]
+    assert list(store.iter_commands(pattern="make test"))[0]["exit_code"] == 2
+
+    assert store.record_modified_file(Path("/etc/hosts"))
+    assert not store.record_modified_file(Path("/etc/hosts"))
+    assert store.record_modified_file(Path("/opt/app/config"))
+    assert list(store.iter_modified_files(path_prefix=Path("/etc"))) == [Path("/etc/hosts")]
+    store.close()
+
+
+def test_upgrade_schema_and_stats(tmp_path):
+    # A database created before the timing columns were added
+    connection = sqlite3.connect(tmp_path / "history.sqlite")
+    connection.executescript(SCHEMA)
+    connection.execute("INSERT INTO meta (key, value) VALUES ('migrated', '0')")
+    connection.execute("INSERT INTO commands (timestamp, cwd, command, exit_code) VALUES (1.0, '/', 'ls', 0)")
+    connection.commit()
+    connection.close()
+
+    store = HistoryStore(tmp_path)
+    store.record_command("sleep 1", Path("/"), stats=ExecStats(wall_time=1.5, remote_time=1.0, stdout_bytes=0))
+    store.record_command("false", Path("/"), exit_code=1, stats=ExecStats(wall_time=0.5))
+    assert store.timings("wall_time") == [1.5, 0.5]
+    assert store.timings("remote_time") == [1.0]
+    assert [entry["command"] for entry in store.slowest_commands(1)] == ["sleep 1"]
+    assert [entry["command"] for entry in store.iter_commands(successful_only=True)] == ["ls", "sleep 1"]
+    store.close()
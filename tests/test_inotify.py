@@ -0,0 +1,42 @@
+"""Test the inotify module"""
+
+import pytest
+from pathlib import Path
+
+from dockerdo.inotify import is_excluded, scan_directories
+
+
+@pytest.mark.parametrize("path, exclude_globs, expected", [
+    ("/proc", ["/proc", "/dev", "/sys"], True),
+    ("/proc/1", ["/proc", "/dev", "/sys"], False),
+    ("/var/lib/apt", ["/var/lib/apt"], True),
+    ("/root/.cache", ["/*/.cache"], True),
+    ("/home/user/project/__pycache__", ["*/__pycache__"], True),
+    ("/etc", [], False),
+])
+def test_is_excluded(path, exclude_globs, expected):
+    assert is_excluded(Path(path), exclude_globs) == expected
+
+
+def test_scan_directories(tmp_path):
+    for subdir in ("etc/ssh", "opt/app/src", "usr/lib/python3", "usr/local/bin", "proc/1", "root/.cache/pip"):
+        (tmp_path / subdir).mkdir(parents=True)
+    (tmp_path / "etc" / "hostname").write_text("container\n")
+    (tmp_path / "link").symlink_to(tmp_path / "usr")
+
+    everything = {str(inside) for _, inside in scan_directories(tmp_path, [Path("/")], ["/proc", "/root/.cache"])}
+    assert "/" in everything
+    assert "/usr/lib/python3" in everything
+    assert "/proc" not in everything
+    assert "/proc/1" not in everything
+    assert "/root" in everything
+    assert "/root/.cache/pip" not in everything
+    assert "/link" not in everything
+    assert "/etc/hostname" not in everything
+
+    scoped = scan_directories(tmp_path, [Path("/etc"), Path("/opt"), Path("/usr/local"), Path("/nonexistent")], [])
+    assert {str(inside) for _, inside in scoped} == {
+        "/etc", "/etc/ssh", "/opt", "/opt/app", "/opt/app/src", "/usr/local", "/usr/local/bin",
+    }
+    for local_path, inside in scoped:
+        assert local_path == tmp_path / inside.relative_to("/")
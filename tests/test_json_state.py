@@ -0,0 +1,22 @@
+"""Test the state files shared by the local sessions"""
+
+from pydantic import BaseModel, Field
+from typing import List
+
+from dockerdo.json_state import load_state, locked_state
+
+
+class Counters(BaseModel):
+    values: List[int] = Field(default_factory=list)
+
+
+def test_locked_state(tmp_path):
+    path = tmp_path / "state" / "counters.json"
+    assert load_state(path, Counters) == Counters()
+    with locked_state(path, tmp_path / "state" / "counters.lock", Counters) as counters:
+        counters.values.append(1)
+    assert load_state(path, Counters).values == [1]
+    assert [child.name for child in path.parent.iterdir() if child.suffix == ".tmp"] == []
+
+    path.write_text("{not json")
+    assert load_state(path, Counters) == Counters()
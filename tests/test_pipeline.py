@@ -0,0 +1,52 @@
+"""Test the pipeline module"""
+
+import threading
+import time
+
+import pytest
+
+from dockerdo.pipeline import Step, run_pipeline, first_failure
+
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+
+    def wait_for_others():
+        barrier.wait()
+        return 0
+
+    start = time.perf_counter()
+    results = run_pipeline([Step(name, wait_for_others) for name in ("a", "b", "c")])
+    assert results == {"a": 0, "b": 0, "c": 0}
+    assert time.perf_counter() - start < 5
+
+
+def test_dependencies_and_failures():
+    order = []
+
+    def step(name, retval=0):
+        def run():
+            order.append(name)
+            return retval
+        return run
+
+    results = run_pipeline([
+        # Listed before its dependency, which is skipped
+        Step("after_skipped", step("after_skipped"), ("skipped",)),
+        Step("skipped", step("skipped"), ("fails",)),
+        Step("fails", step("fails", 3)),
+        Step("first", step("first")),
+        Step("second", step("second"), ("first",)),
+    ])
+    assert results == {"fails": 3, "first": 0, "second": 0, "skipped": None, "after_skipped": None}
+    assert order.index("first") < order.index("second")
+    assert "skipped" not in order
+    assert first_failure(results) == 3
+    assert first_failure({"a": 0, "b": None}) == 0
+
+
+def test_invalid_graphs():
+    with pytest.raises(ValueError):
+        run_pipeline([Step("a", lambda: 0, ("missing",))])
+    with pytest.raises(ValueError):
+        run_pipeline([Step("a", lambda: 0, ("b",)), Step("b", lambda: 0, ("a",))])
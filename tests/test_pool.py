@@ -0,0 +1,45 @@
+"""Test the pool of pre-started containers"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dockerdo.pool import PooledContainer, add_container, claim_container, load_pool, remove_containers
+
+
+def make_container(name, created_at, host="host", image_tag="image:latest", docker_run_args=""):
+    return PooledContainer(
+        host=host,
+        image_tag=image_tag,
+        docker_run_args=docker_run_args,
+        container_name=name,
+        port=2222 + int(created_at),
+        created_at=created_at,
+    )
+
+
+def test_claim_oldest_matching(tmp_path):
+    add_container(tmp_path, make_container("newer", 2.0))
+    add_container(tmp_path, make_container("older", 1.0))
+    add_container(tmp_path, make_container("other_host", 0.0, host="other"))
+    add_container(tmp_path, make_container("other_image", 0.0, image_tag="other:latest"))
+    add_container(tmp_path, make_container("other_args", 0.0, docker_run_args="--gpus all"))
+
+    claimed = claim_container(tmp_path, "host", "image:latest", "")
+    assert claimed is not None and claimed.container_name == "older"
+    claimed = claim_container(tmp_path, "host", "image:latest", "")
+    assert claimed is not None and claimed.container_name == "newer"
+    assert claim_container(tmp_path, "host", "image:latest", "") is None
+    assert len(load_pool(tmp_path).containers) == 3
+
+    remove_containers(tmp_path, ["other_host", "other_args"])
+    assert [container.container_name for container in load_pool(tmp_path).containers] == ["other_image"]
+
+
+def test_parallel_claims(tmp_path):
+    for i in range(5):
+        add_container(tmp_path, make_container(f"pooled{i}", float(i)))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        claimed = list(executor.map(lambda _: claim_container(tmp_path, "host", "image:latest", ""), range(8)))
+    names = [container.container_name for container in claimed if container is not None]
+    assert sorted(names) == [f"pooled{i}" for i in range(5)]
+    assert load_pool(tmp_path).containers == []
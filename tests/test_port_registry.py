@@ -0,0 +1,76 @@
+"""Test the port registry"""
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from dockerdo.port_registry import (
+    PortAllocationError,
+    allocate_port,
+    load_registry,
+    reassign_port,
+    release_ports,
+)
+
+PORTS = range(2222, 2232)
+
+
+def make_session_dir(tmp_path, name):
+    session_dir = tmp_path / "sessions" / name
+    session_dir.mkdir(parents=True)
+    return session_dir
+
+
+def test_allocate_and_release(tmp_path):
+    registry_dir = tmp_path / "state"
+    first = make_session_dir(tmp_path, "first")
+    second = make_session_dir(tmp_path, "second")
+
+    # The lowest port that is neither listening nor assigned
+    assert allocate_port(registry_dir, "host", "first", first, in_use=[2222], port_range=PORTS) == 2223
+    assert allocate_port(registry_dir, "host", "second", second, in_use=[2222], port_range=PORTS) == 2224
+    # Ports are per host
+    assert allocate_port(registry_dir, "other", "second", second, in_use=[], port_range=PORTS) == 2222
+    # A session keeps its port
+    assert allocate_port(registry_dir, "host", "first", first, in_use=[2222], port_range=PORTS) == 2223
+
+    with pytest.raises(PortAllocationError, match="assigned to session first"):
+        allocate_port(registry_dir, "host", "second", second, in_use=[], port_range=PORTS, requested=2223)
+    with pytest.raises(PortAllocationError, match="No free port"):
+        allocate_port(registry_dir, "host", "second", second, in_use=list(PORTS), port_range=PORTS)
+
+    release_ports(registry_dir, first)
+    assert allocate_port(registry_dir, "host", "second", second, in_use=[], port_range=PORTS, requested=2223) == 2223
+    assert [(a.host, a.port) for a in load_registry(registry_dir).assignments] == [("other", 2222), ("host", 2223)]
+
+
+def test_stale_sessions_are_pruned(tmp_path):
+    registry_dir = tmp_path / "state"
+    gone = make_session_dir(tmp_path, "gone")
+    assert allocate_port(registry_dir, "host", "gone", gone, in_use=[], port_range=PORTS) == 2222
+    gone.rmdir()
+    live = make_session_dir(tmp_path, "live")
+    assert allocate_port(registry_dir, "host", "live", live, in_use=[], port_range=PORTS) == 2222
+
+
+def test_parallel_allocation(tmp_path):
+    registry_dir = tmp_path / "state"
+    session_dirs = [make_session_dir(tmp_path, f"session{i}") for i in range(10)]
+
+    def allocate(session_dir):
+        return allocate_port(registry_dir, "host", session_dir.name, session_dir, in_use=[], port_range=PORTS)
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        ports = list(executor.map(allocate, session_dirs))
+    assert sorted(ports) == list(PORTS)
+
+
+def test_reassign_port(tmp_path):
+    registry_dir = tmp_path / "state"
+    pooled = make_session_dir(tmp_path, "pooled")
+    claimer = make_session_dir(tmp_path, "claimer")
+    assert allocate_port(registry_dir, "host", "pooled", pooled, in_use=[], port_range=PORTS) == 2222
+    assert allocate_port(registry_dir, "host", "claimer", claimer, in_use=[], port_range=PORTS) == 2223
+
+    # The claiming session gives up its own port, and takes over the port of the pooled container
+    reassign_port(registry_dir, "host", 2222, "claimer", claimer)
+    assert [(a.port, a.session_name) for a in load_registry(registry_dir).assignments] == [(2222, "claimer")]
@@ -0,0 +1,26 @@
+"""Test the prefetch module"""
+
+import threading
+from pathlib import Path
+
+from dockerdo.prefetch import PrefetchStats, prefetch_tree
+
+
+def test_prefetch_tree(tmp_path):
+    project = tmp_path / "opt" / "project"
+    for package in range(3):
+        (project / f"pkg{package}" / "sub").mkdir(parents=True)
+        for module in range(4):
+            (project / f"pkg{package}" / f"module{module}.py").write_text("")
+    (project / "link").symlink_to(tmp_path / "opt")
+
+    stats = prefetch_tree(tmp_path, [Path("/opt/project"), Path("/missing")], max_entries=1000)
+    # project, missing, 3 packages and their subdirectories. The symlink is not followed.
+    assert stats == PrefetchStats(directories=8, entries=4 + 3 * 5, truncated=False)
+
+    stats = prefetch_tree(tmp_path, [Path("/opt/project")], max_entries=2)
+    assert stats == PrefetchStats(directories=1, entries=4, truncated=True)
+
+    stop = threading.Event()
+    stop.set()
+    assert prefetch_tree(tmp_path, [Path("/opt")], max_entries=1000, stop=stop).directories == 0
@@ -3,7 +3,7 @@
 import pytest
 import re
 
-from dockerdo.prettyprint import format_bullet, format_action
+from dockerdo.prettyprint import format_bullet, format_action, ActionGroup, LongAction, format_age
 
 RE_MULTISPACE = re.compile(r"\s+")
 
@@ -31,3 +31,24 @@ def test_format_action(host, verb, text, status, expected):
     result = str(format_action(host, verb, text, status))
     result = RE_MULTISPACE.sub(" ", result)
     assert result == expected
+
+
+def test_action_group():
+    """Concurrent actions are rendered together, one line each"""
+    group = ActionGroup()
+    with group:
+        with LongAction("local", "Running", "Ran", "first", group=group) as first:
+            first.set_status("OK")
+        with LongAction("remote", "Running", "Ran", "second", group=group):
+            pass
+    assert [action.status for action in group.actions] == ["OK", "FAIL"]
+
+
+@pytest.mark.parametrize("age, expected", [
+    (5, "just now"),
+    (90, "1m ago"),
+    (7200, "2h ago"),
+    (3 * 86400 + 5, "3d ago"),
+])
+def test_format_age(age, expected):
+    assert format_age(1000000.0 - age, now=1000000.0) == expected
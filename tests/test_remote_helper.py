@@ -0,0 +1,42 @@
+"""Test the remote helper script and the parsing of its answers"""
+
+import subprocess
+
+from dockerdo.remote_helper import HostStatus, format_helper_args, helper_queries, read_helper_script
+
+
+def test_format_helper_args():
+    assert format_helper_args(helper_queries()) == "sh .dockerdo-helper-v3.sh"
+    assert format_helper_args(helper_queries(image="foo:latest", container="bar", ports=True, files=True)) == (
+        "sh .dockerdo-helper-v3.sh image=foo:latest container=bar ports files"
+    )
+    assert helper_queries(image="foo:latest", all_images=True, all_containers=True) == ["images", "containers"]
+
+
+def test_helper_script(tmp_path):
+    (tmp_path / 'with "quotes"').touch()
+    (tmp_path / "plain").touch()
+    (tmp_path / "session.tar.gz").write_bytes(b"x" * 100)
+    output = subprocess.check_output(
+        ["sh", "-s", "disk", "files", "ports", "tarballs"], input=read_helper_script().encode("utf-8"), cwd=tmp_path
+    )
+    status = HostStatus.model_validate_json(output)
+    assert status.version == 3
+    assert sorted(status.files or []) == ["plain", "session.tar.gz", 'with "quotes"']
+    assert status.tarballs is not None
+    assert [(tarball.name, tarball.size) for tarball in status.tarballs] == [("session.tar.gz", 100)]
+    assert status.disk is not None
+    assert status.disk.total_kb > 0
+    assert status.ports is not None
+    # Not asked
+    assert status.images is None
+    assert status.containers is None
+
+
+def test_host_status_find_container():
+    status = HostStatus.model_validate_json(
+        '{"version": 1, "images": [], "containers": [{"ID": "abc", "Names": "foo,bar", "State": "running"}]}'
+    )
+    assert status.find_container("bar") == {"ID": "abc", "Names": "foo,bar", "State": "running"}
+    assert status.find_container("baz") is None
+    assert not status.has_image()
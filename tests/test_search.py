@@ -0,0 +1,27 @@
+"""Test the search module"""
+
+import io
+from pathlib import Path
+
+from dockerdo.search import LocalPathOutput, format_search_command, rewrites_paths
+
+
+def test_format_search_command():
+    assert format_search_command("grep", ["-rn", "def main", "src"]) == "grep -H -rn 'def main' src"
+    assert format_search_command("grep", ["-h", "x", "file"]) == "grep -h x file"
+    assert not rewrites_paths("grep", ["--no-filename", "x"])
+    assert format_search_command("find", ["/usr/include", "-name", "*.h"]) == "find /usr/include -name '*.h'"
+    assert rewrites_paths("find", [])
+
+
+def test_local_path_output():
+    destination = io.BytesIO()
+    output = LocalPathOutput(destination, Path("/home/user/project/container"))
+    output.write(b"/usr/include/stdio.h:12:int printf\nsrc/main.c:3:/* comment */\n--\n/opt/pro")
+    assert destination.getvalue() == (
+        b"/home/user/project/container/usr/include/stdio.h:12:int printf\nsrc/main.c:3:/* comment */\n--\n"
+    )
+    output.write(b"ject/README")
+    output.close()
+    assert destination.getvalue().endswith(b"--\n/home/user/project/container/opt/project/README")
+    assert output.byte_count == 84
@@ -0,0 +1,73 @@
+"""Test the session index"""
+
+import os
+from pathlib import Path
+
+from dockerdo.config import Session
+from dockerdo.session_index import SessionIndex
+
+
+def make_session(sessions_dir: Path, name: str, remote_host=None) -> Session:
+    session = Session(
+        name=name,
+        container_name=f"{name}_container",
+        remote_host=remote_host,
+        distro="ubuntu",
+        base_image="ubuntu:latest",
+        session_dir=sessions_dir / name,
+        remote_host_build_dir=Path("."),
+        local_work_dir=sessions_dir,
+    )
+    session.save()
+    return session
+
+
+def test_update_and_remove(tmp_path):
+    index = SessionIndex(tmp_path / "state")
+    first = make_session(tmp_path / "sessions", "first")
+    second = make_session(tmp_path / "sessions", "second", remote_host="reykjavik")
+    index.update(first)
+    index.update(second)
+    second.container_state = "running"
+    second.ssh_port_on_remote_host = 2223
+    index.update(second)
+
+    entries = index.sessions()
+    assert [(entry.name, entry.host, entry.container_state) for entry in entries] == [
+        ("first", "localhost", "nothing"),
+        ("second", "reykjavik", "running"),
+    ]
+    assert entries[1].ssh_port_on_remote_host == 2223
+
+    # Every exec writes the history database, which counts as activity
+    history_path = second.session_dir / "history.sqlite"
+    history_path.touch()
+    os.utime(history_path, (entries[1].updated_at + 100, entries[1].updated_at + 100))
+    assert entries[1].last_active() == entries[1].updated_at + 100
+    assert entries[0].last_active() == entries[0].updated_at
+
+    index.remove(first.session_dir)
+    assert [entry.name for entry in index.sessions()] == ["second"]
+    index.close()
+
+
+def test_discover_and_prune(tmp_path):
+    sessions_dir = tmp_path / "sessions"
+    index = SessionIndex(tmp_path / "state")
+    indexed = make_session(sessions_dir, "indexed")
+    index.update(indexed)
+    make_session(sessions_dir, "older")
+    (sessions_dir / "not_a_session").mkdir()
+
+    # Read only, for dry runs
+    assert [session.name for session in index.unindexed(sessions_dir)] == ["older"]
+    assert [entry.name for entry in index.sessions()] == ["indexed"]
+    assert index.discover(sessions_dir) == [sessions_dir / "older"]
+    assert index.discover(sessions_dir) == []
+    assert [entry.name for entry in index.sessions()] == ["indexed", "older"]
+
+    (indexed.session_dir / "session.yaml").unlink()
+    assert [entry.name for entry in index.missing()] == ["indexed"]
+    assert [entry.name for entry in index.sessions()] == ["indexed", "older"]
+    assert [entry.name for entry in index.prune_missing()] == ["indexed"]
+    assert [entry.name for entry in index.sessions()] == ["older"]
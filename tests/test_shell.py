@@ -1,8 +1,16 @@
 """Test the shell module"""
 
+import io
+import os
 import pytest
 
-from dockerdo.shell import parse_docker_ps_output, determine_acceptable_container_state
+from dockerdo.shell import (
+    parse_docker_ps_output,
+    determine_acceptable_container_state,
+    split_timing_marker,
+    find_container,
+    OutputPump,
+)
 
 
 @pytest.mark.parametrize("output, expected", [
@@ -26,3 +34,46 @@ def test_parse_docker_ps_output(output, expected):
 ])
 def test_determine_acceptable_container_state(actual_state, expected):
     assert determine_acceptable_container_state(actual_state) == expected
+
+
+@pytest.mark.parametrize("data, expected_data, expected_time", [
+    (b"", b"", None),
+    (b"error\n", b"error\n", None),
+    (b"error\n\x1edockerdo-timing 1000000000 3500000000\n", b"error\n", 2.5),
+    (b"\x1edockerdo-timing 10 10", b"", 0.0),
+    # date without %N: the marker is removed, without a time
+    (b"error\n\x1edockerdo-timing 1700000000N 1700000001N\n", b"error\n", None),
+    (b"\x1edockerdo-timing %s %N\n", b"", None),
+    # Not at the start of a line
+    (b"a \x1edockerdo-timing 10 10\n", b"a \x1edockerdo-timing 10 10\n", None),
+])
+def test_split_timing_marker(data, expected_data, expected_time):
+    assert split_timing_marker(data) == (expected_data, expected_time)
+
+
+def test_output_pump_strips_marker():
+    read_fd, write_fd = os.pipe()
+    destination = io.BytesIO()
+    with os.fdopen(read_fd, "rb") as source:
+        pump = OutputPump(source, destination, strip_timing=True)
+        pump.start()
+        os.write(write_fd, b"first line\n")
+        os.write(write_fd, b"second \x1e line\n\x1edockerdo-")
+        os.write(write_fd, b"timing 1000 2000\n")
+        os.close(write_fd)
+        pump.join()
+    assert destination.getvalue() == b"first line\nsecond \x1e line\n"
+    assert pump.byte_count == len(b"first line\nsecond \x1e line\n")
+    assert pump.remote_time == 1e-6
+
+
+def test_find_container_exact_match():
+    output = "\n".join([
+        '{"ID":"aaa","Names":"mycontainer2","State":"running"}',
+        '{"ID":"bbb","Names":"mycontainer","State":"exited"}',
+    ])
+    assert find_container(output, "mycontainer")["ID"] == "bbb"
+    assert find_container(output, "mycontainer2")["ID"] == "aaa"
+    assert find_container(output, "container") is None
+    assert find_container(output)["ID"] == "aaa"
+    assert parse_docker_ps_output(output, "mycontainer") == "exited"
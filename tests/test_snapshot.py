@@ -0,0 +1,58 @@
+"""Test a snapshot of a running session, with the fake tools of the benchmarks standing in for ssh, sshfs and docker"""
+
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from dockerdo import supervisor as supervisor_module
+from dockerdo.config import Session
+from dockerdo.shell import make_session_supervisor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+from run_benchmarks import Workspace  # noqa: E402
+
+
+async def wait_for(condition, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.slow
+def test_snapshot_keeps_session(tmp_path, monkeypatch):
+    # The fake sshfs does not really mount, so its readiness is not waited for
+    monkeypatch.setattr(supervisor_module, "READY_TIMEOUT", 0.1)
+    ws = Workspace(tmp_path, latency=0.0, bandwidth=0.0, image_mb=1, boot=0.0)
+    ws.set_container_state(running=True)
+    for name in ("PATH", "HOME", "DOCKERDO_BENCH_ROOT"):
+        monkeypatch.setenv(name, ws.env[name])
+    # The mount is started with our stdin, which pytest replaces by one without a file descriptor
+    monkeypatch.setattr(sys, "stdin", open(os.devnull))
+    session = Session.load(ws.session_dir)
+    assert session.remote_host is not None and session.ssh_port_on_remote_host is not None
+    supervisor = make_session_supervisor(session, session.remote_host, session.ssh_port_on_remote_host, record=False)
+    components = {component.name: component for component in supervisor.components}
+
+    async def main():
+        task = asyncio.create_task(supervisor.run(show_progress=False))
+        # The fake docker events creates the file of events once it follows it
+        await wait_for(lambda: components["events"].state == "running" and (tmp_path / "events.jsonl").exists())
+        # Like docker commit, the fake one pauses the container while committing
+        await asyncio.get_running_loop().run_in_executor(None, ws.run_cli, ["snapshot", "first"])
+        await asyncio.sleep(0.5)
+        assert "pause" in (tmp_path / "events.jsonl").read_text()
+        assert not supervisor.shutting_down
+        assert {name: component.state for name, component in components.items()} == {
+            "ssh master": "running", "sshfs": "running", "events": "running"
+        }
+        assert all(component.restarts == 0 for component in components.values())
+        supervisor.request_shutdown("test done")
+        return await asyncio.wait_for(task, timeout=10)
+
+    assert asyncio.run(main()) == 0
+    assert [snapshot.name for snapshot in Session.load(ws.session_dir).snapshots] == ["first"]
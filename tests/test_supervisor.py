@@ -0,0 +1,193 @@
+"""Test the session supervisor"""
+
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from dockerdo import supervisor as supervisor_module
+from dockerdo.config import Session
+from dockerdo.container_state import CachedContainerState, load_cached_state
+from dockerdo.supervisor import Supervisor, ProcessComponent, EventsComponent, PrefetchComponent
+
+
+def make_session(tmp_path: Path) -> Session:
+    return Session(
+        name="test",
+        container_name="test_container",
+        distro="ubuntu",
+        base_image="ubuntu:latest",
+        session_dir=tmp_path,
+        remote_host_build_dir=Path("."),
+        local_work_dir=tmp_path,
+    )
+
+
+async def control_request(socket_path: Path, request: str) -> dict:
+    reader, writer = await asyncio.open_unix_connection(str(socket_path))
+    writer.write(f"{request}\n".encode("utf-8"))
+    response = json.loads(await reader.readline())
+    writer.close()
+    return response
+
+
+async def wait_for(condition, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_restart_with_backoff_and_control_socket(tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor_module, "BACKOFF_INITIAL", 0.01)
+    session = make_session(tmp_path)
+    flaky = ProcessComponent("flaky", "flaky", ["sh", "-c", "exit 3"], cwd=tmp_path)
+    steady = ProcessComponent("steady", "steady", ["sleep", "30"], cwd=tmp_path)
+    supervisor = Supervisor(session, [steady, flaky])
+
+    async def main():
+        task = asyncio.create_task(supervisor.run(show_progress=False))
+        await wait_for(lambda: flaky.restarts >= 2)
+        health = await control_request(supervisor.control_path, "status")
+        assert health["components"]["steady"]["state"] == "running"
+        assert health["components"]["steady"]["restarts"] == 0
+        assert health["components"]["flaky"]["last_exit"] == 3
+        assert await control_request(supervisor.control_path, "shutdown") == {"ok": True}
+        return await asyncio.wait_for(task, timeout=10)
+
+    assert asyncio.run(main()) == 0
+    assert supervisor.shutdown_reason == "shutdown requested"
+    assert steady.process is not None and steady.process.returncode is not None
+    assert steady.state == "stopped"
+    assert not supervisor.control_path.exists()
+
+
+def test_reconnect_restarts_connections(tmp_path):
+    session = make_session(tmp_path)
+    connection = ProcessComponent("connection", "connection", ["sleep", "30"], cwd=tmp_path, reconnect=True)
+    other = ProcessComponent("other", "other", ["sleep", "30"], cwd=tmp_path)
+    supervisor = Supervisor(session, [connection, other])
+
+    async def main():
+        task = asyncio.create_task(supervisor.run(show_progress=False))
+        await wait_for(lambda: supervisor.control_path.exists() and connection.state == "running")
+        first_pid = connection.pid
+        assert await control_request(supervisor.control_path, "reconnect") == {"ok": True}
+        # Restarted immediately, without backoff
+        await wait_for(lambda: connection.restarts == 1 and connection.state == "running", timeout=2)
+        assert connection.pid != first_pid
+        assert other.restarts == 0
+        supervisor.request_shutdown("done")
+        return await asyncio.wait_for(task, timeout=10)
+
+    assert asyncio.run(main()) == 0
+
+
+def test_watchdog_restarts_unhealthy(tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor_module, "WATCHDOG_INTERVAL", 0.05)
+    session = make_session(tmp_path)
+    checks = []
+
+    def health_check() -> bool:
+        checks.append(time.monotonic())
+        # Hung after the first check
+        return len(checks) < 2
+
+    hung = ProcessComponent("hung", "hung", ["sleep", "30"], cwd=tmp_path, health_check=health_check)
+    supervisor = Supervisor(session, [hung])
+
+    async def main():
+        task = asyncio.create_task(supervisor.run(show_progress=False))
+        await wait_for(lambda: hung.restarts >= 1)
+        supervisor.request_shutdown("done")
+        return await asyncio.wait_for(task, timeout=10)
+
+    assert asyncio.run(main()) == 0
+    assert len(checks) >= 2
+
+
+def test_shutdown_while_starting(tmp_path):
+    session = make_session(tmp_path)
+
+    def request_shutdown() -> None:
+        # Runs in a worker thread, before the process is started
+        loop.call_soon_threadsafe(supervisor.request_shutdown, "shutdown requested")
+        time.sleep(0.2)
+
+    slow = ProcessComponent("slow", "slow", ["sleep", "30"], cwd=tmp_path, before_start=request_shutdown)
+    supervisor = Supervisor(session, [slow])
+
+    async def main():
+        nonlocal loop
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(supervisor.run(show_progress=False), timeout=10)
+
+    loop = None
+    assert asyncio.run(main()) == 0
+    assert slow.process is not None and slow.process.returncode is not None
+
+
+def test_container_stop_shuts_down(tmp_path):
+    session = make_session(tmp_path)
+    event = {"Type": "container", "Action": "die", "id": "abc", "Actor": {"Attributes": {"name": "test_container"}}}
+    cached = CachedContainerState(container_name="test_container", state="running", checked_at=time.time())
+    events = EventsComponent(
+        ["sh", "-c", f"echo '{json.dumps(event)}'; exec sleep 30"], tmp_path, session_dir=tmp_path, cached=cached
+    )
+    supervisor = Supervisor(session, [events])
+
+    asyncio.run(asyncio.wait_for(supervisor.run(show_progress=False), timeout=10))
+    assert supervisor.shutdown_reason == "container exited"
+    saved = load_cached_state(tmp_path, "test_container", max_age=float("inf"))
+    assert saved is not None
+    assert saved.state == "exited"
+    # No longer kept up to date
+    assert saved.watcher_pid is None
+
+
+def test_container_pause_keeps_session(tmp_path):
+    session = make_session(tmp_path)
+    # docker commit pauses the container while it takes the snapshot
+    pause = {"Type": "container", "Action": "pause", "id": "abc", "Actor": {"Attributes": {"name": "test_container"}}}
+    unpause = {**pause, "Action": "unpause"}
+    cached = CachedContainerState(container_name="test_container", state="running", checked_at=time.time())
+    events = EventsComponent(
+        ["sh", "-c", f"echo '{json.dumps(pause)}'; echo '{json.dumps(unpause)}'; exec sleep 30"],
+        tmp_path,
+        session_dir=tmp_path,
+        cached=cached,
+    )
+    supervisor = Supervisor(session, [events])
+
+    async def main():
+        task = asyncio.create_task(supervisor.run(show_progress=False))
+        await wait_for(lambda: events.state == "running")
+        # Give the events time to arrive
+        await asyncio.sleep(0.5)
+        assert cached.state == "running"
+        assert not supervisor.shutting_down
+        assert await control_request(supervisor.control_path, "shutdown") == {"ok": True}
+        return await asyncio.wait_for(task, timeout=10)
+
+    assert asyncio.run(main()) == 0
+    assert supervisor.shutdown_reason == "shutdown requested"
+
+
+def test_prefetch_component(tmp_path):
+    session = make_session(tmp_path)
+    session.prefetch_paths = [Path("/opt/project")]
+    session.sshfs_cache_timeout = 1
+    (session.sshfs_container_mount_point / "opt" / "project" / "src").mkdir(parents=True)
+    prefetch = PrefetchComponent(session)
+    supervisor = Supervisor(session, [prefetch])
+
+    async def main():
+        task = asyncio.create_task(supervisor.run(show_progress=False))
+        await wait_for(lambda: prefetch.last_prefetch is not None)
+        supervisor.request_shutdown("test")
+        return await asyncio.wait_for(task, timeout=10)
+
+    assert asyncio.run(main()) == 0
+    assert prefetch.last_prefetch is not None
+    assert prefetch.last_prefetch.directories == 2
+    assert prefetch.state == "stopped"
@@ -0,0 +1,38 @@
+"""Test the trace module"""
+
+import json
+
+from dockerdo import trace
+
+
+def test_trace_disabled(monkeypatch):
+    monkeypatch.setattr(trace, "_trace_path", None)
+    monkeypatch.setattr(trace, "_events", [])
+    with trace.span("nothing", "test"):
+        pass
+    trace.instant("nothing", "test")
+    assert trace._events == []
+
+
+def test_trace_write(monkeypatch, tmp_path):
+    monkeypatch.setattr(trace, "_events", [])
+    monkeypatch.setattr(trace, "_trace_path", None)
+    monkeypatch.setattr(trace.atexit, "register", lambda func: None)
+    trace.enable(tmp_path, name="exec")
+    with trace.span("ssh", "subprocess", command="ssh host ls") as span_args:
+        span_args["returncode"] = 0
+    trace.sleep(0.01, reason="remote delay")
+    trace.instant("ssh master", "subprocess")
+    trace.write()
+    monkeypatch.setattr(trace, "_trace_path", None)
+
+    trace_files = list(tmp_path.glob("dockerdo-exec-*.json"))
+    assert len(trace_files) == 1
+    with open(trace_files[0], "r") as fin:
+        events = json.load(fin)["traceEvents"]
+    assert [event["name"] for event in events] == ["exec", "ssh", "sleep", "ssh master"]
+    assert events[1]["ph"] == "X"
+    assert events[1]["args"] == {"command": "ssh host ls", "returncode": "0"}
+    assert events[2]["dur"] >= 10000
+    assert events[2]["args"]["reason"] == "remote delay"
+    assert events[0]["dur"] >= events[2]["dur"]
@@ -1,9 +1,22 @@
 """Test the utils module"""
 
 import pytest
+import socket
+import struct
+import threading
 import time
 
-from dockerdo.utils import ephemeral_container_name, make_image_tag
+from dockerdo.utils import (
+    ephemeral_container_name,
+    make_image_tag,
+    make_snapshot_tag,
+    percentile,
+    probe_path,
+    process_start_time,
+    snapshot_base_image,
+    split_image_reference,
+    ssh_master_alive,
+)
 
 
 def test_ephemeral_container_name():
@@ -44,3 +57,71 @@ def test_make_image_tag_custom_template(registry, base_image, session_name, expe
         session_name,
         "custom:{base_image}-{session_name}-{base_image_tag}-foo"
     ) == expected
+
+
+@pytest.mark.parametrize(
+    "image_tag, expected",
+    [
+        ("dockerdo-alpine:nightly-test", "dockerdo-alpine:nightly-test-snapshot-1"),
+        ("harbor.local:5000/dockerdo-alpine:latest-foo", "harbor.local:5000/dockerdo-alpine:latest-foo-snapshot-1"),
+        ("harbor.local:5000/custom", "harbor.local:5000/custom:latest-snapshot-1"),
+    ],
+)
+def test_make_snapshot_tag(image_tag, expected):
+    assert make_snapshot_tag(image_tag, "1") == expected
+    assert snapshot_base_image(expected) == snapshot_base_image(image_tag)
+    assert split_image_reference(expected)[1].endswith("-snapshot-1")
+
+
+@pytest.mark.parametrize("values, q, expected", [
+    ([], 50, None),
+    ([3.0], 90, 3.0),
+    ([1.0, 2.0, 3.0, 4.0], 50, 2.5),
+    ([4.0, 1.0, 3.0, 2.0], 100, 4.0),
+    ([1.0, 2.0, 3.0, 4.0, 5.0], 90, 4.6),
+])
+def test_percentile(values, q, expected):
+    assert percentile(values, q) == pytest.approx(expected)
+
+
+def test_process_start_time():
+    assert 0 < time.time() - process_start_time() < 3600
+
+
+def mux_message(*values: int) -> bytes:
+    payload = struct.pack(f">{len(values)}I", *values)
+    return struct.pack(">I", len(payload)) + payload
+
+
+def serve_ssh_master(server: socket.socket) -> None:
+    """Answer one `ssh -O check` like an ssh master"""
+    connection, _ = server.accept()
+    with connection:
+        connection.sendall(mux_message(0x00000001, 4))
+        assert connection.recv(12) == mux_message(0x00000001, 4)
+        _, _, request_id = struct.unpack(">III", connection.recv(12))
+        connection.sendall(mux_message(0x80000005, request_id, 1234))
+
+
+def test_ssh_master_alive(tmp_path):
+    path = tmp_path / "socket"
+    assert not ssh_master_alive(path, timeout=1.0)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(path))
+        server.listen()
+        thread = threading.Thread(target=serve_ssh_master, args=(server,))
+        thread.start()
+        assert ssh_master_alive(path, timeout=1.0)
+        thread.join()
+        # Accepting connections is not enough: a stuck master does not answer
+        start = time.monotonic()
+        assert not ssh_master_alive(path, timeout=0.2)
+        assert time.monotonic() - start < 1.0
+    # A stale socket file left behind by a dead process
+    assert path.exists()
+    assert not ssh_master_alive(path, timeout=1.0)
+
+
+def test_probe_path(tmp_path):
+    assert probe_path(tmp_path, timeout=1.0)
+    assert not probe_path(tmp_path / "missing", timeout=1.0)